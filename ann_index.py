@@ -0,0 +1,367 @@
+"""On-disk IVF-PQ approximate nearest neighbour index of face embeddings.
+
+ Indexes the rows of the float16 .npy matrices written by `embed.py`. Each
+ vector is assigned to the nearest of --nlist coarse k-means centroids (the
+ inverted lists) and the residual to that centroid is product quantized: the
+ vector is cut into --m sub-vectors, each stored as the uint8 number of the
+ nearest of 256 sub-centroids. A 3120-d embedding shrinks from 6240 bytes to
+ m bytes.
+
+ A search ranks the coarse centroids, scans the codes of the --nprobe nearest
+ lists with one 256-entry distance table per sub-vector (asymmetric distance
+ computation), and optionally re-ranks the best k * --refine candidates with
+ the exact vectors, read from the memory-mapped source matrices.
+
+ The index is a directory:
+
+   meta.json        dimensions, parameters and the list of segments
+   coarse.npy       (nlist, d) coarse centroids
+   codebooks.npy    (m, 256, d / m) sub-centroids
+   segment_NNNNN/   one per build or add: the ids, the codes transposed to
+                    (m, n) and grouped by list, and the list offsets
+
+ Every `add` writes a new segment and swaps meta.json atomically, so
+ searches never see a half-written index. Ids are consecutive over the added
+ rows, in order.
+
+ Usage:
+   python ann_index.py build --embeddings=gallery.npy --index=gallery.ivfpq
+   python ann_index.py add --embeddings=new.npy --index=gallery.ivfpq
+   python ann_index.py search --index=gallery.ivfpq --queries=probe.npy
+   python ann_index.py benchmark --index=gallery.ivfpq --nprobe=1,4,16,64
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+KSUB = 256
+_CHUNK = 16384
+
+
+def _sq_distances(x, centroids, centroid_norms=None):
+  """Squared L2 distances of the rows of x to every centroid."""
+  if centroid_norms is None:
+    centroid_norms = (centroids ** 2).sum(1)
+  d = (x ** 2).sum(1)[:, None] - 2. * x.dot(centroids.T)
+  d += centroid_norms[None]
+  return d
+
+
+def _assign(x, centroids):
+  norms = (centroids ** 2).sum(1)
+  return np.concatenate([
+      _sq_distances(x[i:i + _CHUNK], centroids, norms).argmin(1)
+      for i in range(0, len(x), _CHUNK)])
+
+
+def kmeans(x, k, iterations=10, rng=None):
+  """Lloyd's k-means; returns (k, d) float32 centroids."""
+  rng = rng or np.random.RandomState(0)
+  centroids = x[rng.choice(len(x), k, replace=len(x) < k)].copy()
+  for _ in range(iterations):
+    assignment = _assign(x, centroids)
+    counts = np.bincount(assignment, minlength=k)
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, assignment, x)
+    empty = counts == 0
+    centroids[~empty] = sums[~empty] / counts[~empty, None]
+    # Reseed empty clusters with random points.
+    centroids[empty] = x[rng.choice(len(x), empty.sum())]
+  return centroids
+
+
+def _padded(x, dim):
+  """Rows of x as float32, zero padded to dim columns."""
+  x = np.asarray(x, dtype=np.float32)
+  if x.shape[1] < dim:
+    x = np.pad(x, [(0, 0), (0, dim - x.shape[1])], mode='constant')
+  return x
+
+
+class IVFPQIndex(object):
+  """An IVF-PQ index directory."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'meta.json')) as f:
+      self.meta = json.load(f)
+    self.coarse = np.load(os.path.join(path, 'coarse.npy'))
+    self.codebooks = np.load(os.path.join(path, 'codebooks.npy'))
+    self._coarse_norms = (self.coarse ** 2).sum(1)
+    self._codebook_norms = (self.codebooks ** 2).sum(2)
+    self.segments = [self._load_segment(s) for s in self.meta['segments']]
+    self._sources = {}
+
+  @property
+  def dim(self):
+    return self.meta['dim']
+
+  @property
+  def ntotal(self):
+    return sum(s['count'] for s in self.meta['segments'])
+
+  def _load_segment(self, segment):
+    directory = os.path.join(self.path, segment['name'])
+    return {'ids': np.load(os.path.join(directory, 'ids.npy')),
+            'codes': np.load(os.path.join(directory, 'codes.npy'),
+                             mmap_mode='r'),
+            'offsets': np.load(os.path.join(directory, 'offsets.npy')),
+            'first_id': segment['first_id'], 'source': segment['source']}
+
+  @classmethod
+  def train(cls, path, vectors, nlist, m, train_size=100000, seed=0):
+    """Train the quantizers on a sample of vectors; returns the empty index."""
+    rng = np.random.RandomState(seed)
+    dim = vectors.shape[1]
+    padded_dim = -(-dim // m) * m
+    sample = np.sort(rng.choice(len(vectors), min(train_size, len(vectors)),
+                                replace=False))
+    x = _padded(vectors[sample], padded_dim)
+    coarse = kmeans(x, nlist, rng=rng)
+    residuals = x - coarse[_assign(x, coarse)]
+    dsub = padded_dim // m
+    codebooks = np.stack([
+        kmeans(np.ascontiguousarray(residuals[:, j * dsub:(j + 1) * dsub]),
+               KSUB, rng=rng) for j in range(m)])
+
+    if os.path.exists(path):
+      shutil.rmtree(path)
+    os.makedirs(path)
+    np.save(os.path.join(path, 'coarse.npy'), coarse)
+    np.save(os.path.join(path, 'codebooks.npy'), codebooks)
+    _write_meta(path, {'dim': dim, 'padded_dim': padded_dim, 'nlist': nlist,
+                       'm': m, 'segments': []})
+    return cls(path)
+
+  def encode(self, x):
+    """(list numbers, (n, m) uint8 codes) of float32 padded vectors."""
+    lists = _assign(x, self.coarse)
+    residuals = x - self.coarse[lists]
+    m, _, dsub = self.codebooks.shape
+    codes = np.empty((len(x), m), dtype=np.uint8)
+    for j in range(m):
+      codes[:, j] = _assign(residuals[:, j * dsub:(j + 1) * dsub],
+                            self.codebooks[j])
+    return lists, codes
+
+  def add(self, source):
+    """Index every row of the .npy matrix at source, as one new segment."""
+    vectors = np.load(source, mmap_mode='r')
+    if vectors.shape[1] != self.dim:
+      raise ValueError('%s has %d columns, the index %d' %
+                       (source, vectors.shape[1], self.dim))
+    lists, codes = [], []
+    for i in range(0, len(vectors), _CHUNK):
+      l, c = self.encode(_padded(vectors[i:i + _CHUNK],
+                                 self.meta['padded_dim']))
+      lists.append(l)
+      codes.append(c)
+    lists = np.concatenate(lists)
+    codes = np.concatenate(codes)
+    order = np.argsort(lists, kind='stable')
+    first_id = self.ntotal
+    offsets = np.searchsorted(lists[order], np.arange(self.meta['nlist'] + 1))
+
+    name = 'segment_%05d' % len(self.meta['segments'])
+    tmp = os.path.join(self.path, name + '.tmp%d' % os.getpid())
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'ids.npy'), first_id + order.astype(np.int64))
+    np.save(os.path.join(tmp, 'codes.npy'),
+            np.ascontiguousarray(codes[order].T))
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets.astype(np.int64))
+    os.rename(tmp, os.path.join(self.path, name))
+
+    segment = {'name': name, 'first_id': first_id, 'count': len(vectors),
+               'source': os.path.abspath(source)}
+    self.meta['segments'].append(segment)
+    _write_meta(self.path, self.meta)
+    self.segments.append(self._load_segment(segment))
+
+  def _source_vector(self, i):
+    starts = [s['first_id'] for s in self.segments]
+    segment = self.segments[np.searchsorted(starts, i, side='right') - 1]
+    source = segment['source']
+    if source not in self._sources:
+      self._sources[source] = np.load(source, mmap_mode='r')
+    return self._sources[source][i - segment['first_id']]
+
+  def search_one(self, query, k, nprobe, refine=0):
+    """(squared distances, ids) of the approximate k nearest neighbours."""
+    q = _padded(query[None], self.meta['padded_dim'])
+    coarse = _sq_distances(q, self.coarse, self._coarse_norms)[0]
+    probes = np.argpartition(coarse, min(nprobe, len(coarse) - 1))[:nprobe]
+    m, _, dsub = self.codebooks.shape
+
+    # One distance table per probed list and sub-vector, (nprobe, m, 256).
+    residuals = (q - self.coarse[probes]).reshape(len(probes), m, dsub)
+    tables = (self._codebook_norms[None] + (residuals ** 2).sum(2)[:, :, None]
+              - 2. * np.einsum('pmd,mkd->pmk', residuals, self.codebooks))
+    tables = tables.ravel()
+
+    codes, ids, rows = [], [], []
+    for p, l in enumerate(probes):
+      for segment in self.segments:
+        lo, hi = segment['offsets'][l], segment['offsets'][l + 1]
+        if lo < hi:
+          codes.append(segment['codes'][:, lo:hi])
+          ids.append(segment['ids'][lo:hi])
+          rows.append(np.full(hi - lo, p * m * KSUB, dtype=np.int64))
+    if not ids:
+      return np.empty(0, np.float32), np.empty(0, np.int64)
+    codes = np.concatenate(codes, 1).astype(np.int64)
+    ids = np.concatenate(ids)
+    rows = np.concatenate(rows)
+    distances = np.take(tables, rows + codes[0])
+    for j in range(1, m):
+      distances += np.take(tables, rows + (j * KSUB + codes[j]))
+
+    keep = min(len(ids), k * refine if refine else k)
+    best = np.argpartition(distances, keep - 1)[:keep]
+    distances, ids = distances[best], ids[best]
+    if refine:
+      exact = np.array([self._source_vector(i) for i in ids],
+                       dtype=np.float32)
+      distances = ((exact - query[None].astype(np.float32)) ** 2).sum(1)
+    order = np.argsort(distances)[:k]
+    return distances[order], ids[order]
+
+  def search(self, queries, k, nprobe, refine=0):
+    """(q, k) distances and ids, -1 where fewer than k were found."""
+    all_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    all_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for i, query in enumerate(queries):
+      d, ids = self.search_one(query, k, nprobe, refine)
+      all_distances[i, :len(d)] = d
+      all_ids[i, :len(ids)] = ids
+    return all_distances, all_ids
+
+
+def _write_meta(path, meta):
+  tmp = os.path.join(path, 'meta.json.tmp%d' % os.getpid())
+  with open(tmp, 'w') as f:
+    json.dump(meta, f, indent=2)
+  os.rename(tmp, os.path.join(path, 'meta.json'))
+
+
+def exact_search(index, queries, k):
+  """Brute force k nearest ids over all sources of the index."""
+  queries = queries.astype(np.float32)
+  best_d = np.full((len(queries), k), np.inf, dtype=np.float32)
+  best_i = np.full((len(queries), k), -1, dtype=np.int64)
+  for segment in index.segments:
+    vectors = np.load(segment['source'], mmap_mode='r')
+    for start in range(0, len(vectors), _CHUNK):
+      chunk = np.asarray(vectors[start:start + _CHUNK], dtype=np.float32)
+      d = _sq_distances(queries, chunk)
+      i = np.broadcast_to(segment['first_id'] + start +
+                          np.arange(len(chunk)), d.shape)
+      d = np.concatenate([best_d, d], 1)
+      i = np.concatenate([best_i, i], 1)
+      top = np.argpartition(d, k - 1, axis=1)[:, :k]
+      best_d = np.take_along_axis(d, top, 1)
+      best_i = np.take_along_axis(i, top, 1)
+  return best_i
+
+
+def benchmark(index, queries, k, nprobes, refines):
+  """Recall@k and latency for every (nprobe, refine); yields dicts."""
+  truth = exact_search(index, queries, k)
+  for nprobe in nprobes:
+    for refine in refines:
+      index.search(queries[:1], k, nprobe, refine)  # warm the page cache
+      found, latencies = [], []
+      for q, true_ids in zip(queries, truth):
+        start = time.time()
+        _, ids = index.search_one(q, k, nprobe, refine)
+        latencies.append(time.time() - start)
+        found.append(len(np.intersect1d(ids, true_ids)) / k)
+      latencies = np.array(latencies)
+      yield {'nprobe': nprobe, 'refine': refine, 'k': k,
+             'recall': float(np.mean(found)),
+             'latency_ms_p50': 1000. * float(np.percentile(latencies, 50)),
+             'latency_ms_p99': 1000. * float(np.percentile(latencies, 99)),
+             'queries_per_sec': len(latencies) / latencies.sum()}
+
+
+def _ints(csv):
+  return [int(v) for v in csv.split(',') if v]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest='command')
+  build = commands.add_parser('build', help='train and fill a new index')
+  build.add_argument('--embeddings', required=True)
+  build.add_argument('--index', required=True)
+  build.add_argument('--nlist', type=int, default=1024)
+  build.add_argument('--m', type=int, default=48)
+  build.add_argument('--train_size', type=int, default=100000)
+  build.add_argument('--seed', type=int, default=0)
+  add = commands.add_parser('add', help='index the rows of another matrix')
+  add.add_argument('--embeddings', required=True)
+  add.add_argument('--index', required=True)
+  for name in ('search', 'benchmark'):
+    command = commands.add_parser(name)
+    command.add_argument('--index', required=True)
+    command.add_argument('--k', type=int, default=10)
+    command.add_argument('--refine', default='0')
+    command.add_argument('--nprobe', default='16')
+  search = commands.choices['search']
+  search.add_argument('--queries', required=True,
+                      help='.npy matrix of query embeddings')
+  bench = commands.choices['benchmark']
+  bench.add_argument('--num_queries', type=int, default=1000)
+  bench.add_argument('--seed', type=int, default=0)
+  bench.add_argument('--output', default='./ann_benchmark.jsonl')
+  args = parser.parse_args()
+
+  if args.command == 'build':
+    vectors = np.load(args.embeddings, mmap_mode='r')
+    start = time.time()
+    index = IVFPQIndex.train(args.index, vectors, args.nlist, args.m,
+                             args.train_size, args.seed)
+    print('Trained in %.1f sec.' % (time.time() - start))
+    index.add(args.embeddings)
+    print('Indexed %d vectors in %.1f sec.' % (index.ntotal,
+                                               time.time() - start))
+  elif args.command == 'add':
+    index = IVFPQIndex(args.index)
+    index.add(args.embeddings)
+    print('Index holds %d vectors.' % index.ntotal)
+  elif args.command == 'search':
+    index = IVFPQIndex(args.index)
+    queries = np.load(args.queries)
+    distances, ids = index.search(queries, args.k, _ints(args.nprobe)[0],
+                                  _ints(args.refine)[0])
+    for d, i in zip(distances, ids):
+      print(' '.join('%d:%.4f' % pair for pair in zip(i, d)))
+  elif args.command == 'benchmark':
+    index = IVFPQIndex(args.index)
+    rng = np.random.RandomState(args.seed)
+    ids = np.sort(rng.choice(index.ntotal, min(args.num_queries,
+                                               index.ntotal), replace=False))
+    queries = np.array([index._source_vector(i) for i in ids],
+                       dtype=np.float32)
+    with open(args.output, 'a') as f:
+      for result in benchmark(index, queries, args.k, _ints(args.nprobe),
+                              _ints(args.refine)):
+        result['ntotal'] = index.ntotal
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+        print('nprobe %4d refine %2d  recall@%d %.3f  p50 %.2f ms  '
+              'p99 %.2f ms' % (result['nprobe'], result['refine'], args.k,
+                               result['recall'], result['latency_ms_p50'],
+                               result['latency_ms_p99']))
+  else:
+    parser.print_help()
+
+
+if __name__ == '__main__':
+  main()
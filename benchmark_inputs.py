@@ -0,0 +1,367 @@
+"""Benchmarks the input pipeline stage by stage and end to end.
+
+ Writes synthetic shards in the exact face record schema read by
+ `image_processing.parse_example_proto` (image/data, image/points,
+ image/class/label, image/class/text), then measures examples/sec and step
+ latency of
+
+   read         raw TFRecord reads
+   parse        parse_example_proto per example, _parse_example_batch
+   decode       decode_raw and reshape of images and points
+   flip         per-example flip baseline, random_flip_batch
+   color        per-example color baseline, distort_color_batch
+   crop         per-example crop baseline, extract_feature_points_batch
+   model        model.model forward pass, for every tower mode
+   batch_inputs queue-runner pipeline end to end
+   dataset      tf.data pipeline end to end
+
+ Each isolated stage runs on in-memory inputs. The per-example variants run
+ their op under tf.map_fn over the same batch as the batched variant, so both
+ pay one session call per batch and differ only in the ops. The end-to-end
+ pipelines shuffle with --input_queue_memory_factor lowered to fit the
+ synthetic set, so the queues hold at most the records on disk. The
+ end-to-end runs sweep
+ --bench_num_readers, --bench_preprocess_threads and --bench_batch_sizes.
+ Every measurement is one JSON line in --bench_output.
+
+ Usage:
+   python benchmark_inputs.py --bench_dir=/tmp/bench --bench_steps=50
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import platform
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import face_runtime
+import image_processing
+import model
+import util
+
+tf.app.flags.DEFINE_string('bench_dir', '/tmp/face_input_benchmark',
+                           """Directory of the synthetic shards.""")
+tf.app.flags.DEFINE_integer('bench_shards', 8,
+                            """Number of synthetic shards.""")
+tf.app.flags.DEFINE_integer('bench_records_per_shard', 256,
+                            """Records per synthetic shard.""")
+tf.app.flags.DEFINE_integer('bench_steps', 50,
+                            """Timed runs per measurement.""")
+tf.app.flags.DEFINE_integer('bench_warmup_steps', 5,
+                            """Untimed runs before each measurement.""")
+tf.app.flags.DEFINE_string('bench_batch_sizes', '32',
+                           """Comma separated batch sizes to sweep.""")
+tf.app.flags.DEFINE_string('bench_num_readers', '1,4',
+                           """Comma separated reader counts to sweep.""")
+tf.app.flags.DEFINE_string('bench_preprocess_threads', '4,8',
+                           """Comma separated preprocessing thread counts """
+                           """to sweep.""")
+tf.app.flags.DEFINE_string('bench_stages', 'all',
+                           """Comma separated stages to run, or 'all'.""")
+tf.app.flags.DEFINE_string('bench_output', './input_benchmark.jsonl',
+                           """File the JSON results are appended to.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+STAGES = ['read', 'parse', 'decode', 'flip', 'color', 'crop', 'model',
+          'batch_inputs', 'dataset']
+
+
+def _ints(csv):
+  return [int(v) for v in csv.split(',') if v]
+
+
+def synthetic_example(rng, label):
+  """A serialized random face record with valid feature points."""
+  image = rng.randint(0, 256, (util.FACE_SIZE, util.FACE_SIZE, 3))
+  points = rng.randint(40, util.FACE_SIZE - 40, (13, 2))
+  return face_runtime.face_example(
+      image.astype(np.uint8).tobytes(), points.astype(np.int64).tobytes(),
+      label, 'label_%d' % label)
+
+
+def write_synthetic_shards(directory, num_shards, records_per_shard, seed=0):
+  """Write synthetic face record shards; returns their file pattern."""
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  rng = np.random.RandomState(seed)
+  for s in range(num_shards):
+    path = os.path.join(directory, 'train-%05d-of-%05d' % (s, num_shards))
+    if os.path.exists(path):
+      continue
+    writer = tf.python_io.TFRecordWriter(path)
+    for _ in range(records_per_shard):
+      writer.write(synthetic_example(rng, rng.randint(600)))
+    writer.close()
+  return os.path.join(directory, '*[0-9]')
+
+
+def time_op(sess, op, examples_per_run, feed_dict=None, steps=None,
+            warmup=None):
+  """Run op repeatedly and time it.
+
+  Returns:
+    dict with examples_per_sec and step latency percentiles in ms.
+  """
+  steps = steps or FLAGS.bench_steps
+  warmup = FLAGS.bench_warmup_steps if warmup is None else warmup
+  for _ in range(warmup):
+    sess.run(op, feed_dict)
+  durations = []
+  for _ in range(steps):
+    start = time.time()
+    sess.run(op, feed_dict)
+    durations.append(time.time() - start)
+  durations = np.array(durations)
+  return {'examples_per_sec': examples_per_run * steps / durations.sum(),
+          'step_ms_mean': 1000. * durations.mean(),
+          'step_ms_p50': 1000. * np.percentile(durations, 50),
+          'step_ms_p90': 1000. * np.percentile(durations, 90)}
+
+
+def _session():
+  return tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+
+
+def _sample_arrays(batch_size, seed=0):
+  """In-memory serialized records, images and points of one batch."""
+  rng = np.random.RandomState(seed)
+  serialized = [synthetic_example(rng, i) for i in range(batch_size)]
+  images = rng.randint(0, 256, (batch_size, util.FACE_SIZE, util.FACE_SIZE,
+                                3)).astype(np.uint8)
+  points = rng.randint(40, util.FACE_SIZE - 40, (batch_size, 13, 2))
+  return serialized, images, points.astype(np.int32)
+
+
+def bench_read(pattern, batch_size):
+  with tf.Graph().as_default():
+    files = tf.data.Dataset.list_files(pattern).repeat()
+    records = files.interleave(tf.data.TFRecordDataset, cycle_length=4)
+    op = records.batch(batch_size).make_one_shot_iterator().get_next()
+    with _session() as sess:
+      yield 'read', {}, time_op(sess, op, batch_size)
+
+
+def bench_parse(batch_size):
+  serialized, _, _ = _sample_arrays(batch_size)
+  with tf.Graph().as_default():
+    records = tf.constant(serialized)
+    single = tf.map_fn(image_processing.parse_example_proto, records,
+                       dtype=(tf.string, tf.int64, tf.string, tf.string))
+    batched = image_processing._parse_example_batch(records)
+    with _session() as sess:
+      yield 'parse', {'variant': 'per_example'}, time_op(
+          sess, single, batch_size)
+      yield 'parse', {'variant': 'batch_with_decode'}, time_op(
+          sess, batched, batch_size)
+
+
+def bench_decode(batch_size):
+  serialized, _, _ = _sample_arrays(batch_size)
+  with tf.Graph().as_default():
+    image_buffer, _, points, _ = image_processing.parse_example_proto(
+        tf.constant(serialized[0]))
+    data = tf.Variable(image_buffer, trainable=False)
+    raw_points = tf.Variable(points, trainable=False)
+    image = tf.reshape(tf.decode_raw(data, tf.uint8), [230, 230, 3])
+    image = tf.image.convert_image_dtype(image, tf.float32)
+    points = tf.reshape(tf.decode_raw(raw_points, tf.int64), [13, 2])
+    with _session() as sess:
+      sess.run(tf.global_variables_initializer())
+      yield 'decode', {}, time_op(sess, [image, points], 1)
+
+
+def _image_inputs(batch_size):
+  _, images, points = _sample_arrays(batch_size)
+  images = tf.Variable(images, trainable=False)
+  points = tf.Variable(points, trainable=False)
+  return tf.image.convert_image_dtype(images, tf.float32), points
+
+
+# Per-example baselines: the preprocessing batch_inputs ran on every example
+# before flip, color and crop moved to the batch level.
+
+
+def _flip_one(image, points):
+  """Randomly mirror one image and its points."""
+  flip = tf.random_uniform([]) < 0.5
+  width = tf.shape(image)[1]
+  x, y = tf.unstack(points, axis=1)
+  flipped = tf.stack([width - 1 - x, y], axis=1)
+  return (tf.cond(flip, lambda: tf.image.flip_left_right(image),
+                  lambda: image),
+          tf.cond(flip, lambda: flipped, lambda: points))
+
+
+def _distort_color_one(image):
+  """Random brightness, saturation, hue and contrast of one image."""
+  image = tf.image.random_brightness(image, max_delta=32. / 255.)
+  image = tf.image.random_saturation(image, lower=0.5, upper=1.5)
+  image = tf.image.random_hue(image, max_delta=0.2)
+  image = tf.image.random_contrast(image, lower=0.5, upper=1.5)
+  return tf.clip_by_value(image, 0.0, 1.0)
+
+
+def _crop_one(image, point, train):
+  """Cut the window around one point, padding the image per point."""
+  c = 39 if train else 29
+  image = tf.pad(image, [[c, c + 1], [c, c + 1], [0, 0]])
+  image = tf.image.crop_to_bounding_box(image, point[1], point[0],
+                                        c * 2 + 1, c * 2 + 1)
+  if train:
+    begin, size, _ = tf.image.sample_distorted_bounding_box(
+        tf.shape(image), bounding_boxes=[[[0.0, 0.0, 1.0, 1.0]]],
+        area_range=[0.75, 1.0], aspect_ratio_range=[1.0, 1.0])
+    image = tf.slice(image, begin, size)
+  image = tf.image.resize_images(image, [30, 30])
+  image.set_shape([30, 30, 3])
+  return image
+
+
+def _extract_one(image, points, train):
+  """The 13 point windows of one image, one crop at a time."""
+  return tf.stack([_crop_one(image, point, train)
+                   for point in tf.unstack(points, axis=0)])
+
+
+def bench_flip(batch_size):
+  with tf.Graph().as_default():
+    images, points = _image_inputs(batch_size)
+    single = tf.map_fn(lambda e: _flip_one(e[0], e[1]), (images, points),
+                       dtype=(tf.float32, tf.int32))
+    batched = image_processing.random_flip_batch(images, points)
+    with _session() as sess:
+      sess.run(tf.global_variables_initializer())
+      yield 'flip', {'variant': 'per_example'}, time_op(
+          sess, single, batch_size)
+      yield 'flip', {'variant': 'batch'}, time_op(sess, batched, batch_size)
+
+
+def bench_color(batch_size):
+  with tf.Graph().as_default():
+    images, points = _image_inputs(batch_size)
+    patches = image_processing.extract_feature_points_batch(images, points,
+                                                            False)
+    patches = tf.Variable(patches, trainable=False)
+    single = tf.map_fn(_distort_color_one, images)
+    batched = image_processing.distort_color_batch(patches)
+    with _session() as sess:
+      sess.run(tf.global_variables_initializer())
+      yield 'color', {'variant': 'per_example_full_image'}, time_op(
+          sess, single, batch_size)
+      yield 'color', {'variant': 'batch_patches'}, time_op(
+          sess, batched, batch_size)
+
+
+def bench_crop(batch_size):
+  with tf.Graph().as_default():
+    images, points = _image_inputs(batch_size)
+    single = tf.map_fn(lambda e: _extract_one(e[0], e[1], True),
+                       (images, points), dtype=tf.float32)
+    batched = image_processing.extract_feature_points_batch(images, points,
+                                                            True)
+    with _session() as sess:
+      sess.run(tf.global_variables_initializer())
+      yield 'crop', {'variant': 'per_example'}, time_op(
+          sess, single, batch_size)
+      yield 'crop', {'variant': 'batch'}, time_op(sess, batched, batch_size)
+
+
+def bench_model(batch_size):
+  size = FLAGS.image_size
+  for mode in ('towers', 'grouped', 'folded'):
+    with tf.Graph().as_default():
+      patches = tf.random_uniform([batch_size, 13, size, size, 3], -1., 1.)
+      patches = tf.Variable(patches, trainable=False)
+      logits = model.model(patches, batch_size, train=False, mode=mode)
+      with _session() as sess:
+        sess.run(tf.global_variables_initializer())
+        yield 'model', {'mode': mode}, time_op(sess, logits, batch_size)
+
+
+def bench_batch_inputs(batch_size, num_readers, num_preprocess_threads):
+  with tf.Graph().as_default():
+    images, labels = image_processing.batch_inputs(
+        None, batch_size, train=True,
+        num_preprocess_threads=num_preprocess_threads,
+        num_readers=num_readers)
+    with _session() as sess:
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+      try:
+        yield 'batch_inputs', {}, time_op(sess, [images, labels], batch_size)
+      finally:
+        coord.request_stop()
+        coord.join(threads, stop_grace_period_secs=5)
+
+
+def bench_dataset(batch_size, num_readers):
+  with tf.Graph().as_default():
+    images, labels = image_processing.dataset_inputs(
+        None, batch_size, train=True, num_readers=num_readers)
+    with _session() as sess:
+      yield 'dataset', {}, time_op(sess, [images, labels], batch_size)
+
+
+def run(stages, pattern):
+  """Yield (stage, config, result) for every measurement."""
+  for batch_size in _ints(FLAGS.bench_batch_sizes):
+    config = {'batch_size': batch_size}
+    isolated = [('read', lambda: bench_read(pattern, batch_size)),
+                ('parse', lambda: bench_parse(batch_size)),
+                ('decode', lambda: bench_decode(batch_size)),
+                ('flip', lambda: bench_flip(batch_size)),
+                ('color', lambda: bench_color(batch_size)),
+                ('crop', lambda: bench_crop(batch_size)),
+                ('model', lambda: bench_model(batch_size))]
+    for stage, bench in isolated:
+      if stage in stages:
+        for name, extra, result in bench():
+          yield name, dict(config, **extra), result
+
+    for num_readers in _ints(FLAGS.bench_num_readers):
+      if 'dataset' in stages:
+        for name, extra, result in bench_dataset(batch_size, num_readers):
+          yield name, dict(config, num_readers=num_readers), result
+      if 'batch_inputs' not in stages:
+        continue
+      for threads in _ints(FLAGS.bench_preprocess_threads):
+        for name, extra, result in bench_batch_inputs(batch_size, num_readers,
+                                                      threads):
+          yield name, dict(config, num_readers=num_readers,
+                           num_preprocess_threads=threads), result
+
+
+def main(unused_argv):
+  stages = STAGES if FLAGS.bench_stages == 'all' else \
+      FLAGS.bench_stages.split(',')
+  pattern = write_synthetic_shards(FLAGS.bench_dir, FLAGS.bench_shards,
+                                   FLAGS.bench_records_per_shard)
+  # The end-to-end pipelines read the synthetic shards. Their shuffle holds
+  # 1024 * input_queue_memory_factor records; the default of 16 would queue
+  # far more records than the synthetic set has.
+  image_processing.DATA_FILES['image'] = pattern
+  num_records = FLAGS.bench_shards * FLAGS.bench_records_per_shard
+  FLAGS.input_queue_memory_factor = max(1, min(
+      FLAGS.input_queue_memory_factor, num_records // 1024))
+
+  host = {'host': platform.node(), 'cpus': os.cpu_count(),
+          'tensorflow': tf.__version__, 'time': time.time(),
+          'input_queue_memory_factor': FLAGS.input_queue_memory_factor}
+  with open(FLAGS.bench_output, 'a') as f:
+    for stage, config, result in run(stages, pattern):
+      line = dict(host, stage=stage, config=config, **result)
+      f.write(json.dumps(line, sort_keys=True) + '\n')
+      f.flush()
+      print('%-12s %-60s %10.1f examples/sec %8.2f ms/step' % (
+          stage, json.dumps(config, sort_keys=True),
+          result['examples_per_sec'], result['step_ms_mean']))
+
+
+if __name__ == '__main__':
+  tf.app.run()
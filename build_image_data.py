@@ -0,0 +1,223 @@
+"""Converts raw face photos to aligned TFRecord shards.
+
+ The photos are expected to reside in one sub-directory per identity
+
+   data_dir/Aaron_Eckhart/0092e416edbceb4f0171a58fc2e1c6e5a3565027.jpg
+   data_dir/Adam_Brody/059e2ef3a42a6a00a0c26e23fee2373f60e2e850.jpg
+   ...
+
+ where the sub-directory names are listed, one per line, in the labels file.
+ The line number of a name is its integer label.
+
+ Every photo goes through dlib face detection, the 68-point shape predictor,
+ `util.procrustes` alignment against the base face and the fused
+ `util.transform` warp. With --landmark_cache set, landmarks are looked up
+ in a `landmark_cache.LandmarkCache` before running dlib. This work is spread
+ over a process pool that holds one dlib predictor per worker. The parent
+ process streams the results round-robin into the output shards, each a
+ TFRecord file of Example protos with the fields read by
+ `image_processing.parse_example_proto`:
+
+   image/data: 230*230*3 raw uint8 bytes of the aligned face
+   image/points: 13*2 raw int64 bytes, (x, y) of util.FEATURE_POINTS
+   image/class/label: integer label, line number in the labels file
+   image/class/text: string label, e.g. 'Aaron_Eckhart'
+
+ The records are encoded and framed by `face_runtime`, so neither this script
+ nor its workers import TensorFlow.
+
+ Usage:
+   python build_image_data.py --data_dir=./faces --output_directory=./train
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+from absl import app
+from absl import flags
+
+import face_runtime
+import landmark_cache
+
+flags.DEFINE_string('data_dir', './faces',
+                    """Directory with one sub-directory per label.""")
+flags.DEFINE_string('output_directory', './train',
+                    """Output data directory.""")
+flags.DEFINE_string('labels_file', './labels',
+                    """Labels file, one label name per line.""")
+flags.DEFINE_string('predictor_path',
+                    './data/shape_predictor_68_face_landmarks.dat',
+                    """dlib 68-point shape predictor model.""")
+flags.DEFINE_string('base_face', './data/base_face.jpg',
+                    """Reference face every photo is aligned to.""")
+flags.DEFINE_string('name', 'train',
+                    """Prefix of the output shard names.""")
+flags.DEFINE_integer('shards', 16,
+                     """Number of output shards.""")
+flags.DEFINE_integer('num_workers', 0,
+                     """Number of worker processes, 0 for one per """
+                     """core.""")
+flags.DEFINE_integer('chunk_size', 32,
+                     """Number of photos aligned per worker task.""")
+flags.DEFINE_integer('upsample', 1,
+                     """Times dlib upsamples the photo for detection.""")
+flags.DEFINE_string('landmark_cache', '',
+                    """Directory of the landmark cache, so dlib runs """
+                    """only once per photo. Empty to disable.""")
+
+FLAGS = flags.FLAGS
+
+# Per-worker dlib models, set up once by _init_worker.
+_detector = None
+_predictor = None
+_base_shape = None
+_upsample = 1
+_cache = None
+
+
+# Landmark and alignment helpers live in the TensorFlow-free runtime that
+# workers can import alone.
+shape_to_array = face_runtime.shape_to_array
+_detect_landmarks = face_runtime.detect_landmarks
+load_base_shape = face_runtime.load_base_shape
+_find_image_files = face_runtime.find_image_files
+align_faces = face_runtime.align_faces
+
+
+def _init_worker(predictor_path, base_shape, upsample, cache_dir):
+  global _detector, _predictor, _base_shape, _upsample, _cache
+  import dlib
+  _detector = dlib.get_frontal_face_detector()
+  _predictor = dlib.shape_predictor(predictor_path)
+  _base_shape = base_shape
+  _upsample = upsample
+  if cache_dir:
+    _cache = landmark_cache.LandmarkCache(cache_dir, predictor_path)
+
+
+def _process_chunk(chunk):
+  """Align one chunk of (filename, label, text) in a worker.
+
+  Returns:
+    list of (image bytes, points bytes, label, text, filename) for the photos
+    with a detected face, and the number of photos that were skipped.
+  """
+  from skimage import io
+  images, shapes, meta = [], [], []
+  skipped = 0
+  for filename, label, text in chunk:
+    entry = key = None
+    if _cache is not None:
+      with open(filename, 'rb') as f:
+        key = landmark_cache.digest(f.read())
+      entry = _cache.get_digest(key)
+      if entry is not None and entry[1] is None:
+        # dlib found no face last time.
+        skipped += 1
+        continue
+    try:
+      img = io.imread(filename)
+    except (IOError, ValueError) as e:
+      print('Skipping unreadable %s: %s' % (filename, e), file=sys.stderr)
+      skipped += 1
+      continue
+    if img.ndim != 3 or img.shape[2] != 3:
+      skipped += 1
+      continue
+    if entry is None:
+      box, shape = _detect_landmarks(img, _detector, _predictor, _upsample)
+      if _cache is not None:
+        _cache.put_digest(key, box, shape)
+    else:
+      box, shape = entry
+    if shape is None:
+      skipped += 1
+      continue
+    images.append(img)
+    shapes.append(shape)
+    meta.append((label, text, filename))
+  if not images:
+    return [], skipped
+
+  faces, points = align_faces(images, np.stack(shapes), _base_shape)
+  results = [(faces[i].tobytes(), points[i].tobytes(), label, text, filename)
+             for i, (label, text, filename) in enumerate(meta)]
+  return results, skipped
+
+
+def _chunks(seq, size):
+  for i in range(0, len(seq), size):
+    yield seq[i:i + size]
+
+
+def build(files, output_directory, name, num_shards, num_workers,
+          chunk_size, predictor_path, base_shape, upsample=1,
+          cache_dir=None):
+  """Align files in a process pool and write them to sharded TFRecords.
+
+  Returns:
+    number of examples written.
+  """
+  if not os.path.isdir(output_directory):
+    os.makedirs(output_directory)
+  writers = [face_runtime.TFRecordFile(
+                 os.path.join(output_directory,
+                              '%s-%05d-of-%05d' % (name, s, num_shards)))
+             for s in range(num_shards)]
+  num_workers = num_workers or multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(num_workers, _init_worker,
+                              (predictor_path, base_shape, upsample,
+                               cache_dir))
+  written = skipped = 0
+  start = last_report = time.time()
+  try:
+    for results, chunk_skipped in pool.imap_unordered(
+        _process_chunk, _chunks(files, chunk_size)):
+      skipped += chunk_skipped
+      for image_data, points, label, text, _ in results:
+        writers[written % num_shards].write(
+            face_runtime.face_example(image_data, points, label, text))
+        written += 1
+      now = time.time()
+      if now - last_report > 10:
+        last_report = now
+        print('%d written, %d skipped of %d, %.1f images/sec on %d workers' %
+              (written, skipped, len(files),
+               (written + skipped) / (now - start), num_workers))
+        sys.stdout.flush()
+  finally:
+    pool.close()
+    pool.join()
+    for writer in writers:
+      writer.close()
+
+  duration = time.time() - start
+  print('Wrote %d examples to %d shards (%d skipped) in %.1f sec, '
+        '%.1f images/sec.' % (written, num_shards, skipped, duration,
+                              len(files) / max(duration, 1e-6)))
+  return written
+
+
+def main(unused_argv):
+  import dlib
+  detector = dlib.get_frontal_face_detector()
+  predictor = dlib.shape_predictor(FLAGS.predictor_path)
+  base_shape = load_base_shape(detector, predictor, FLAGS.base_face,
+                               FLAGS.upsample)
+
+  files = _find_image_files(FLAGS.data_dir, FLAGS.labels_file)
+  # Spread the labels evenly over the shards.
+  np.random.RandomState(12345).shuffle(files)
+  build(files, FLAGS.output_directory, FLAGS.name, FLAGS.shards,
+        FLAGS.num_workers, FLAGS.chunk_size, FLAGS.predictor_path,
+        base_shape, FLAGS.upsample, FLAGS.landmark_cache)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,121 @@
+"""Computes the color statistics of the training set.
+
+ One streaming pass over the face record shards accumulates, per shard on a
+ process pool, the pixel count, per-channel mean and 3x3 co-moment matrix of
+ the pixels in [0, 1], merged batch by batch with the pairwise update of Chan
+ et al. in float64, so that no sum of squares is ever formed. The result is
+ saved to --color_stats as an .npz artifact with
+
+   count       number of pixels
+   mean        (3,) per-channel mean
+   std         (3,) per-channel standard deviation
+   covariance  (3, 3) channel covariance
+   zca         (3, 3) ZCA whitening matrix, U diag(1/sqrt(S + eps)) U^T
+
+ which `image_processing` applies to every batch when
+ --color_standardization is 'channel' or 'zca'.
+
+ Usage:
+   python color_stats.py --stats_pattern='./train/*[0-9]' \
+       --color_stats=./color_stats.npz
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+import record_index
+import util
+
+tf.app.flags.DEFINE_string('stats_pattern',
+                           image_processing.DATA_FILES['image'],
+                           """Face record shards to compute the """
+                           """statistics of.""")
+tf.app.flags.DEFINE_float('zca_epsilon', 1e-3,
+                          """Regularization of the ZCA eigenvalues.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class ColorMoments(object):
+  """Running count, mean and co-moment of 3-channel pixels."""
+
+  def __init__(self):
+    self.count = 0
+    self.mean = np.zeros(3)
+    self.comoment = np.zeros((3, 3))
+
+  def merge(self, count, mean, comoment):
+    """Fold in the moments of another set of pixels."""
+    if not count:
+      return
+    total = self.count + count
+    delta = mean - self.mean
+    self.mean = self.mean + delta * (count / total)
+    self.comoment = (self.comoment + comoment +
+                     np.outer(delta, delta) * (self.count * count / total))
+    self.count = total
+
+  def update(self, pixels):
+    """Fold in an (n, 3) array of pixels."""
+    pixels = np.asarray(pixels, dtype=np.float64)
+    mean = pixels.mean(0)
+    centered = pixels - mean
+    self.merge(len(pixels), mean, centered.T.dot(centered))
+
+  def covariance(self):
+    return self.comoment / max(self.count - 1, 1)
+
+
+def shard_moments(path):
+  """(count, mean, comoment) of the pixels of one face record shard."""
+  moments = ColorMoments()
+  for record in tf.python_io.tf_record_iterator(path):
+    feature = tf.train.Example.FromString(record).features.feature
+    image = np.frombuffer(feature['image/data'].bytes_list.value[0],
+                          dtype=np.uint8)
+    moments.update(image.reshape(-1, 3) / 255.)
+  return moments.count, moments.mean, moments.comoment
+
+
+def color_statistics(moments, epsilon):
+  """The artifact arrays of merged moments."""
+  covariance = moments.covariance()
+  eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+  zca = eigenvectors.dot(np.diag(1. / np.sqrt(eigenvalues + epsilon))).dot(
+      eigenvectors.T)
+  return {'count': moments.count, 'mean': moments.mean,
+          'std': np.sqrt(np.diag(covariance)), 'covariance': covariance,
+          'zca': zca}
+
+
+def main(unused_argv):
+  shards = record_index.shard_files(FLAGS.stats_pattern)
+  if not shards:
+    raise ValueError('No shards match %s' % FLAGS.stats_pattern)
+  start = time.time()
+  moments = ColorMoments()
+  pool = multiprocessing.Pool()
+  try:
+    for partial in pool.imap_unordered(shard_moments, shards):
+      moments.merge(*partial)
+  finally:
+    pool.close()
+    pool.join()
+  stats = color_statistics(moments, FLAGS.zca_epsilon)
+  np.savez(FLAGS.color_stats, **stats)
+  print('%d faces, %d pixels in %.1f sec.' % (
+      moments.count // (util.FACE_SIZE * util.FACE_SIZE), moments.count,
+      time.time() - start))
+  print('mean %s std %s' % (np.round(stats['mean'], 4),
+                            np.round(stats['std'], 4)))
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,483 @@
+"""Incremental, deduplicating updates of the aligned face data set.
+
+ Instead of rebuilding every shard, the data set directory is grown by
+ appending new shards. A manifest records, for every record,
+
+   digest   sha1 of the photo file the record was aligned from
+   dhash    64-bit difference hash of the aligned face
+   shard    shard the record is in
+   offset, length   position of the record's data in the shard
+   label    integer label
+
+ Commands:
+
+   add      hash the photos under --data_dir and align only those whose
+            digest is not in the manifest yet, drop the aligned faces within
+            --near_duplicate_bits of an existing face's dhash, and write the
+            rest to new shards of at most --records_per_shard records. Starts
+            a background compaction when small shards pile up. The first
+            add to a directory built by build_image_data.py adopts its
+            shards.
+   compact  merge the shards smaller than --compact_fraction of
+            --records_per_shard into full ones.
+   status   print the record, shard and small shard counts.
+
+ Manifests are generations, manifest-NNNNNN.npz, and the MANIFEST file names
+ the current one. Shards and their record_index sidecars are written under
+ temporary names and renamed into place, then the new manifest is written,
+ and MANIFEST is replaced with an atomic rename, so readers always see a
+ complete generation. `record_index.shard_files`, which all readers list
+ shards with, only returns the shards of the current generation. Shards only
+ referenced by generations before the previous one are deleted. Writers
+ serialize on a lock file.
+
+ Usage:
+   python dataset_manager.py add --data_dir=./new --output_directory=./train
+   python dataset_manager.py compact --output_directory=./train
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fcntl
+import glob
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import build_image_data
+import face_runtime
+import landmark_cache
+import record_index
+import util
+
+tf.app.flags.DEFINE_integer('records_per_shard', 1024,
+                            """Records per shard written by add and """
+                            """compact.""")
+tf.app.flags.DEFINE_integer('near_duplicate_bits', 4,
+                            """Largest dhash Hamming distance of a near """
+                            """duplicate, -1 to keep them.""")
+tf.app.flags.DEFINE_float('compact_fraction', 0.5,
+                          """Shards below this fraction of """
+                          """records_per_shard are compacted.""")
+tf.app.flags.DEFINE_boolean('background_compaction', True,
+                            """Let add start a compaction in the background """
+                            """when small shards pile up.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+ENTRY_DTYPE = np.dtype([('digest', 'V20'), ('dhash', '<u8'), ('shard', '<i4'),
+                        ('label', '<i4'), ('offset', '<u8'), ('length', '<u8')])
+
+CURRENT = record_index.MANIFEST
+LOCK = 'LOCK'
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(face):
+  """64-bit difference hash of an aligned (H, W, 3) uint8 face.
+
+  The face is averaged down to 8x9 gray blocks and every bit tells whether a
+  block is brighter than its right neighbour, which survives recompression,
+  rescaling and small color changes.
+  """
+  gray = face.astype(np.float32).mean(2)
+  rows = np.linspace(0, gray.shape[0], 9).astype(int)[:-1]
+  cols = np.linspace(0, gray.shape[1], 10).astype(int)[:-1]
+  blocks = np.add.reduceat(np.add.reduceat(gray, rows, 0), cols, 1)
+  sizes = np.outer(np.diff(np.append(rows, gray.shape[0])),
+                   np.diff(np.append(cols, gray.shape[1])))
+  blocks /= sizes
+  bits = (blocks[:, 1:] > blocks[:, :-1]).ravel()
+  return np.uint64(int(np.packbits(bits).view('>u8')[0]))
+
+
+def hamming(hashes, h):
+  """Hamming distances of an array of uint64 hashes to h."""
+  x = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(h))
+  return _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(1)
+
+
+class NearDuplicateIndex(object):
+  """Finds the hashes within max_bits of a query.
+
+  The 64 bits are cut into max_bits + 1 bands; two hashes at most max_bits
+  apart agree on at least one band, so only the hashes sharing a band value
+  with the query, looked up in one sorted array per band, are compared.
+  """
+
+  def __init__(self, hashes, max_bits):
+    self.max_bits = max_bits
+    self._bands = []
+    bands = max_bits + 1
+    edges = np.linspace(0, 64, bands + 1).astype(int)
+    self._masks = [(int(lo), int(hi)) for lo, hi in zip(edges, edges[1:])]
+    self._hashes = np.asarray(hashes, dtype=np.uint64)
+    for lo, hi in self._masks:
+      keys = self._band(self._hashes, lo, hi)
+      order = np.argsort(keys, kind='stable')
+      self._bands.append((keys[order], order))
+    self._added = []
+
+  @staticmethod
+  def _band(hashes, lo, hi):
+    mask = np.uint64((1 << (hi - lo)) - 1)
+    return np.bitwise_and(np.right_shift(hashes, np.uint64(lo)), mask)
+
+  def contains(self, h):
+    """Whether a hash within max_bits of h was indexed or added."""
+    h = np.asarray([h], dtype=np.uint64)
+    for (lo, hi), (keys, order) in zip(self._masks, self._bands):
+      key = self._band(h, lo, hi)[0]
+      start, end = np.searchsorted(keys, [key, key + np.uint64(1)])
+      if end > start and hamming(self._hashes[order[start:end]],
+                                 h[0]).min() <= self.max_bits:
+        return True
+    return bool(self._added) and hamming(self._added,
+                                         h[0]).min() <= self.max_bits
+
+  def add(self, h):
+    self._added.append(h)
+
+
+class Manifest(object):
+  """One generation of the data set."""
+
+  def __init__(self, generation=0, shards=(), entries=None):
+    self.generation = generation
+    self.shards = list(shards)
+    self.entries = (np.zeros(0, dtype=ENTRY_DTYPE) if entries is None
+                    else entries)
+
+  def shard_sizes(self):
+    return np.bincount(self.entries['shard'], minlength=len(self.shards))
+
+
+def _manifest_name(generation):
+  return 'manifest-%06d.npz' % generation
+
+
+def load_manifest(directory):
+  """The current Manifest of a data set directory, empty if there is none."""
+  try:
+    with open(os.path.join(directory, CURRENT)) as f:
+      name = f.read().strip()
+  except IOError:
+    return Manifest()
+  with np.load(os.path.join(directory, name)) as data:
+    return Manifest(int(data['generation']), data['shards'].tolist(),
+                    data['entries'])
+
+
+def _atomic_write(path, write):
+  tmp = '%s.tmp%d' % (path, os.getpid())
+  with open(tmp, 'wb') as f:
+    write(f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(tmp, path)
+
+
+def commit_manifest(directory, manifest):
+  """Write manifest as the next generation and make it current."""
+  manifest.generation += 1
+  name = _manifest_name(manifest.generation)
+  _atomic_write(os.path.join(directory, name), lambda f: np.savez(
+      f, generation=manifest.generation,
+      shards=np.array(manifest.shards, dtype=str), entries=manifest.entries))
+  _atomic_write(os.path.join(directory, CURRENT),
+                lambda f: f.write(name.encode('utf-8') + b'\n'))
+  _collect_garbage(directory, manifest.generation)
+
+
+def _collect_garbage(directory, generation):
+  # Readers may still hold the previous generation; older ones go, with the
+  # shards only they referenced.
+  def shards(g):
+    with np.load(os.path.join(directory, _manifest_name(g))) as data:
+      return set(data['shards'].tolist())
+
+  keep = shards(generation)
+  if os.path.exists(os.path.join(directory, _manifest_name(generation - 1))):
+    keep |= shards(generation - 1)
+  for path in glob.glob(os.path.join(directory, 'manifest-*.npz')):
+    g = int(path[-10:-4])
+    if g >= generation - 1:
+      continue
+    for shard in shards(g) - keep:
+      shard = os.path.join(directory, shard)
+      for f in (shard, record_index.index_path(shard)):
+        if os.path.exists(f):
+          os.remove(f)
+    os.remove(path)
+
+
+class _Lock(object):
+  """Exclusive lock of a data set directory, for writers."""
+
+  def __init__(self, directory):
+    self._file = open(os.path.join(directory, LOCK), 'a')
+
+  def __enter__(self):
+    fcntl.flock(self._file, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *args):
+    fcntl.flock(self._file, fcntl.LOCK_UN)
+    self._file.close()
+
+
+class ShardWriter(object):
+  """Writes records to new shards of at most records_per_shard records."""
+
+  def __init__(self, directory, name, generation, records_per_shard):
+    self._directory = directory
+    self._prefix = '%s-%06d-' % (name, generation)
+    self._records_per_shard = records_per_shard
+    self._writer = None
+    self._count = 0
+    self.shards = []
+
+  def write(self, record):
+    """Write one serialized record; returns (shard number, record number)."""
+    if self._writer is None or self._count == self._records_per_shard:
+      self._close_shard()
+      self.shards.append('%s%05d' % (self._prefix, len(self.shards)))
+      self._writer = tf.python_io.TFRecordWriter(self._tmp(self.shards[-1]))
+      self._count = 0
+    self._writer.write(record)
+    self._count += 1
+    return len(self.shards) - 1, self._count - 1
+
+  def _tmp(self, shard):
+    return os.path.join(self._directory, shard + '.tmp')
+
+  def _close_shard(self):
+    if self._writer is not None:
+      self._writer.close()
+      self._writer = None
+
+  def close(self):
+    """Move the shards into place; returns their record offset indexes."""
+    self._close_shard()
+    indexes = []
+    for shard in self.shards:
+      path = os.path.join(self._directory, shard)
+      os.rename(self._tmp(shard), path)
+      indexes.append(record_index.build_index(path))
+    return indexes
+
+
+def _file_digest(filename):
+  with open(filename, 'rb') as f:
+    return landmark_cache.digest(f.read())
+
+
+def _locate(entries, positions, indexes, first_shard):
+  """Set the shard, offset and length of entries from ShardWriter positions."""
+  if not len(entries):
+    return
+  shards = np.array([s for s, _ in positions], dtype=np.int32)
+  located = np.array([indexes[s][r] for s, r in positions], dtype=np.uint64)
+  entries['shard'] = first_shard + shards
+  entries['offset'] = located[:, 0]
+  entries['length'] = located[:, 1]
+
+
+def adopt(directory):
+  """Manifest of shards written by build_image_data, before any add.
+
+  The photos those records came from are unknown, so their digest is the
+  sha1 of the aligned face instead.
+  """
+  manifest = Manifest()
+  for path in record_index.shard_files(os.path.join(directory, '*[0-9]')):
+    shard = len(manifest.shards)
+    manifest.shards.append(os.path.basename(path))
+    index = record_index.load_index(path)
+    entries = np.zeros(len(index), dtype=ENTRY_DTYPE)
+    for i, record in enumerate(tf.python_io.tf_record_iterator(path)):
+      feature = tf.train.Example.FromString(record).features.feature
+      image_data = feature['image/data'].bytes_list.value[0]
+      entries[i]['digest'] = landmark_cache.digest(image_data)
+      entries[i]['dhash'] = dhash(np.frombuffer(image_data, np.uint8).reshape(
+          util.FACE_SIZE, util.FACE_SIZE, 3))
+      entries[i]['label'] = feature['image/class/label'].int64_list.value[0]
+    entries['shard'] = shard
+    entries['offset'] = index[:, 0]
+    entries['length'] = index[:, 1]
+    manifest.entries = np.concatenate([manifest.entries, entries])
+  return manifest
+
+
+def add(directory, files, predictor_path, base_shape):
+  """Align and append the photos of files that are not in the data set yet.
+
+  Returns:
+    number of records added.
+  """
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  with _Lock(directory):
+    manifest = load_manifest(directory)
+    if not manifest.generation and record_index.shard_files(
+        os.path.join(directory, '*[0-9]')):
+      manifest = adopt(directory)
+    known = set(manifest.entries['digest'].tolist())
+    pool = multiprocessing.Pool(FLAGS.num_workers or None)
+    try:
+      digests = pool.map(_file_digest, [f[0] for f in files], chunksize=64)
+    finally:
+      pool.close()
+      pool.join()
+    new_files, digest_of = [], {}
+    for f, d in zip(files, digests):
+      if d not in known:
+        known.add(d)
+        new_files.append(f)
+        digest_of[f[0]] = d
+    print('%d of %d photos are new.' % (len(new_files), len(files)))
+
+    near = NearDuplicateIndex(manifest.entries['dhash'],
+                              FLAGS.near_duplicate_bits)
+    writer = ShardWriter(directory, FLAGS.name, manifest.generation + 1,
+                         FLAGS.records_per_shard)
+    entries, positions = [], []
+    near_duplicates = skipped = 0
+    pool = multiprocessing.Pool(FLAGS.num_workers or None,
+                                build_image_data._init_worker,
+                                (predictor_path, base_shape, FLAGS.upsample,
+                                 FLAGS.landmark_cache))
+    try:
+      for results, chunk_skipped in pool.imap(
+          build_image_data._process_chunk,
+          build_image_data._chunks(new_files, FLAGS.chunk_size)):
+        skipped += chunk_skipped
+        for image_data, points, label, text, filename in results:
+          face = np.frombuffer(image_data, dtype=np.uint8).reshape(
+              util.FACE_SIZE, util.FACE_SIZE, 3)
+          h = dhash(face)
+          if FLAGS.near_duplicate_bits >= 0 and near.contains(h):
+            near_duplicates += 1
+            continue
+          near.add(h)
+          positions.append(writer.write(face_runtime.face_example(
+              image_data, points, label, text)))
+          entries.append((digest_of[filename], h, 0, label, 0, 0))
+    finally:
+      pool.close()
+      pool.join()
+      indexes = writer.close()
+
+    new_entries = np.array(entries, dtype=ENTRY_DTYPE)
+    _locate(new_entries, positions, indexes, len(manifest.shards))
+    manifest.shards.extend(writer.shards)
+    manifest.entries = np.concatenate([manifest.entries, new_entries])
+    commit_manifest(directory, manifest)
+  print('Added %d records in %d shards, dropped %d near duplicates, '
+        'skipped %d photos.' % (len(new_entries), len(writer.shards),
+                                near_duplicates, skipped))
+  return len(new_entries)
+
+
+def _small_shards(manifest):
+  limit = FLAGS.compact_fraction * FLAGS.records_per_shard
+  return [i for i, n in enumerate(manifest.shard_sizes()) if n < limit]
+
+
+def compact(directory):
+  """Merge the small shards of the data set; returns the number merged."""
+  with _Lock(directory):
+    manifest = load_manifest(directory)
+    small = _small_shards(manifest)
+    if len(small) < 2:
+      return 0
+    moved = np.flatnonzero(np.isin(manifest.entries['shard'], small))
+    # Keep the records of a shard together and in order.
+    moved = moved[np.lexsort((manifest.entries['offset'][moved],
+                              manifest.entries['shard'][moved]))]
+    writer = ShardWriter(directory, FLAGS.name, manifest.generation + 1,
+                         FLAGS.records_per_shard)
+    positions = []
+    files = {}
+    try:
+      for i in moved:
+        entry = manifest.entries[i]
+        path = os.path.join(directory, manifest.shards[entry['shard']])
+        if path not in files:
+          files[path] = open(path, 'rb')
+        f = files[path]
+        f.seek(int(entry['offset']))
+        positions.append(writer.write(f.read(int(entry['length']))))
+    finally:
+      for f in files.values():
+        f.close()
+      indexes = writer.close()
+
+    # Renumber the shards: the kept ones first, then the merged ones.
+    small = set(small)
+    kept = [s for s in range(len(manifest.shards)) if s not in small]
+    renumber = np.full(len(manifest.shards), -1, dtype=np.int32)
+    renumber[kept] = np.arange(len(kept))
+    entries = manifest.entries.copy()
+    entries['shard'] = renumber[entries['shard']]
+    moved_entries = entries[moved]
+    _locate(moved_entries, positions, indexes, len(kept))
+    entries[moved] = moved_entries
+    manifest.shards = [manifest.shards[s] for s in kept] + writer.shards
+    manifest.entries = entries
+    commit_manifest(directory, manifest)
+  print('Compacted %d shards into %d.' % (len(small), len(writer.shards)))
+  return len(small)
+
+
+def _start_background_compaction(directory):
+  subprocess.Popen([sys.executable, os.path.abspath(__file__), 'compact',
+                    '--output_directory=%s' % directory,
+                    '--records_per_shard=%d' % FLAGS.records_per_shard,
+                    '--compact_fraction=%f' % FLAGS.compact_fraction,
+                    '--name=%s' % FLAGS.name],
+                   start_new_session=True)
+
+
+def status(directory):
+  manifest = load_manifest(directory)
+  print('generation %d: %d records, %d labels, %d shards, %d small' % (
+      manifest.generation, len(manifest.entries),
+      len(np.unique(manifest.entries['label'])), len(manifest.shards),
+      len(_small_shards(manifest))))
+
+
+def main(argv):
+  command = argv[1] if len(argv) > 1 else 'status'
+  directory = FLAGS.output_directory
+  start = time.time()
+  if command == 'add':
+    import dlib
+    detector = dlib.get_frontal_face_detector()
+    predictor = dlib.shape_predictor(FLAGS.predictor_path)
+    base_shape = build_image_data.load_base_shape(
+        detector, predictor, FLAGS.base_face, FLAGS.upsample)
+    files = build_image_data._find_image_files(FLAGS.data_dir,
+                                               FLAGS.labels_file)
+    add(directory, files, FLAGS.predictor_path, base_shape)
+    if (FLAGS.background_compaction and
+        len(_small_shards(load_manifest(directory))) > 1):
+      _start_background_compaction(directory)
+  elif command == 'compact':
+    compact(directory)
+  elif command == 'status':
+    status(directory)
+  else:
+    raise ValueError('Unknown command %r' % command)
+  print('Done in %.1f sec.' % (time.time() - start))
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,103 @@
+"""Exports face embeddings of every record to a memory-mapped matrix.
+
+ Runs a checkpoint of `model.model` over all records of --record_format, in
+ the deterministic order of `image_processing.ordered_inputs`, and writes
+
+   <embeddings>        (N, d) float16 .npy matrix, L2 normalized rows, opened
+                       with np.load(mmap_mode='r')
+   <embeddings>.keys   the '<shard>:<record number>' key of row i on line i
+   <embeddings>.labels (N,) int64 .npy labels
+
+ The embedding is either the 3120-d concatenated tower features
+ (--embedding=features) or the 600-d logits (--embedding=logits). The rows
+ are what `ann_index.py` indexes.
+
+ Usage:
+   python embed.py --checkpoint=./model.ckpt --embeddings=./gallery.npy
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+import model
+import record_index
+
+tf.app.flags.DEFINE_string('checkpoint', '',
+                           """Checkpoint of model.model to embed with.""")
+tf.app.flags.DEFINE_string('model_mode', 'grouped',
+                           """Tower construction, see model.model.""")
+tf.app.flags.DEFINE_string('embedding', 'features',
+                           """'features' or 'logits'.""")
+tf.app.flags.DEFINE_string('embeddings', './embeddings.npy',
+                           """Path of the embedding matrix.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def _count_records():
+  shards = record_index.shard_files(
+      image_processing.DATA_FILES[FLAGS.record_format])
+  return sum(len(record_index.load_index(s)) for s in shards)
+
+
+def export(checkpoint, path):
+  """Write the embeddings of every record to path; returns their number."""
+  num_records = _count_records()
+  with tf.Graph().as_default():
+    keys, images, labels = image_processing.ordered_inputs(
+        None, FLAGS.batch_size)
+    if FLAGS.embedding == 'features':
+      with tf.name_scope('model'):
+        embeddings = model.features(images, FLAGS.model_mode)
+    elif FLAGS.embedding == 'logits':
+      embeddings = model.model(images, FLAGS.batch_size, train=False,
+                               mode=FLAGS.model_mode)
+    else:
+      raise ValueError('Unknown embedding %r' % FLAGS.embedding)
+    embeddings = tf.nn.l2_normalize(embeddings, 1)
+    dim = embeddings.get_shape().as_list()[1]
+    saver = tf.train.Saver()
+
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float16,
+                                       shape=(num_records, dim))
+    all_labels = np.empty(num_records, dtype=np.int64)
+    row = 0
+    start = time.time()
+    with tf.Session() as sess, open(path + '.keys', 'w') as key_file:
+      saver.restore(sess, checkpoint)
+      while True:
+        try:
+          batch_keys, batch, batch_labels = sess.run([keys, embeddings,
+                                                      labels])
+        except tf.errors.OutOfRangeError:
+          break
+        matrix[row:row + len(batch)] = batch
+        all_labels[row:row + len(batch)] = batch_labels
+        key_file.writelines(k.decode('utf-8') + '\n' for k in batch_keys)
+        row += len(batch)
+    matrix.flush()
+    del matrix
+    if row != num_records:
+      raise ValueError('Read %d records, the indexes list %d' %
+                       (row, num_records))
+    with open(path + '.labels', 'wb') as f:
+      np.save(f, all_labels)
+  print('Embedded %d records (%d-d) in %.1f sec.' % (
+      row, dim, time.time() - start))
+  return row
+
+
+def main(unused_argv):
+  if not FLAGS.checkpoint:
+    raise ValueError('Please supply a --checkpoint')
+  export(FLAGS.checkpoint, FLAGS.embeddings)
+
+
+if __name__ == '__main__':
+  tf.app.run()
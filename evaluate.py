@@ -0,0 +1,89 @@
+"""Evaluates a checkpoint on every record of a data set, in order.
+
+ Reads the shards of --record_format with `image_processing.ordered_inputs`,
+ in parallel but in a deterministic order and without any random op, and
+ covers every record exactly once. The prediction of every example is
+ streamed to --predictions_file as one tab separated line
+
+   key  label  top-1 class  top-1 probability  top-k classes (comma separated)
+
+ where key is '<shard>:<record number>', so two runs can be diffed and the
+ lines joined back to the records. Top-1 and top-k accuracy are printed at
+ the end.
+
+ Usage:
+   python evaluate.py --checkpoint=./model.ckpt \
+       --predictions_file=./predictions.tsv
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+import model
+
+tf.app.flags.DEFINE_string('checkpoint', '',
+                           """Checkpoint of model.model to evaluate.""")
+tf.app.flags.DEFINE_string('model_mode', 'grouped',
+                           """Tower construction, see model.model.""")
+tf.app.flags.DEFINE_string('predictions_file', './predictions.tsv',
+                           """File the per-example predictions go to.""")
+tf.app.flags.DEFINE_integer('top_k', 5,
+                            """Number of classes written per example.""")
+tf.app.flags.DEFINE_integer('eval_readers', os.cpu_count() or 1,
+                            """Shards read in parallel.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+def evaluate(checkpoint, predictions_file):
+  """Write the predictions of every record; returns (examples, top1, topk)."""
+  with tf.Graph().as_default():
+    keys, images, labels = image_processing.ordered_inputs(
+        None, FLAGS.batch_size, num_readers=FLAGS.eval_readers)
+    logits = model.model(images, FLAGS.batch_size, train=False,
+                         mode=FLAGS.model_mode)
+    top_probs, top_classes = tf.nn.top_k(tf.nn.softmax(logits), FLAGS.top_k)
+    saver = tf.train.Saver()
+
+    examples = top1 = topk = 0
+    start = time.time()
+    with tf.Session() as sess, open(predictions_file, 'w') as out:
+      saver.restore(sess, checkpoint)
+      while True:
+        try:
+          batch = sess.run([keys, labels, top_probs, top_classes])
+        except tf.errors.OutOfRangeError:
+          break
+        for key, label, probs, classes in zip(*batch):
+          out.write('%s\t%d\t%d\t%.6f\t%s\n' % (
+              key.decode('utf-8'), label, classes[0], probs[0],
+              ','.join(str(c) for c in classes)))
+        batch_labels, batch_classes = batch[1], batch[3]
+        examples += len(batch_labels)
+        top1 += np.sum(batch_classes[:, 0] == batch_labels)
+        topk += np.sum(np.any(batch_classes == batch_labels[:, None], axis=1))
+        out.flush()
+    duration = time.time() - start
+  print('%d examples in %.1f sec (%.1f examples/sec)' % (
+      examples, duration, examples / max(duration, 1e-6)))
+  return examples, top1, topk
+
+
+def main(unused_argv):
+  if not FLAGS.checkpoint:
+    raise ValueError('Please supply a --checkpoint')
+  examples, top1, topk = evaluate(FLAGS.checkpoint, FLAGS.predictions_file)
+  if examples:
+    print('top-1 accuracy %.4f, top-%d accuracy %.4f' % (
+        top1 / examples, FLAGS.top_k, topk / examples))
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,129 @@
+"""Exports a checkpoint as a frozen, self-contained inference graph.
+
+ Builds the inference graph once,
+
+   images (uint8 [batch, 230, 230, 3]) and points (int32 [batch, 13, 2])
+   -> image_processing.augment_batch, eval mode: patch extraction and rescale
+   -> model.model, eval mode, without the dropout branch
+   -> probabilities (softmax) and top_k
+
+ restores the checkpoint, folds the variables into constants, strips the
+ Identity and other training-only nodes, folds constant subgraphs and writes
+ one GraphDef to --frozen_graph. `frozen_runtime.FrozenClassifier` loads it
+ without importing any of the model code.
+
+ With --cold_start_runs the export is followed by a benchmark that starts
+ that many fresh processes each loading the artifact with frozen_runtime.py,
+ and reports the median time from process start to the first prediction,
+ split into TensorFlow import, graph load and first run.
+
+ Usage:
+   python export_model.py --checkpoint=./model.ckpt \
+       --frozen_graph=./face_model.pb --cold_start_runs=5
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+import model
+import util
+
+tf.app.flags.DEFINE_string('checkpoint', '',
+                           """Checkpoint of model.model to export.""")
+tf.app.flags.DEFINE_string('model_mode', 'grouped',
+                           """Tower construction, see model.model.""")
+tf.app.flags.DEFINE_string('frozen_graph', './face_model.pb',
+                           """Path of the frozen graph.""")
+tf.app.flags.DEFINE_integer('top_k', 5,
+                            """Number of classes of the top_k output.""")
+tf.app.flags.DEFINE_integer('cold_start_runs', 0,
+                            """Fresh processes to time, 0 to skip.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+OUTPUTS = ['probabilities', 'top_k']
+
+
+def inference_graph(mode, top_k):
+  """Build the inference graph in the default graph."""
+  images = tf.placeholder(tf.uint8, [None, util.FACE_SIZE, util.FACE_SIZE, 3],
+                          name='images')
+  points = tf.placeholder(tf.int32, [None, 13, 2], name='points')
+  patches = image_processing.augment_batch(images, points, train=False,
+                                           add_summaries=False)
+  logits = model.model(patches, None, train=False, mode=mode)
+  probabilities = tf.nn.softmax(logits, name='probabilities')
+  tf.nn.top_k(probabilities, top_k, name='top_k')
+
+
+def _optimize(graph_def):
+  """Strip and fold the frozen graph as far as the installed TF allows."""
+  try:
+    from tensorflow.tools.graph_transforms import TransformGraph
+  except ImportError:
+    return tf.graph_util.remove_training_nodes(graph_def,
+                                               protected_nodes=OUTPUTS)
+  return TransformGraph(graph_def, ['images', 'points'], OUTPUTS, [
+      'remove_nodes(op=Identity, op=CheckNumerics, op=StopGradient)',
+      'fold_constants(ignore_errors=true)',
+      'merge_duplicate_nodes',
+      'sort_by_execution_order'])
+
+
+def export(checkpoint, path, mode, top_k):
+  """Write the frozen graph; returns its GraphDef."""
+  with tf.Graph().as_default() as graph:
+    inference_graph(mode, top_k)
+    saver = tf.train.Saver()
+    with tf.Session() as sess:
+      saver.restore(sess, checkpoint)
+      frozen = tf.graph_util.convert_variables_to_constants(
+          sess, graph.as_graph_def(), OUTPUTS)
+  frozen = tf.graph_util.extract_sub_graph(_optimize(frozen), OUTPUTS)
+  with open(path, 'wb') as f:
+    f.write(frozen.SerializeToString())
+  print('Wrote %s: %d nodes, %.1f MB.' % (path, len(frozen.node),
+                                          os.path.getsize(path) / 1e6))
+  return frozen
+
+
+def cold_start_benchmark(path, runs):
+  """Time fresh processes loading path up to their first prediction."""
+  runtime = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'frozen_runtime.py')
+  results = []
+  for _ in range(runs):
+    start = time.time()
+    output = subprocess.check_output([sys.executable, runtime, path])
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['cold_start_sec'] = result.pop('first_prediction_time') - start
+    results.append(result)
+  summary = {k: float(np.median([r[k] for r in results]))
+             for k in results[0]}
+  print('cold start to first prediction: %.3f sec median of %d '
+        '(import %.3f, load %.3f, first run %.3f)' % (
+            summary['cold_start_sec'], runs, summary['import_sec'],
+            summary['load_sec'], summary['first_prediction_sec']))
+  return summary
+
+
+def main(unused_argv):
+  if not FLAGS.checkpoint:
+    raise ValueError('Please supply a --checkpoint')
+  export(FLAGS.checkpoint, FLAGS.frozen_graph, FLAGS.model_mode, FLAGS.top_k)
+  if FLAGS.cold_start_runs:
+    cold_start_benchmark(FLAGS.frozen_graph, FLAGS.cold_start_runs)
+
+
+if __name__ == '__main__':
+  tf.app.run()
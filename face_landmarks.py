@@ -0,0 +1,238 @@
+"""Landmarks of every face of a batch of images.
+
+ build_image_data keeps the first face of a photo, which is right for the
+ portrait training set but drops everyone but one person of a group photo.
+ extract_landmarks returns all of them:
+
+   image_index  int32 [num_faces]         image each face was found in
+   boxes        int32 [num_faces, 4]      [left, top, right, bottom]
+   shapes       float [num_faces, 68, 2]  (x, y) landmarks
+
+ Images are grouped by resolution for detection, so the CNN (mmod) detector
+ gets whole batches of equally sized images in one call. dlib's HOG detector
+ has no multi-image call, so with a pool from landmark_pool the HOG
+ detection and the shape predictor run on chunks of images in worker
+ processes that each hold their own dlib models. Without a pool they run
+ image by image in this process. Once all faces are known the landmark array
+ is allocated once and each face's landmarks are written into its row.
+ shapes and images[image_index] can go straight to face_runtime.align_faces.
+
+ Run as a script it compares faces/sec of extract_landmarks, in process and
+ with a pool of --workers processes, with the per-image loop of the landmark
+ notebooks.
+
+ Usage:
+   python face_landmarks.py --predictor_path=... ./group_photos/*.jpg
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import multiprocessing
+import time
+
+import numpy as np
+
+import face_runtime
+
+NUM_LANDMARKS = 68
+
+# Per-worker dlib models, set up once by _init_worker.
+_detector = None
+_predictor = None
+
+
+def detect_batch(images, detector, upsample=0, batch_size=32):
+  """Face boxes of every image.
+
+  Args:
+    images: sequence of (H, W, 3) uint8 images.
+    detector: dlib HOG frontal face detector or cnn_face_detection_model_v1.
+    upsample: times dlib upsamples the images.
+    batch_size: images per CNN detector call.
+  Returns:
+    list with the list of dlib.rectangle boxes of each image.
+  """
+  groups = collections.defaultdict(list)
+  for i, image in enumerate(images):
+    groups[image.shape].append(i)
+  cnn = type(detector).__name__ == 'cnn_face_detection_model_v1'
+  boxes = [None] * len(images)
+  for indices in groups.values():
+    if not cnn:
+      for i in indices:
+        boxes[i] = list(detector(images[i], upsample))
+      continue
+    for start in range(0, len(indices), batch_size):
+      chunk = indices[start:start + batch_size]
+      dets = detector([images[i] for i in chunk], upsample,
+                      batch_size=len(chunk))
+      for i, image_dets in zip(chunk, dets):
+        boxes[i] = [d.rect for d in image_dets]
+  return boxes
+
+
+def _init_worker(predictor_path):
+  global _detector, _predictor
+  import dlib
+  _detector = dlib.get_frontal_face_detector()
+  _predictor = dlib.shape_predictor(predictor_path)
+
+
+def _landmarks_chunk(args):
+  """Boxes and landmarks of the faces of a chunk of images, in a worker."""
+  images, upsample = args
+  results = []
+  for image in images:
+    dets = _detector(image, upsample)
+    boxes = np.empty((len(dets), 4), dtype=np.int32)
+    shapes = np.empty((len(dets), NUM_LANDMARKS, 2), dtype=float)
+    for j, d in enumerate(dets):
+      boxes[j] = d.left(), d.top(), d.right(), d.bottom()
+      shapes[j] = face_runtime.shape_to_array(_predictor(image, d))
+    results.append((boxes, shapes))
+  return results
+
+
+def landmark_pool(predictor_path, num_workers=0):
+  """Process pool for extract_landmarks, with HOG detector and predictor.
+
+  Args:
+    predictor_path: dlib 68-point shape predictor model.
+    num_workers: number of processes, 0 for one per core.
+  """
+  return multiprocessing.Pool(num_workers or multiprocessing.cpu_count(),
+                              _init_worker, (predictor_path,))
+
+
+def extract_landmarks(images, detector, predictor, upsample=0, batch_size=32,
+                      pool=None, chunk_size=4):
+  """Landmarks of every face of a batch of images.
+
+  Args:
+    images: sequence of (H, W, 3) uint8 images.
+    detector: dlib HOG frontal face detector or cnn_face_detection_model_v1.
+    predictor: dlib 68-point shape predictor.
+    upsample: times dlib upsamples the images for detection.
+    batch_size: images per CNN detector call.
+    pool: optional landmark_pool. Its workers run HOG detection and the
+      predictor in place of detector and predictor. Ignored for the CNN
+      detector, whose batches already run in one call.
+    chunk_size: images per pool task.
+  Returns:
+    image_index: int32 [num_faces] image of each face.
+    boxes: int32 [num_faces, 4] [left, top, right, bottom] boxes.
+    shapes: float [num_faces, 68, 2] landmarks.
+  """
+  cnn = type(detector).__name__ == 'cnn_face_detection_model_v1'
+  pooled = pool is not None and not cnn
+  if pooled:
+    chunks = [(images[i:i + chunk_size], upsample)
+              for i in range(0, len(images), chunk_size)]
+    per_image = [r for rs in pool.imap(_landmarks_chunk, chunks) for r in rs]
+    counts = [len(b) for b, _ in per_image]
+  else:
+    detections = detect_batch(images, detector, upsample, batch_size)
+    counts = [len(d) for d in detections]
+  num_faces = sum(counts)
+  image_index = np.repeat(np.arange(len(images), dtype=np.int32), counts)
+  boxes = np.empty((num_faces, 4), dtype=np.int32)
+  shapes = np.empty((num_faces, NUM_LANDMARKS, 2), dtype=float)
+  if pooled:
+    ends = np.cumsum(counts)
+    for (image_boxes, image_shapes), end, count in zip(per_image, ends,
+                                                       counts):
+      boxes[end - count:end] = image_boxes
+      shapes[end - count:end] = image_shapes
+    return image_index, boxes, shapes
+  face = 0
+  for i, dets in enumerate(detections):
+    for d in dets:
+      boxes[face] = d.left(), d.top(), d.right(), d.bottom()
+      shapes[face] = face_runtime.shape_to_array(predictor(images[i], d))
+      face += 1
+  return image_index, boxes, shapes
+
+
+def _per_image_loop(images, detector, predictor, upsample):
+  """The notebook loop, keeping every face: the benchmark baseline."""
+  shapes = []
+  for image in images:
+    for d in detector(image, upsample):
+      shape = predictor(image, d)
+      shapes.append(np.array([[p.x, p.y] for p in shape.parts()],
+                             dtype=float))
+  return shapes
+
+
+def benchmark(images, detector, predictor, upsample=0, repeat=3, pool=None):
+  """faces/sec of the per-image loop and of extract_landmarks.
+
+  With a pool, extract_landmarks is also timed on it, as 'pooled'.
+  """
+  results = {}
+  runs = [
+      ('per_image', lambda: len(_per_image_loop(images, detector, predictor,
+                                                upsample))),
+      ('batched', lambda: len(extract_landmarks(images, detector, predictor,
+                                                upsample)[0]))]
+  if pool is not None:
+    runs.append(('pooled', lambda: len(extract_landmarks(
+        images, detector, predictor, upsample, pool=pool)[0])))
+  for name, fn in runs:
+    best = float('inf')
+    for _ in range(repeat):
+      start = time.time()
+      faces = fn()
+      best = min(best, time.time() - start)
+    results[name] = {'faces': faces, 'sec': best,
+                     'faces_per_sec': faces / max(best, 1e-9)}
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('images', nargs='+')
+  parser.add_argument('--predictor_path',
+                      default='./data/shape_predictor_68_face_landmarks.dat')
+  parser.add_argument('--cnn_detector', default='',
+                      help='mmod_human_face_detector.dat, HOG if empty')
+  parser.add_argument('--upsample', type=int, default=1)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--workers', type=int, default=0,
+                      help='HOG pool processes, 0 for one per core, '
+                           '-1 for no pool')
+  args = parser.parse_args()
+
+  import dlib
+  from skimage import io
+  if args.cnn_detector:
+    detector = dlib.cnn_face_detection_model_v1(args.cnn_detector)
+  else:
+    detector = dlib.get_frontal_face_detector()
+  predictor = dlib.shape_predictor(args.predictor_path)
+  images = [io.imread(f)[..., :3] for f in args.images]
+  pool = None
+  if not args.cnn_detector and args.workers >= 0:
+    pool = landmark_pool(args.predictor_path, args.workers)
+  try:
+    results = benchmark(images, detector, predictor, args.upsample,
+                        args.repeat, pool)
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  baseline = max(results['per_image']['faces_per_sec'], 1e-9)
+  for name in ('per_image', 'batched', 'pooled'):
+    if name not in results:
+      continue
+    r = results[name]
+    print('%-9s %d faces in %.3f sec, %.1f faces/sec, speedup %.2fx' % (
+        name, r['faces'], r['sec'], r['faces_per_sec'],
+        r['faces_per_sec'] / baseline))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,374 @@
+"""TensorFlow-free runtime for aligning faces and writing face records.
+
+ Preprocessing workers only need dlib landmarks, the NumPy/SciPy alignment
+ of `util` and a way to write records, none of which needs TensorFlow. This
+ module imports nothing outside the standard library at load time: numpy,
+ util and scipy load on the first alignment, numpy on the first large
+ checksum. build_image_data writes its shards with it.
+
+ Records are written without TensorFlow or protobuf:
+
+   face_example  serializes the Example proto of build_image_data's face
+                 record format field by field.
+   TFRecordFile  writes the TFRecord framing, the uint64 length and the
+                 masked CRC32C of the length and of the data around each
+                 record, readable by tf.data.TFRecordDataset.
+
+ CRC32C uses the crc32c or google_crc32c package when one is installed. The
+ fallback runs the byte-wise table over many lanes of a record at once with
+ numpy and merges the lane checksums with precomputed GF(2) shift operators.
+
+ Run as a script it measures the import time of this module and of
+ --compare, and the time a spawn pool of --workers processes importing each
+ takes to start.
+
+ Usage:
+   python face_runtime.py --workers=8 --compare=build_image_data
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import struct
+
+CASTAGNOLI = 0x82F63B78
+
+# Records at least this long are checksummed with the numpy lanes.
+_LANES_MIN = 4096
+# Bytes per lane, a power of two.
+_LANE = 256
+
+_table = None
+_backend = None
+# log2(n) -> (numpy byte tables, column images) of the operator appending
+# n zero bytes.
+_shifts = {}
+
+
+def _crc_table():
+  global _table
+  if _table is None:
+    table = []
+    for i in range(256):
+      c = i
+      for _ in range(8):
+        c = (c >> 1) ^ (CASTAGNOLI if c & 1 else 0)
+      table.append(c)
+    _table = table
+  return _table
+
+
+def _crc_update(crc, data):
+  """Byte-wise CRC32C update, without initial or final inversion."""
+  table = _crc_table()
+  for b in bytearray(data):
+    crc = table[(crc ^ b) & 0xff] ^ (crc >> 8)
+  return crc
+
+
+def _apply(columns, x):
+  """GF(2) operator, as the images of the 32 unit vectors, applied to x."""
+  y = 0
+  i = 0
+  while x:
+    if x & 1:
+      y ^= columns[i]
+    x >>= 1
+    i += 1
+  return y
+
+
+def _shift_tables(log2n):
+  """Byte tables of the operator appending 2**log2n zero bytes."""
+  if log2n not in _shifts:
+    import numpy as np
+    if log2n == 0:
+      table = _crc_table()
+      columns = [table[(1 << i) & 0xff] ^ ((1 << i) >> 8) for i in range(32)]
+    else:
+      half = _shift_tables(log2n - 1)[1]
+      columns = [_apply(half, _apply(half, 1 << i)) for i in range(32)]
+    tables = np.zeros((4, 256), dtype=np.uint32)
+    byte = np.arange(256)
+    for i in range(32):
+      tables[i // 8][(byte >> (i % 8)) & 1 == 1] ^= columns[i]
+    _shifts[log2n] = (tables, columns)
+  return _shifts[log2n]
+
+
+def _shift(tables, x):
+  return (tables[0][x & 0xff] ^ tables[1][(x >> 8) & 0xff] ^
+          tables[2][(x >> 16) & 0xff] ^ tables[3][x >> 24])
+
+
+def _crc_lanes(data):
+  """CRC32C without inversions of a long record, lanes in parallel."""
+  import numpy as np
+  data = np.frombuffer(data, dtype=np.uint8)
+  lanes = 1
+  while lanes * _LANE < len(data):
+    lanes *= 2
+  # Leading zeros leave a CRC without initial inversion unchanged.
+  padded = np.zeros(lanes * _LANE, dtype=np.uint8)
+  padded[len(padded) - len(data):] = data
+  padded = padded.reshape(lanes, _LANE).T.astype(np.uint32)
+  table = np.array(_crc_table(), dtype=np.uint32)
+  crc = np.zeros(lanes, dtype=np.uint32)
+  for column in padded:
+    crc = table[(crc ^ column) & 0xff] ^ (crc >> 8)
+  # Merge neighbouring lanes: crc(a + b) = shift_len(b)(crc(a)) ^ crc(b).
+  log2n = _LANE.bit_length() - 1
+  while len(crc) > 1:
+    crc = _shift(_shift_tables(log2n)[0], crc[0::2]) ^ crc[1::2]
+    log2n += 1
+  return int(crc[0])
+
+
+def _crc32c_python(data):
+  n = len(data)
+  if n < _LANES_MIN:
+    return _crc_update(0xffffffff, data) ^ 0xffffffff
+  # The initial inversion is 0xffffffff followed by n zero bytes.
+  init = 0xffffffff
+  log2n = 0
+  while n:
+    if n & 1:
+      init = _apply(_shift_tables(log2n)[1], init)
+    n >>= 1
+    log2n += 1
+  return _crc_lanes(data) ^ init ^ 0xffffffff
+
+
+def crc32c(data):
+  """CRC32C (Castagnoli) of bytes."""
+  global _backend
+  if _backend is None:
+    try:
+      import crc32c as package
+      _backend = package.crc32c
+    except ImportError:
+      try:
+        import google_crc32c
+        _backend = google_crc32c.value
+      except ImportError:
+        _backend = _crc32c_python
+  return _backend(data)
+
+
+def masked_crc32c(data):
+  """The masked CRC32C of the TFRecord format."""
+  crc = crc32c(data)
+  return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+def tfrecord(data):
+  """One record of a TFRecord file, framing included."""
+  length = struct.pack('<Q', len(data))
+  return b''.join([length, struct.pack('<I', masked_crc32c(length)), data,
+                   struct.pack('<I', masked_crc32c(data))])
+
+
+class TFRecordFile(object):
+  """Minimal tf.python_io.TFRecordWriter, without compression."""
+
+  def __init__(self, path):
+    self._file = open(path, 'wb')
+
+  def write(self, record):
+    self._file.write(tfrecord(record))
+
+  def flush(self):
+    self._file.flush()
+
+  def close(self):
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def _varint(value):
+  value &= 0xffffffffffffffff
+  out = bytearray()
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+  return bytes(out)
+
+
+def _field(number, payload):
+  """A length-delimited protobuf field."""
+  return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def bytes_feature(value):
+  """Serialized Feature with a one-value bytes_list."""
+  return _field(1, _field(1, value))
+
+
+def int64_feature(values):
+  """Serialized Feature with an int64_list."""
+  if not isinstance(values, (list, tuple)):
+    values = [values]
+  return _field(3, _field(1, b''.join(_varint(v) for v in values)))
+
+
+def example(features):
+  """Serialized Example of a dict of feature name to serialized Feature."""
+  entries = [_field(1, _field(1, name.encode('utf-8')) + _field(2, feature))
+             for name, feature in sorted(features.items())]
+  return _field(1, b''.join(entries))
+
+
+def face_example(image_data, points, label, text):
+  """Serialized Example of build_image_data's face record format.
+
+  Args:
+    image_data: bytes, raw uint8 pixels of a 230x230x3 face.
+    points: bytes, raw int64 (x, y) coordinates of the 13 feature points.
+    label: integer label.
+    text: string label.
+  """
+  if not isinstance(text, bytes):
+    text = text.encode('utf-8')
+  return example({'image/data': bytes_feature(image_data),
+                  'image/points': bytes_feature(points),
+                  'image/class/label': int64_feature(int(label)),
+                  'image/class/text': bytes_feature(text)})
+
+
+def shape_to_array(shape):
+  """Convert a dlib full_object_detection into a (68, 2) float array."""
+  import numpy as np
+  return np.array([[p.x, p.y] for p in shape.parts()], dtype=float)
+
+
+def detect_landmarks(img, detector, predictor, upsample):
+  """Box and landmarks of the first face dlib finds in img.
+
+  Returns:
+    [left, top, right, bottom] box and (68, 2) landmarks, or (None, None).
+  """
+  dets = detector(img, upsample)
+  if len(dets) == 0:
+    return None, None
+  d = dets[0]
+  box = [d.left(), d.top(), d.right(), d.bottom()]
+  return box, shape_to_array(predictor(img, d))
+
+
+def load_base_shape(detector, predictor, base_face, upsample=1):
+  """Landmarks of the reference face all photos are aligned to."""
+  from skimage import io
+  _, shape = detect_landmarks(io.imread(base_face), detector, predictor,
+                              upsample)
+  if shape is None:
+    raise ValueError('No face found in base face %s' % base_face)
+  return shape
+
+
+def find_image_files(data_dir, labels_file):
+  """Build a list of all photos and labels in the data set.
+
+  The photos of a label are in the sub-directory of data_dir named after
+  it; labels are line numbers in labels_file.
+
+  Returns:
+    list of (filename, label, text) tuples.
+  """
+  import glob
+  import os
+  with open(labels_file) as f:
+    texts = [l.strip() for l in f if l.strip()]
+
+  files = []
+  for label, text in enumerate(texts):
+    for filename in sorted(glob.glob(os.path.join(data_dir, text, '*'))):
+      files.append((filename, label, text))
+  print('Found %d photos across %d labels inside %s.' %
+        (len(files), len(texts), data_dir))
+  return files
+
+
+def align_faces(images, shapes, base_shape, out=None):
+  """Align a chunk of faces to the base shape.
+
+  Args:
+    images: sequence of N (H, W, 3) uint8 images.
+    shapes: (N, 68, 2) landmarks of the faces.
+    base_shape: (68, 2) landmarks of the reference face.
+    out: optional preallocated (N, 230, 230, 3) uint8 buffer.
+  Returns:
+    faces: (N, 230, 230, 3) uint8 aligned faces.
+    points: (N, 13, 2) int64 feature points in the aligned faces.
+  """
+  import numpy as np
+  import util
+  _, z, tform = util.procrustes_batch(base_shape, shapes)
+  faces = util.transform_batch(images, tform, out=out)
+  points = np.rint(z[:, util.FEATURE_POINTS]).astype(np.int64)
+  np.clip(points, 0, util.FACE_SIZE - 1, out=points)
+  return faces, points
+
+
+def _import(name):
+  import importlib
+  importlib.import_module(name)
+
+
+def _pid(_):
+  import os
+  return os.getpid()
+
+
+def import_time(module, runs=5):
+  """Median seconds a fresh interpreter takes to import module."""
+  import os
+  import subprocess
+  import sys
+  code = ('import time; t = time.time(); import %s; '
+          'print(time.time() - t)' % module)
+  here = os.path.dirname(os.path.abspath(__file__))
+  times = sorted(float(subprocess.check_output([sys.executable, '-c', code],
+                                               cwd=here))
+                 for _ in range(runs))
+  return times[len(times) // 2]
+
+
+def spawn_time(module, workers):
+  """Seconds until a spawn pool importing module has run a task per worker."""
+  import multiprocessing
+  import time
+  start = time.time()
+  pool = multiprocessing.get_context('spawn').Pool(workers, _import,
+                                                   (module,))
+  try:
+    pool.map(_pid, range(workers), chunksize=1)
+    return time.time() - start
+  finally:
+    pool.close()
+    pool.join()
+
+
+def main():
+  import argparse
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--compare', default='build_image_data',
+                      help='module to compare with, empty for none')
+  args = parser.parse_args()
+  for module in ['face_runtime', args.compare]:
+    if not module:
+      continue
+    print('%-18s import %.3f sec, spawn pool of %d %.3f sec' % (
+        module, import_time(module, args.runs), args.workers,
+        spawn_time(module, args.workers)))
+
+
+if __name__ == '__main__':
+  main()
@@ -14,43 +14,78 @@
 # ==============================================================================
 """Read and preprocess image data.
 
- Image processing occurs on a single image at a time. Image are read and
- preprocessed in parallel across multiple threads. The resulting images
- are concatenated together to form a single batch for training or evaluation.
+ inputs and distorted_inputs pick one input engine from the flags. Every
+ engine yields batches of the 13 feature point patches of a face. The patch
+ cut and, for training, the flip and color distortion run once per batch, in
+ augment_batch or augment_patch_batch:
+
+   batch_inputs    queue runners read records, and --num_preprocess_threads
+                   threads parse and decode them one at a time into a batch.
+   dataset_inputs  tf.data reads, shuffles and batches the serialized
+                   records, then parses and decodes whole batches
+                   (--use_tf_data, --record_format=patches,
+                   --indexed_shuffle).
+   cached_inputs   the deterministic stages are read from a preprocess_cache
+                   built on first use (--preprocess_cache).
+   online_inputs   faces are realigned from the photos by an
+                   online_alignment.AlignmentRing with jittered alignments
+                   (--online_alignment, training only).
+   ordered_inputs  every record once, in order, with its record key, for
+                   evaluation. Called directly rather than by inputs.
 
  -- Provide processed image data for a network:
  inputs: Construct batches of evaluation examples of images.
  distorted_inputs: Construct batches of training examples of images.
  batch_inputs: Construct batches of training or evaluation examples of images.
+ dataset_inputs: Construct the same batches from a tf.data pipeline.
+ ordered_inputs: Construct keyed evaluation batches of every record, in order.
+ cached_inputs: Construct the same batches from the preprocessing cache.
+ online_inputs: Construct training batches realigned online from the photos.
 
  -- Data processing:
  parse_example_proto: Parses an Example proto containing a training example
    of an image.
 
- -- Image decoding:
- decode_jpeg: Decode a JPEG encoded string into a 3-D float32 Tensor.
-
  -- Image preprocessing:
- image_preprocessing: Decode and preprocess one image for evaluation or training
- distort_image: Distort one image for training a network.
- eval_image: Prepare one image for evaluation.
- distort_color: Distort the color in one image for training.
+ extract_feature_points_batch: Cut the 13 feature point patches of a batch.
+ random_flip_batch: Randomly mirror the images and points of a batch.
+ distort_color_batch: Distort the color of a batch of patches.
+ augment_batch: Flip, cut and distort a batch of decoded images.
+ augment_patch_batch: Flip, cut and distort a batch of stored patches.
+ standardize_color_batch: Standardize or whiten the colors of a batch.
 """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import sys
+import time
+
+import numpy as np
 import tensorflow as tf
 
+import pipeline_stats
+import preprocess_cache
+import record_index
+
 FLAGS = tf.app.flags.FLAGS
 
+# Shards of every record format. Shard names end in their number, which
+# keeps the record_index sidecar files out of the match.
+DATA_FILES = {'image': './train/*[0-9]', 'patches': './train_patches/*[0-9]'}
+
+# Side of the window around each point that patch records keep: the largest
+# window extract_feature_points_batch cuts, for training.
+PATCH_WINDOW = 2 * 39 + 1
+
 tf.app.flags.DEFINE_integer('batch_size', 32,
                             """Number of images to process in a batch.""")
 tf.app.flags.DEFINE_integer('image_size', 30,
                             """Provide square images of this size.""")
 tf.app.flags.DEFINE_integer('num_preprocess_threads', 4,
-                            """Number of preprocessing threads per tower. """
-                            """Please make this a multiple of 4.""")
+                            """Number of threads per tower that parse and """
+                            """decode records for batch_inputs.""")
 tf.app.flags.DEFINE_integer('num_readers', 4,
                             """Number of parallel readers during train.""")
 
@@ -69,6 +104,76 @@ tf.app.flags.DEFINE_integer('input_queue_memory_factor', 16,
                             """Default is ideal but try smaller values, e.g. """
                             """4, 2 or 1, if host memory is constrained. See """
                             """comments in code for more details.""")
+tf.app.flags.DEFINE_integer('augmentation_seed', None,
+                            """Seed of the random flips, color distortions """
+                            """and patch jitter. Unseeded if not set.""")
+tf.app.flags.DEFINE_string('record_format', 'image',
+                           """'image' for records of full 230x230 faces, """
+                           """'patches' for the compact records of """
+                           """patch_records.py. Patches need tf.data.""")
+tf.app.flags.DEFINE_integer('patch_record_size', 40,
+                            """Side of the patches stored in patch records.""")
+tf.app.flags.DEFINE_boolean('indexed_shuffle', False,
+                            """Shuffle training records with full-data set """
+                            """permutations read through record_index """
+                            """instead of a shuffle buffer. Needs tf.data.""")
+tf.app.flags.DEFINE_boolean('instrument_pipeline', False,
+                            """Add queue counters, stage timers and step """
+                            """timestamps for pipeline_stats."""
+                            """PipelineMonitorHook.""")
+tf.app.flags.DEFINE_boolean('use_tf_data', False,
+                            """Build the input pipeline with tf.data """
+                            """instead of queue runners.""")
+tf.app.flags.DEFINE_string('color_standardization', 'none',
+                           """'none', 'channel' (per-channel mean and std) """
+                           """or 'zca' whitening of the patches, with the """
+                           """statistics of --color_stats.""")
+tf.app.flags.DEFINE_string('color_stats', './color_stats.npz',
+                           """Color statistics written by color_stats.py.""")
+tf.app.flags.DEFINE_integer('task_index', 0,
+                            """Read only every num_tasks-th shard, """
+                            """starting at this one.""")
+tf.app.flags.DEFINE_integer('num_tasks', 1,
+                            """Number of data-parallel tasks splitting """
+                            """the training shards.""")
+tf.app.flags.DEFINE_string('preprocess_cache', '',
+                           """Directory of the cache of the deterministic """
+                           """preprocessing stages, see preprocess_cache. """
+                           """Disabled if empty.""")
+tf.app.flags.DEFINE_integer('preprocess_cache_ram_mb', 1024,
+                            """Read caches up to this size into memory """
+                            """instead of memory-mapping them.""")
+tf.app.flags.DEFINE_boolean('online_alignment', False,
+                            """Train on the photos of --alignment_data_dir """
+                            """realigned with random jitter, see """
+                            """online_alignment.""")
+tf.app.flags.DEFINE_string('alignment_data_dir', './faces',
+                           """Photos realigned online, one sub-directory """
+                           """per label.""")
+tf.app.flags.DEFINE_string('alignment_labels_file', './labels',
+                           """Labels file of --alignment_data_dir.""")
+tf.app.flags.DEFINE_string('alignment_predictor_path',
+                           './data/shape_predictor_68_face_landmarks.dat',
+                           """dlib 68-point shape predictor model.""")
+tf.app.flags.DEFINE_string('alignment_base_face', './data/base_face.jpg',
+                           """Reference face photos are aligned to.""")
+tf.app.flags.DEFINE_string('alignment_landmark_cache', '',
+                           """Landmark cache of the photos, see """
+                           """build_image_data --landmark_cache.""")
+tf.app.flags.DEFINE_integer('alignment_upsample', 1,
+                            """Times dlib upsamples photos missing from """
+                            """the landmark cache.""")
+tf.app.flags.DEFINE_integer('alignment_workers', 0,
+                            """Online alignment processes, 0 for one per """
+                            """core.""")
+tf.app.flags.DEFINE_integer('alignment_slots', 8,
+                            """Batches of the online alignment ring.""")
+tf.app.flags.DEFINE_float('alignment_max_rotation', 5.,
+                          """Largest alignment rotation jitter, degrees.""")
+tf.app.flags.DEFINE_float('alignment_max_scale', 0.05,
+                          """Largest relative alignment scale jitter.""")
+tf.app.flags.DEFINE_float('alignment_max_shift', 4.,
+                          """Largest alignment shift jitter, pixels.""")
 
 
 def inputs(dataset, batch_size=None, num_preprocess_threads=None):
@@ -96,10 +201,16 @@ def inputs(dataset, batch_size=None, num_preprocess_threads=None):
   # Force all input processing onto CPU in order to reserve the GPU for
   # the forward inference and back-propagation.
   with tf.device('/cpu:0'):
-    images, labels = batch_inputs(
-        dataset, batch_size, train=False,
-        num_preprocess_threads=num_preprocess_threads,
-        num_readers=1)
+    if FLAGS.preprocess_cache:
+      images, labels = cached_inputs(dataset, batch_size, train=False)
+    elif FLAGS.use_tf_data or FLAGS.record_format == 'patches':
+      images, labels = dataset_inputs(dataset, batch_size, train=False,
+                                      num_readers=1)
+    else:
+      images, labels = batch_inputs(
+          dataset, batch_size, train=False,
+          num_preprocess_threads=num_preprocess_threads,
+          num_readers=1)
 
   return images, labels
 
@@ -130,178 +241,235 @@ def distorted_inputs(dataset, batch_size=None, num_preprocess_threads=None):
   # Force all input processing onto CPU in order to reserve the GPU for
   # the forward inference and back-propagation.
   with tf.device('/cpu:0'):
-    images, labels = batch_inputs(
-        dataset, batch_size, train=True,
-        num_preprocess_threads=num_preprocess_threads,
-        num_readers=FLAGS.num_readers)
+    if FLAGS.online_alignment:
+      images, labels = online_inputs(dataset, batch_size)
+    elif FLAGS.preprocess_cache:
+      images, labels = cached_inputs(dataset, batch_size, train=True)
+    elif (FLAGS.use_tf_data or FLAGS.record_format == 'patches' or
+          FLAGS.indexed_shuffle):
+      images, labels = dataset_inputs(dataset, batch_size, train=True,
+                                      num_readers=FLAGS.num_readers)
+    else:
+      images, labels = batch_inputs(
+          dataset, batch_size, train=True,
+          num_preprocess_threads=num_preprocess_threads,
+          num_readers=FLAGS.num_readers)
   return images, labels
 
-def distort_color(image, thread_id=0, scope=None):
-  """Distort the color of the image.
+def extract_feature_points_batch(images, points, train, seed=None,
+                                 extrapolation_value=0.0, scope=None):
+    """Cut the 13 patches around the feature points of a whole batch.
 
-  Each color distortion is non-commutative and thus ordering of the color ops
-  matters. Ideally we would randomly permute the ordering of the color ops.
-  Rather then adding that level of complication, we select a distinct ordering
-  of color ops for each preprocessing thread.
+    Every point becomes one normalized box and all batch*13 patches are
+    sampled by a single crop_and_resize, which fills the area outside the
+    image with zeros instead of padding the source images. The boxes cover
+    (2c+1)^2 pixels around the point with c = 39 for train and 29 for eval.
+    In train mode every box is shrunk to a random 75%-100% of its area at a
+    random offset, as sample_distorted_bounding_box does.
 
-  Args:
-    image: Tensor containing single image.
-    thread_id: preprocessing thread ID.
-    scope: Optional scope for op_scope.
-  Returns:
-    color-distorted image
-  """
-  # with tf.op_scope([image], scope, 'distort_color'):
-  with tf.name_scope(scope, 'distort_color', [image]):
-    color_ordering = thread_id % 2
-
-    #image = _whitebalanced_image(image)
-    if color_ordering == 0:
-      image = tf.image.random_brightness(image, max_delta=32. / 255.)
-      image = tf.image.random_saturation(image, lower=0.5, upper=1.5)
-      image = tf.image.random_hue(image, max_delta=0.2)
-      image = tf.image.random_contrast(image, lower=0.5, upper=1.5)
-    elif color_ordering == 1:
-      image = tf.image.random_brightness(image, max_delta=32. / 255.)
-      image = tf.image.random_contrast(image, lower=0.5, upper=1.5)
-      image = tf.image.random_saturation(image, lower=0.5, upper=1.5)
-      image = tf.image.random_hue(image, max_delta=0.2)
-
-    image = tf.clip_by_value(image, 0.0, 1.0)
-    # image = tf.image.per_image_standardization(image)
-    # The random_* ops do not necessarily clamp.
-    return image
-
-def distort_image(image, height, width, bbox, thread_id=0, scope=None):
-  """Distort one image for training a network.
+    Args:
+      images: 4-D float Tensor [batch, height, width, 3].
+      points: 3-D int Tensor [batch, 13, 2] of (x, y) feature points.
+      train: boolean
+      seed: optional integer seed of the box jitter.
+      extrapolation_value: value of the pixels outside the image.
+      scope: Optional scope for name_scope.
+    Returns:
+      5-D float Tensor [batch, 13, image_size, image_size, 3].
+    """
+    with tf.name_scope(scope, 'extract_feature_points', [images, points]):
+        size = FLAGS.image_size
+        shape = tf.shape(images)
+        batch, height, width = shape[0], shape[1], shape[2]
+        num_points = tf.shape(points)[1]
+        points = tf.to_float(tf.reshape(points, [-1, 2]))
+
+        x, y, span = _patch_windows(points, train, seed)
+        h = tf.to_float(height - 1)
+        w = tf.to_float(width - 1)
+        boxes = tf.stack([y / h, x / w, (y + span) / h, (x + span) / w],
+                         axis=1)
+        box_ind = tf.reshape(
+            tf.tile(tf.expand_dims(tf.range(batch), 1), [1, num_points]), [-1])
+
+        patches = tf.image.crop_and_resize(
+            images, boxes, box_ind, [size, size],
+            extrapolation_value=extrapolation_value)
+        return tf.reshape(patches, [batch, num_points, size, size, 3])
+
+def _patch_windows(points, train, seed=None):
+    """Sampling windows of the patches around a list of points.
 
-  Distorting images provides a useful technique for augmenting the data
-  set during training in order to make the network invariant to aspects
-  of the image that do not effect the label.
+    Args:
+      points: 2-D float Tensor [num_boxes, 2] of (x, y) points.
+      train: boolean
+      seed: optional integer seed of the box jitter.
+    Returns:
+      x, y: 1-D float Tensors, pixel coordinates of the first samples.
+      span: 1-D float Tensor, pixel distance from the first to the last sample.
+    """
+    size = FLAGS.image_size
+    c = 39 if train else 29
+    window = float(2 * c + 1)
+    num_boxes = tf.shape(points)[0]
+
+    # top left corner and side of every window, in pixels
+    x = points[:, 0] - c
+    y = points[:, 1] - c
+    side = tf.fill([num_boxes], window)
+    if train:
+      area = tf.random_uniform([num_boxes], 0.75, 1.0, seed=seed)
+      side = window * tf.sqrt(area)
+      offsets = tf.random_uniform([num_boxes, 2],
+                                  seed=_offset_seed(seed, 1))
+      x += offsets[:, 0] * (window - side)
+      y += offsets[:, 1] * (window - side)
 
-  Args:
-    image: 3-D float Tensor of image
-    height: integer
-    width: integer
-    bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
-      where each coordinate is [0, 1) and the coordinates are arranged
-      as [ymin, xmin, ymax, xmax].
-    thread_id: integer indicating the preprocessing thread.
-    scope: Optional scope for op_scope.
-  Returns:
-    3-D float Tensor of distorted image used for training.
-  """
-  # with tf.op_scope([image, height, width, bbox], scope, 'distort_image'):
-  with tf.name_scope(scope, 'distort_image', [image, height, width, bbox]):
-    distorted_image = image
-    resize_method = thread_id % 4
-    distorted_image = distort_color(distorted_image, thread_id)
+    # crop_and_resize samples both box edges; resize_images samples
+    # size points spaced side / size apart from the first edge.
+    span = side * (size - 1) / size
+    return x, y, span
 
-    if not thread_id:
-      tf.summary.image('final_distorted_image',
-                       tf.expand_dims(distorted_image, 0))
-    return distorted_image
+def _offset_seed(seed, offset):
+    # Distinct op-level seeds keep seeded random ops independent.
+    return None if seed is None else seed + offset
 
+def random_flip_batch(images, points, seed=None, scope=None):
+    """Mirror a random half of a batch of images and their feature points.
 
-def eval_image(image, height, width, scope=None):
-  """Prepare one image for evaluation.
+    Args:
+      images: 4-D Tensor [batch, height, width, channels].
+      points: 3-D int Tensor [batch, num_points, 2] of (x, y) points.
+      seed: optional integer seed.
+      scope: Optional scope for name_scope.
+    Returns:
+      images and points, flipped where a per-sample coin toss came up heads.
+    """
+    with tf.name_scope(scope, 'random_flip_batch', [images, points]):
+        batch = tf.shape(images)[0]
+        width = tf.shape(images)[2]
+        mask = tf.random_uniform([batch], 0, 1.0, seed=seed) < 0.5
+        images = tf.where(mask, tf.reverse(images, axis=[2]), images)
+        x, y = tf.unstack(points, axis=2)
+        flipped = tf.stack([width - 1 - x, y], axis=2)
+        points = tf.where(mask, flipped, points)
+        return images, points
+
+def distort_color_batch(patches, seed=None, scope=None):
+    """Distort the color of a batch of patches.
+
+    Every sample draws one brightness, saturation, hue and contrast change,
+    shared by all its patches, and the changes are applied to the whole
+    batch at once.
 
-  Args:
-    image: 3-D float Tensor
-    height: integer
-    width: integer
-    scope: Optional scope for op_scope.
-  Returns:
-    3-D float Tensor of prepared image.
-  """
-  # with tf.op_scope([image, height, width], scope, 'eval_image'):
-  with tf.name_scope(scope, 'eval_image', [image,  height, width]):
-    # Crop the central region of the image with an area containing 87.5% of
-    # the original image.
-    image = tf.image.central_crop(image, central_fraction=0.875)
-
-    # Resize the image to the original height and width.
-    image = tf.expand_dims(image, 0)
-    image = tf.image.resize_bilinear(image, [height, width],
-                                     align_corners=False)
-    image = tf.squeeze(image, [0])
-    return image
-
-def _flip_points(points, height, width):
-        points = [width, 0] - points
-        points = tf.abs(points)
-        return points
-
-def _ramdom_flip_image_point(image, points, train, scope=None):
-    with tf.name_scope(scope, 'random_flip', [image, points]):
-        random = tf.random_uniform([], minval=0, maxval=1)
-        image = tf.cond(random < 0.5, lambda: tf.image.flip_left_right(image), lambda: image)
-        points = tf.cond(random < 0.5, lambda: _flip_points(points, 230, 230), lambda: points)
-
-    return [image, points]
-
-def _crop_image(image, point, train, scope=None):
-    with tf.name_scope(scope, 'crop_image', [image, point]):
-        c = 39 if train else 29
-        # bbox = [point[0] - 29, point[0]+29, point[1]-29, point[1]+29]
-        image = tf.pad(image, [[c, c+1], [c, c+1], [0,0]])
-        print(image)
-        # image = tf.Print(image, [tf.shape(image)])
-        # image = tf.image.pad_to_bounding_box(image, 0, 0, 250, 250)
-        image = tf.image.crop_to_bounding_box(image, point[1], point[0], c*2+1, c*2+1)
-        if(train):
-            begin, size, bbox_for_draw = tf.image.sample_distorted_bounding_box(tf.shape(image),  bounding_boxes=[[[0.0, 0.0, 1.0, 1.0]]], area_range=[0.75, 1.0], aspect_ratio_range=[1.0, 1.0])
-            image = tf.slice(image, begin, size)
-
-    image = tf.image.resize_images(image, [30, 30])
-    image.set_shape([30, 30, 3])
-    return image
-
-def extract_feature_points(image, points, train):
-    image_block=[]
-    
-    for point in tf.unstack(points, axis=0):
-        imaged = _crop_image(image, point, train)
-        image_block.append(imaged)
-    image = tf.stack(image_block)
-    return image
-
-def image_preprocessing(image_buffer, bbox, train, thread_id=0):
-    """Decode and preprocess one image for evaluation or training.
+    Args:
+      patches: 5-D float Tensor [batch, num_points, height, width, 3] in
+        [0, 1].
+      seed: optional integer seed.
+      scope: Optional scope for name_scope.
+    Returns:
+      color-distorted patches
+    """
+    with tf.name_scope(scope, 'distort_color_batch', [patches]):
+        batch = tf.shape(patches)[0]
+
+        def per_sample(lower, upper, offset):
+            values = tf.random_uniform([batch], lower, upper,
+                                       seed=_offset_seed(seed, offset))
+            return tf.reshape(values, [-1, 1, 1, 1, 1])
+
+        patches = patches + per_sample(-32. / 255., 32. / 255., 0)
+
+        hue, saturation, value = tf.unstack(tf.image.rgb_to_hsv(
+            tf.clip_by_value(patches, 0.0, 1.0)), axis=4)
+        saturation = tf.clip_by_value(
+            saturation * per_sample(0.5, 1.5, 1)[..., 0], 0.0, 1.0)
+        hue = tf.mod(hue + per_sample(-0.2, 0.2, 2)[..., 0], 1.0)
+        patches = tf.image.hsv_to_rgb(tf.stack([hue, saturation, value],
+                                               axis=4))
+
+        mean = tf.reduce_mean(patches, axis=[2, 3], keep_dims=True)
+        patches = (patches - mean) * per_sample(0.5, 1.5, 3) + mean
+
+        # The random_* ops do not necessarily clamp.
+        return tf.clip_by_value(patches, 0.0, 1.0)
+
+def augment_batch(images, points, train, seed=None, add_summaries=True,
+                  scope=None):
+    """Turn a batch of decoded images into the network input patches.
+
+    Flips, patch extraction and color distortion all run on the whole batch,
+    and color is only distorted on the patches the network actually sees.
 
     Args:
-      image_buffer: JPEG encoded string Tensor
-      bbox: 3-D float Tensor of bounding boxes arranged [1, num_boxes, coords]
-        where each coordinate is [0, 1) and the coordinates are arranged as
-        [ymin, xmin, ymax, xmax].
+      images: 4-D uint8 Tensor [batch, 230, 230, 3].
+      points: 3-D int32 Tensor [batch, 13, 2].
       train: boolean
-      thread_id: integer indicating preprocessing thread
-
+      seed: optional integer seed of all random ops.
+      add_summaries: boolean, False inside tf.data functions.
+      scope: Optional scope for name_scope.
     Returns:
-      3-D float Tensor containing an appropriately scaled image
-
-    Raises:
-      ValueError: if user does not provide bounding box
+      5-D float Tensor [batch, 13, image_size, image_size, 3] in [-1, 1],
+      or color standardized with --color_standardization.
     """
-    if bbox is None:
-      raise ValueError('Please supply a bounding box.')
+    with tf.name_scope(scope, 'augment_batch', [images, points]):
+        images = tf.image.convert_image_dtype(images, tf.float32)
+        if train:
+          images, points = random_flip_batch(images, points, seed=seed)
+          if add_summaries: tf.summary.image('flipped_image', images[:1])
+        # Outside the image the patches are gray, as after padding the
+        # rescaled image with zeros.
+        patches = extract_feature_points_batch(
+            images, points, train, seed=_offset_seed(seed, 10),
+            extrapolation_value=0.5)
+        if train:
+          patches = distort_color_batch(patches, seed=_offset_seed(seed, 20))
+        return _rescale_batch(patches)
+
+def _color_transform(method, path):
+    """(W, b) with x W + b the color standardization of [0, 1] pixels x."""
+    stats = np.load(path)
+    mean = stats['mean']
+    if method == 'channel':
+      weights = np.diag(1. / stats['std'])
+    elif method == 'zca':
+      weights = stats['zca']
+    else:
+      raise ValueError('Unknown color_standardization %r' % method)
+    return weights.astype(np.float32), (-mean.dot(weights)).astype(np.float32)
 
-    # image = decode_jpeg(image_buffer)
-    # image = tf.reshape(image_buffer, [59, 59, -1])
-    height = FLAGS.image_size
-    width = FLAGS.image_size
+def standardize_color_batch(patches, method, path, scope=None):
+    """Standardize the colors of a batch with precomputed data set statistics.
 
-    if train:
-      image = distort_image(image_buffer, height, width, bbox, thread_id)
-    else:
-      # image = eval_image(image_buffer, height, width)
-      image = image_buffer
+    Per-channel standardization and ZCA whitening are both an affine map of
+    the 3 channels, applied to all pixels of the batch as one matmul.
 
+    Args:
+      patches: float Tensor [..., 3] in [0, 1].
+      method: 'channel' or 'zca'.
+      path: .npz statistics written by color_stats.py.
+      scope: Optional scope for name_scope.
+    Returns:
+      float Tensor of the shape of patches.
+    """
+    with tf.name_scope(scope, 'standardize_color_batch', [patches]):
+        weights, bias = _color_transform(method, path)
+        shape = tf.shape(patches)
+        pixels = tf.reshape(patches, [-1, 3])
+        pixels = tf.nn.bias_add(tf.matmul(pixels, tf.constant(weights)),
+                                tf.constant(bias))
+        pixels = tf.reshape(pixels, shape)
+        pixels.set_shape(patches.get_shape())
+        return pixels
+
+def _rescale_batch(patches):
+    if FLAGS.color_standardization != 'none':
+      return standardize_color_batch(patches, FLAGS.color_standardization,
+                                     FLAGS.color_stats)
     # Finally, rescale to [-1,1] instead of [0, 1)
-    image = tf.subtract(image, 0.5)
-    image = tf.multiply(image, 2.0)
-    return image
-
+    patches = tf.subtract(patches, 0.5)
+    patches = tf.multiply(patches, 2.0)
+    return patches
 
 def parse_example_proto(example_serialized):
     """Parses an Example proto containing a training example of an image.
@@ -349,6 +517,18 @@ def parse_example_proto(example_serialized):
     return features['image/data'], features['image/class/label'], features['image/points'], features['image/class/text']
 
 
+def _task_shards(record_format, train):
+    """Shards of record_format read by this task.
+
+    Training shards are dealt round robin over the --num_tasks data-parallel
+    tasks, so that every task reads a disjoint subset; evaluation reads all.
+    """
+    shards = record_index.shard_files(DATA_FILES[record_format])
+    if train:
+      shards = shards[FLAGS.task_index::FLAGS.num_tasks]
+    return shards
+
+
 def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
                  num_readers=1):
     """Contruct batches of training or evaluation examples from the image dataset.
@@ -368,9 +548,10 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
     Raises:
       ValueError: if data is not found
     """
+    stats = pipeline_stats.PipelineStats(FLAGS.instrument_pipeline)
     with tf.name_scope('batch_processing'):
-        data_files = tf.matching_files("./train/*") #dataset.data_files()
-        if data_files is None:
+        data_files = _task_shards('image', train) #dataset.data_files()
+        if not data_files:
             raise ValueError('No data files found for this dataset')
 
         # Create filename_queue
@@ -385,10 +566,6 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
         if num_preprocess_threads is None:
           num_preprocess_threads = FLAGS.num_preprocess_threads
 
-        if num_preprocess_threads % 4:
-          raise ValueError('Please make num_preprocess_threads a multiple '
-                           'of 4 (%d % 4 != 0).', num_preprocess_threads)
-
         if num_readers is None:
           num_readers = FLAGS.num_readers
 
@@ -419,11 +596,16 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
           for _ in range(num_readers):
             reader = tf.TFRecordReader()
             _, value = reader.read(filename_queue)
-            enqueue_ops.append(examples_queue.enqueue([value]))
+            enqueue_ops.append(stats.count_op('examples_queue/enqueue',
+                                              examples_queue.enqueue([value])))
 
           tf.train.queue_runner.add_queue_runner(
               tf.train.queue_runner.QueueRunner(examples_queue, enqueue_ops))
-          example_serialized = examples_queue.dequeue()
+          stats.queue('examples_queue', examples_queue,
+                      min_queue_examples + 3 * batch_size if train else
+                      examples_per_shard + 3 * batch_size)
+          example_serialized = stats.count('examples_queue/dequeue',
+                                           examples_queue.dequeue())
         else:
           reader = tf.TFRecordReader()
           _, example_serialized = reader.read(filename_queue)
@@ -431,8 +613,10 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
         images_and_labels = []
         for thread_id in range(num_preprocess_threads):
             # Parse a serialized Example proto to extract the image and metadata.
-            image_buffer, label_index, points, _ = parse_example_proto(
-                example_serialized)
+            image_buffer, label_index, points, _ = stats.stage(
+                'parse', example_serialized,
+                parse_example_proto(example_serialized))
+            raw = [image_buffer, points]
             # read back points
             with tf.name_scope('points_readout'):
               points = tf.decode_raw(points, out_type=tf.int64)
@@ -443,21 +627,27 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
             with tf.name_scope('images_readout'):
               image_buffer = tf.decode_raw(image_buffer, out_type=tf.uint8)
               image_buffer = tf.reshape(image_buffer, [230, 230, 3])
-              image_buffer = tf.image.convert_image_dtype(image_buffer, tf.float32)
+
+            image_buffer, points = stats.stage('decode', raw,
+                                               [image_buffer, points])
 
             if not thread_id: tf.summary.image('original_image', tf.expand_dims(image_buffer, 0))
-            image_buffer, points = _ramdom_flip_image_point(image_buffer, points, train)
-            if not thread_id: tf.summary.image('flipped_image', tf.expand_dims(image_buffer, 0))
-            bbox = [0., 0., 1., 1.]
-            image_buffer = image_preprocessing(image_buffer, bbox, train, thread_id)
-            image = extract_feature_points(image_buffer, points, train)
-            if not thread_id: tf.summary.image('divided_final', image)
-            images_and_labels.append([image, label_index])
-
-        images, label_index_batch = tf.train.batch_join(
+            images_and_labels.append(stats.count(
+                'batch_queue/enqueue', [image_buffer, points, label_index]))
+
+        image_batch, points_batch, label_index_batch = tf.train.batch_join(
             images_and_labels,
             batch_size=batch_size,
             capacity=2 * num_preprocess_threads * batch_size)
+        image_batch = stats.count('batch_queue/dequeue', image_batch,
+                                  batch_size)
+
+        # Flip, cut and distort once per batch rather than once per example.
+        images = stats.stage('augment', [image_batch, points_batch],
+                             augment_batch(image_batch, points_batch, train,
+                                           seed=FLAGS.augmentation_seed))
+        stats.mark_batch_ready([images, label_index_batch])
+        tf.summary.image('divided_final', images[0])
 
         # Reshape images into these desired dimensions.
         height = FLAGS.image_size
@@ -471,3 +661,508 @@ def batch_inputs(dataset, batch_size, train, num_preprocess_threads=None,
         tf.summary.image('images', images[0])
 
         return images, tf.reshape(label_index_batch, [batch_size])
+
+
+def _parse_example_batch(examples_serialized):
+    """Parses and decodes a batch of serialized Example protos.
+
+    Batched counterpart of parse_example_proto plus the points and images
+    readout of batch_inputs.
+
+    Args:
+      examples_serialized: 1-D Tensor tf.string of serialized Example protos.
+
+    Returns:
+      images: 4-D uint8 Tensor [batch, 230, 230, 3].
+      points: 3-D int32 Tensor [batch, 13, 2].
+      labels: 1-D int64 Tensor [batch].
+    """
+    feature_map = {
+        'image/data': tf.FixedLenFeature([], dtype=tf.string,
+                                         default_value=""),
+        'image/class/label': tf.FixedLenFeature([1], dtype=tf.int64,
+                                                default_value=-1),
+        'image/points': tf.FixedLenFeature([], dtype=tf.string,
+                                           default_value="")
+    }
+    features = tf.parse_example(examples_serialized, feature_map)
+
+    with tf.name_scope('points_readout'):
+        points = tf.decode_raw(features['image/points'], out_type=tf.int64)
+        points = tf.to_int32(tf.reshape(points, [-1, 13, 2]))
+
+    with tf.name_scope('images_readout'):
+        images = tf.decode_raw(features['image/data'], out_type=tf.uint8)
+        images = tf.reshape(images, [-1, 230, 230, 3])
+
+    labels = tf.reshape(features['image/class/label'], [-1])
+    return images, points, labels
+
+
+def _parse_patch_batch(examples_serialized):
+    """Parses a batch of serialized patch records.
+
+    Args:
+      examples_serialized: 1-D Tensor tf.string of serialized Example protos
+        written by patch_records.py.
+
+    Returns:
+      patches: 5-D uint8 Tensor [batch, 13, size, size, 3] where size is
+        FLAGS.patch_record_size.
+      labels: 1-D int64 Tensor [batch].
+    """
+    size = FLAGS.patch_record_size
+    feature_map = {
+        'image/patches': tf.FixedLenFeature([], dtype=tf.string,
+                                            default_value=""),
+        'image/class/label': tf.FixedLenFeature([1], dtype=tf.int64,
+                                                default_value=-1),
+    }
+    features = tf.parse_example(examples_serialized, feature_map)
+
+    with tf.name_scope('patches_readout'):
+        patches = tf.decode_raw(features['image/patches'], out_type=tf.uint8)
+        patches = tf.reshape(patches, [-1, 13, size, size, 3])
+
+    labels = tf.reshape(features['image/class/label'], [-1])
+    return patches, labels
+
+
+def augment_patch_batch(patches, train, seed=None, scope=None):
+    """augment_batch for the stored patches of patch records.
+
+    Each stored patch covers the PATCH_WINDOW x PATCH_WINDOW training window
+    around its point, so the same windows as extract_feature_points_batch are
+    cut from it, and mirroring a patch is the same as cutting it from the
+    flipped image.
+
+    Args:
+      patches: 5-D uint8 Tensor [batch, 13, size, size, 3].
+      train: boolean
+      seed: optional integer seed of all random ops.
+      scope: Optional scope for name_scope.
+    Returns:
+      5-D float Tensor [batch, 13, image_size, image_size, 3] in [-1, 1],
+      or color standardized with --color_standardization.
+    """
+    with tf.name_scope(scope, 'augment_patch_batch', [patches]):
+        size = FLAGS.image_size
+        patches = tf.image.convert_image_dtype(patches, tf.float32)
+        batch = tf.shape(patches)[0]
+        stored = patches.get_shape().as_list()[2:]
+        patches = tf.reshape(patches, [-1] + stored)
+        num_boxes = tf.shape(patches)[0]
+        if train:
+          mask = tf.random_uniform([batch], 0, 1.0, seed=seed) < 0.5
+          mask = tf.reshape(tf.tile(tf.expand_dims(mask, 1), [1, 13]), [-1])
+          patches = tf.where(mask, tf.reverse(patches, axis=[2]), patches)
+
+        center = tf.fill([num_boxes, 2], float(PATCH_WINDOW // 2))
+        x, y, span = _patch_windows(center, train, _offset_seed(seed, 10))
+        # Stored pixels sample the window edge to edge.
+        scale = float(PATCH_WINDOW - 1)
+        boxes = tf.stack([y / scale, x / scale, (y + span) / scale,
+                          (x + span) / scale], axis=1)
+        patches = tf.image.crop_and_resize(patches, boxes, tf.range(num_boxes),
+                                           [size, size],
+                                           extrapolation_value=0.5)
+        patches = tf.reshape(patches, [batch, 13, size, size, 3])
+        if train:
+          patches = distort_color_batch(patches, seed=_offset_seed(seed, 20))
+        return _rescale_batch(patches)
+
+
+def dataset_inputs(dataset, batch_size, train, num_readers=None):
+    """Contruct batches of training or evaluation examples with tf.data.
+
+    Produces the same tensors as batch_inputs from one streaming dataset:
+    shards are read by parallel interleaved readers, serialized examples are
+    shuffled and batched, and parsing plus augment_batch run once per batch in
+    a parallel map whose parallelism is autotuned. Nothing is duplicated per
+    thread and no queue runners are needed.
+
+    Args:
+      dataset: instance of Dataset class specifying the dataset.
+        See dataset.py for details.
+      batch_size: integer
+      train: boolean
+      num_readers: integer, number of shards read in parallel
+
+    Returns:
+      images: 5-D float Tensor [batch_size, 13, image_size, image_size, 3]
+      labels: 1-D integer Tensor of [batch_size].
+    """
+    if num_readers is None:
+      num_readers = FLAGS.num_readers
+
+    if num_readers < 1:
+      raise ValueError('Please make num_readers at least 1')
+
+    autotune = tf.data.experimental.AUTOTUNE
+    with tf.name_scope('dataset_processing'):
+        shards = _task_shards(FLAGS.record_format, train)
+        if not shards:
+          raise ValueError('No data files found for this dataset')
+        if train and FLAGS.indexed_shuffle:
+          # Positioned reads in the order of one permutation per epoch.
+          sampler = record_index.IndexedRecordSampler(
+              shards, seed=FLAGS.augmentation_seed)
+          records = tf.data.Dataset.from_generator(sampler, tf.string,
+                                                   tf.TensorShape([]))
+        else:
+          files = tf.data.Dataset.from_tensor_slices(shards)
+          if train:
+            files = files.shuffle(len(shards))
+          files = files.repeat()
+          records = files.apply(tf.data.experimental.parallel_interleave(
+              tf.data.TFRecordDataset, cycle_length=num_readers,
+              sloppy=train))
+
+        if train and not FLAGS.indexed_shuffle:
+          # Same mixing as the RandomShuffleQueue of batch_inputs.
+          examples_per_shard = 1024
+          records = records.shuffle(
+              examples_per_shard * FLAGS.input_queue_memory_factor)
+
+        records = records.batch(batch_size, drop_remainder=True)
+
+        def preprocess_batch(examples_serialized):
+            if FLAGS.record_format == 'patches':
+              patches, labels = _parse_patch_batch(examples_serialized)
+              images = augment_patch_batch(patches, train,
+                                           seed=FLAGS.augmentation_seed)
+              return images, labels
+            images, points, labels = _parse_example_batch(examples_serialized)
+            images = augment_batch(images, points, train,
+                                   seed=FLAGS.augmentation_seed,
+                                   add_summaries=False)
+            return images, labels
+
+        batches = records.map(preprocess_batch, num_parallel_calls=autotune)
+        batches = batches.prefetch(autotune)
+        images, labels = batches.make_one_shot_iterator().get_next()
+        # tf.data does not expose its buffers; the step split shows whether
+        # training waits for it.
+        stats = pipeline_stats.PipelineStats(FLAGS.instrument_pipeline)
+        images = stats.count('dataset/dequeue', images, batch_size)
+        stats.mark_batch_ready([images, labels])
+
+        height = FLAGS.image_size
+        width = FLAGS.image_size
+        depth = 3
+        images = tf.reshape(images,
+                            shape=[batch_size, 13, height, width, depth])
+
+        # Display the training images in the visualizer.
+        tf.summary.image('images', images[0])
+
+        return images, tf.reshape(labels, [batch_size])
+
+
+def _keyed_records(filename):
+    """Records of one shard with their '<shard>:<record number>' keys."""
+    records = tf.data.TFRecordDataset(filename)
+    numbers = tf.data.Dataset.range(tf.int64.max)
+    return tf.data.Dataset.zip((numbers, records)).map(
+        lambda number, record: (
+            tf.string_join([filename, tf.as_string(number)], separator=':'),
+            record))
+
+
+def ordered_inputs(dataset, batch_size, num_readers=None):
+    """Contruct evaluation batches of every record, in a deterministic order.
+
+    Shards are read in parallel but interleaved round robin in sorted shard
+    order, every record is read exactly once (no epoch wraparound, the last
+    batch may be smaller) and no random op runs, so two runs yield the same
+    keys, images and labels in the same order.
+
+    Args:
+      dataset: instance of Dataset class specifying the dataset.
+        See dataset.py for details.
+      batch_size: integer
+      num_readers: integer, number of shards read in parallel
+
+    Returns:
+      keys: 1-D string Tensor [batch] of '<shard>:<record number>' keys.
+      images: 5-D float Tensor [batch, 13, image_size, image_size, 3]
+      labels: 1-D integer Tensor of [batch].
+    """
+    if num_readers is None:
+      num_readers = FLAGS.num_readers
+
+    if num_readers < 1:
+      raise ValueError('Please make num_readers at least 1')
+
+    autotune = tf.data.experimental.AUTOTUNE
+    with tf.name_scope('ordered_processing'):
+        shards = record_index.shard_files(DATA_FILES[FLAGS.record_format])
+        if not shards:
+          raise ValueError('No data files found for this dataset')
+        files = tf.data.Dataset.from_tensor_slices(shards)
+        records = files.apply(tf.data.experimental.parallel_interleave(
+            _keyed_records, cycle_length=num_readers, sloppy=False))
+        records = records.batch(batch_size)
+
+        def preprocess_batch(keys, examples_serialized):
+            if FLAGS.record_format == 'patches':
+              patches, labels = _parse_patch_batch(examples_serialized)
+              return keys, augment_patch_batch(patches, False), labels
+            images, points, labels = _parse_example_batch(examples_serialized)
+            images = augment_batch(images, points, False, add_summaries=False)
+            return keys, images, labels
+
+        # map keeps the order of its input, whatever its parallelism.
+        batches = records.map(preprocess_batch, num_parallel_calls=autotune)
+        batches = batches.prefetch(autotune)
+        keys, images, labels = batches.make_one_shot_iterator().get_next()
+
+        size = FLAGS.image_size
+        images = tf.reshape(images, shape=[-1, 13, size, size, 3])
+        return keys, images, tf.reshape(labels, [-1])
+
+
+def _cache_fields(stage):
+    """Per-record shape and dtype of the cached fields of stage."""
+    if FLAGS.record_format == 'patches':
+      size = FLAGS.patch_record_size
+      return {'patches': ((13, size, size, 3), np.uint8),
+              'labels': ((), np.int64)}
+    if stage == 'eval_patches':
+      size = FLAGS.image_size
+      return {'patches': ((13, size, size, 3), np.uint8),
+              'labels': ((), np.int64)}
+    return {'images': ((230, 230, 3), np.uint8),
+            'points': ((13, 2), np.int32),
+            'labels': ((), np.int64)}
+
+
+def _materialize_stage(shards, stage, num_records, batch_size=256):
+    """Yield dicts of the cached fields of the records of shards, in order.
+
+    Runs the deterministic stages in a graph and session of their own: the
+    parse and decode of every record and, for the 'eval_patches' stage, the
+    eval patch extraction of augment_batch, whose output is rounded to uint8.
+    This happens while the input graph is built, before training starts, so
+    progress out of num_records is printed every 10 seconds.
+    """
+    with tf.Graph().as_default():
+        records = tf.data.Dataset.from_tensor_slices(shards)
+        records = records.flat_map(tf.data.TFRecordDataset).batch(batch_size)
+
+        def deterministic_stages(examples_serialized):
+            if FLAGS.record_format == 'patches':
+              patches, labels = _parse_patch_batch(examples_serialized)
+              return {'patches': patches, 'labels': labels}
+            images, points, labels = _parse_example_batch(examples_serialized)
+            if stage == 'decoded':
+              return {'images': images, 'points': points, 'labels': labels}
+            patches = extract_feature_points_batch(
+                tf.image.convert_image_dtype(images, tf.float32), points,
+                False, extrapolation_value=0.5)
+            patches = tf.image.convert_image_dtype(patches, tf.uint8,
+                                                   saturate=True)
+            return {'patches': patches, 'labels': labels}
+
+        batch = records.map(deterministic_stages,
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        batch = batch.prefetch(2).make_one_shot_iterator().get_next()
+        done = 0
+        start = last_report = time.time()
+        with tf.Session() as sess:
+          while True:
+            try:
+              values = sess.run(batch)
+            except tf.errors.OutOfRangeError:
+              break
+            done += len(values['labels'])
+            now = time.time()
+            if now - last_report > 10:
+              last_report = now
+              print('%s cache: %d of %d records, %.1f records/sec' % (
+                  stage, done, num_records, done / (now - start)))
+              sys.stdout.flush()
+            yield values
+        print('%s cache: built %d records in %.1f sec' % (
+            stage, done, time.time() - start))
+
+
+def cached_inputs(dataset, batch_size, train):
+    """Contruct batches of training or evaluation examples from the cache.
+
+    The deterministic stages run once over the shards of this task, into a
+    preprocess_cache.PreprocessCache in --preprocess_cache: decoded images
+    and points for training, the finished uint8 eval patches for evaluation,
+    and the parsed patches of patch records. The build runs when this
+    function is called and prints its progress. Every epoch after that, and
+    every evaluation run, streams batches from the memory-mapped cache, or
+    from memory when it fits in --preprocess_cache_ram_mb, and applies only
+    the random stages: flips, patch jitter and color distortion, then the
+    rescale or color standardization. Changing a shard or any parameter of
+    the cached stages rebuilds the cache.
+
+    For face records in train mode the cache holds the full 230x230x3
+    images, because the flip comes before the patch cut. It only saves the
+    read, parse and decode of each record; the patch cut and the color
+    distortion still run every step. Caching the 79 px training windows
+    instead would take 13 * 79 * 79 pixels per record, more than the face
+    itself. Patch records (--record_format=patches) are the smaller
+    per-window format.
+
+    Args:
+      dataset: instance of Dataset class specifying the dataset.
+        See dataset.py for details.
+      batch_size: integer
+      train: boolean
+
+    Returns:
+      images: 5-D float Tensor [batch_size, 13, image_size, image_size, 3]
+      labels: 1-D integer Tensor of [batch_size].
+    """
+    autotune = tf.data.experimental.AUTOTUNE
+    with tf.name_scope('cached_processing'):
+        shards = _task_shards(FLAGS.record_format, train)
+        if not shards:
+          raise ValueError('No data files found for this dataset')
+        if FLAGS.record_format == 'patches':
+          stage = 'patches'
+          params = {'patch_record_size': FLAGS.patch_record_size}
+        elif train:
+          stage = 'decoded'
+          params = {}
+        else:
+          stage = 'eval_patches'
+          params = {'image_size': FLAGS.image_size}
+        fields = _cache_fields(stage)
+        cache = preprocess_cache.PreprocessCache(FLAGS.preprocess_cache, shards,
+                                                 stage, params)
+        if not cache.valid():
+          counts = [len(record_index.load_index(s)) for s in shards]
+          print('Building the %s cache of %d records in %s' % (
+              stage, sum(counts), FLAGS.preprocess_cache))
+          cache.build(fields, counts,
+                      _materialize_stage(shards, stage, sum(counts)))
+        arrays = cache.open(FLAGS.preprocess_cache_ram_mb << 20)
+        names = sorted(fields)
+        num_records = len(arrays['labels'])
+        if num_records < batch_size:
+          raise ValueError('Fewer records than one batch in the cache')
+
+        def cached_batches():
+            rng = np.random.RandomState(FLAGS.augmentation_seed)
+            while True:
+              order = rng.permutation(num_records) if train else None
+              for start in range(0, num_records - batch_size + 1, batch_size):
+                if train:
+                  # Sorted, the rows of one batch are read front to back.
+                  rows = np.sort(order[start:start + batch_size])
+                else:
+                  rows = slice(start, start + batch_size)
+                yield tuple(arrays[name][rows] for name in names)
+
+        batches = tf.data.Dataset.from_generator(
+            cached_batches,
+            tuple(tf.as_dtype(fields[name][1]) for name in names),
+            tuple(tf.TensorShape([batch_size] + list(fields[name][0]))
+                  for name in names))
+
+        def random_stages(*values):
+            cached = dict(zip(names, values))
+            labels = cached['labels']
+            if stage == 'patches':
+              images = augment_patch_batch(cached['patches'], train,
+                                           seed=FLAGS.augmentation_seed)
+            elif stage == 'eval_patches':
+              images = _rescale_batch(
+                  tf.image.convert_image_dtype(cached['patches'], tf.float32))
+            else:
+              images = augment_batch(cached['images'], cached['points'], True,
+                                     seed=FLAGS.augmentation_seed,
+                                     add_summaries=False)
+            return images, labels
+
+        batches = batches.map(random_stages, num_parallel_calls=autotune)
+        batches = batches.prefetch(autotune)
+        images, labels = batches.make_one_shot_iterator().get_next()
+        stats = pipeline_stats.PipelineStats(FLAGS.instrument_pipeline)
+        images = stats.count('cache/dequeue', images, batch_size)
+        stats.mark_batch_ready([images, labels])
+
+        size = FLAGS.image_size
+        images = tf.reshape(images, shape=[batch_size, 13, size, size, 3])
+        tf.summary.image('images', images[0])
+        return images, tf.reshape(labels, [batch_size])
+
+
+def online_inputs(dataset, batch_size):
+    """Contruct training batches from photos realigned online.
+
+    An online_alignment.AlignmentRing realigns the photos of
+    --alignment_data_dir with random alignment jitter in --alignment_workers
+    processes; the ring slots are read in place by a generator dataset and
+    augment_batch adds the usual flips, patch jitter and color distortion.
+    The ring shuts down when the process exits.
+
+    The generator may hand tf.data views of the shared memory without a
+    copy, which stay in use until augment_batch has turned them into new
+    tensors. The map therefore runs a fixed number of batches at once, and
+    the ring holds the slots of that many batches, plus one, before handing
+    them back to the workers.
+
+    Args:
+      dataset: instance of Dataset class specifying the dataset.
+        See dataset.py for details.
+      batch_size: integer
+
+    Returns:
+      images: 5-D float Tensor [batch_size, 13, image_size, image_size, 3]
+      labels: 1-D integer Tensor of [batch_size].
+    """
+    import dlib
+    import face_runtime
+    import online_alignment
+    base_shape = face_runtime.load_base_shape(
+        dlib.get_frontal_face_detector(),
+        dlib.shape_predictor(FLAGS.alignment_predictor_path),
+        FLAGS.alignment_base_face, FLAGS.alignment_upsample)
+    photos = [(filename, label) for filename, label, _ in
+              face_runtime.find_image_files(FLAGS.alignment_data_dir,
+                                            FLAGS.alignment_labels_file)]
+    photos = photos[FLAGS.task_index::FLAGS.num_tasks]
+    ring = online_alignment.AlignmentRing(
+        photos, base_shape, batch_size, FLAGS.alignment_landmark_cache,
+        FLAGS.alignment_predictor_path, FLAGS.alignment_upsample,
+        FLAGS.alignment_workers,
+        FLAGS.alignment_slots, FLAGS.alignment_max_rotation,
+        FLAGS.alignment_max_scale, FLAGS.alignment_max_shift,
+        FLAGS.augmentation_seed)
+    atexit.register(ring.close)
+
+    # Batches augment_batch reads from ring slots at once.
+    map_calls = 2
+    autotune = tf.data.experimental.AUTOTUNE
+    with tf.name_scope('online_processing'):
+        batches = tf.data.Dataset.from_generator(
+            lambda: ring.batches(hold=map_calls + 1),
+            (tf.uint8, tf.int32, tf.int64),
+            (tf.TensorShape([batch_size, 230, 230, 3]),
+             tf.TensorShape([batch_size, 13, 2]),
+             tf.TensorShape([batch_size])))
+
+        def random_stages(images, points, labels):
+            images = augment_batch(images, points, True,
+                                   seed=FLAGS.augmentation_seed,
+                                   add_summaries=False)
+            return images, labels
+
+        batches = batches.map(random_stages, num_parallel_calls=map_calls)
+        batches = batches.prefetch(autotune)
+        images, labels = batches.make_one_shot_iterator().get_next()
+        stats = pipeline_stats.PipelineStats(FLAGS.instrument_pipeline)
+        images = stats.count('online/dequeue', images, batch_size)
+        stats.mark_batch_ready([images, labels])
+
+        size = FLAGS.image_size
+        images = tf.reshape(images, shape=[batch_size, 13, size, size, 3])
+        tf.summary.image('images', images[0])
+        return images, tf.reshape(labels, [batch_size])
@@ -0,0 +1,177 @@
+"""Content-addressed cache of dlib face detections and landmarks.
+
+ dlib detection and the 68-point shape predictor are by far the most
+ expensive part of building the aligned data set. This cache keeps their
+ output keyed by the SHA-1 of the image file bytes, so every photo goes
+ through dlib once no matter how often the data set is rebuilt.
+
+ A cache lives in a sub-directory named after the hash of the predictor model
+ file, so replacing the model invalidates every entry:
+
+   cache_dir/<model hash>/index       append-only (digest, found) records
+   cache_dir/<model hash>/landmarks   memory-mapped (box, 68 points) records
+
+ Row i of the landmarks file belongs to record i of the index. Writers append
+ the landmarks row before the index record while holding an exclusive lock on
+ the index, so any number of processes can append concurrently and readers,
+ which never lock, only ever see complete rows.
+
+ Usage:
+   cache = LandmarkCache('./landmark_cache', predictor_path)
+   entry = cache.get(data)
+   if entry is None:
+     box, shape = detect(...)
+     cache.put(data, box, shape)
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+
+NUM_LANDMARKS = 68
+
+INDEX_DTYPE = np.dtype([('digest', 'V20'), ('found', 'u1'), ('pad', 'V3')])
+ROW_DTYPE = np.dtype([('box', '<i4', (4,)),
+                      ('points', '<i2', (NUM_LANDMARKS, 2))])
+
+
+def digest(data):
+  """SHA-1 digest of image file bytes, the cache key."""
+  return hashlib.sha1(data).digest()
+
+
+def model_digest(predictor_path):
+  """Hex digest identifying the predictor model file."""
+  h = hashlib.sha1()
+  with open(predictor_path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      h.update(block)
+  return h.hexdigest()[:16]
+
+
+class LandmarkCache(object):
+  """Persistent landmark store shared by concurrent readers and writers."""
+
+  def __init__(self, cache_dir, predictor_path):
+    self.path = os.path.join(cache_dir, model_digest(predictor_path))
+    if not os.path.isdir(self.path):
+      try:
+        os.makedirs(self.path)
+      except OSError:
+        if not os.path.isdir(self.path):
+          raise
+    self._index_path = os.path.join(self.path, 'index')
+    self._data_path = os.path.join(self.path, 'landmarks')
+    for p in (self._index_path, self._data_path):
+      open(p, 'ab').close()
+
+    self._rows = {}
+    self._found = []
+    self._data = None
+    self._mapped = 0
+    self.refresh()
+
+  def __len__(self):
+    return len(self._found)
+
+  def __contains__(self, data):
+    return self.get(data) is not None
+
+  def refresh(self):
+    """Pick up records appended by other processes.
+
+    Returns:
+      number of new records.
+    """
+    size = os.path.getsize(self._index_path)
+    count = size // INDEX_DTYPE.itemsize
+    start = len(self._found)
+    if count <= start:
+      return 0
+    with open(self._index_path, 'rb') as f:
+      f.seek(start * INDEX_DTYPE.itemsize)
+      new = np.frombuffer(f.read((count - start) * INDEX_DTYPE.itemsize),
+                          dtype=INDEX_DTYPE)
+    for i, record in enumerate(new):
+      self._rows.setdefault(record['digest'].tobytes(), start + i)
+    self._found.extend(new['found'].astype(bool))
+    return count - start
+
+  def _row(self, i):
+    if i >= self._mapped:
+      count = len(self._found)
+      self._data = np.memmap(self._data_path, dtype=ROW_DTYPE, mode='r',
+                             shape=(count,))
+      self._mapped = count
+    return self._data[i]
+
+  def get(self, data):
+    """Look up the landmarks of an image.
+
+    Args:
+      data: bytes of the image file.
+    Returns:
+      None if the image is not cached. Otherwise a (box, points) tuple with
+      the [left, top, right, bottom] detection box and the (68, 2) landmarks,
+      both None if dlib found no face in the image.
+    """
+    return self.get_digest(digest(data))
+
+  def get_digest(self, key):
+    """Like get, for an image identified by its digest."""
+    i = self._rows.get(key)
+    if i is None and self.refresh():
+      i = self._rows.get(key)
+    if i is None:
+      return None
+    if not self._found[i]:
+      return None, None
+    row = self._row(i)
+    return np.array(row['box']), row['points'].astype(float)
+
+  def put(self, data, box, points):
+    """Append the landmarks of an image.
+
+    Args:
+      data: bytes of the image file.
+      box: [left, top, right, bottom] of the detection, None if no face.
+      points: (68, 2) landmarks, None if no face.
+    """
+    self.put_digest(digest(data), box, points)
+
+  def put_digest(self, key, box, points):
+    """Like put, for an image identified by its digest."""
+    row = np.zeros(1, dtype=ROW_DTYPE)
+    record = np.zeros(1, dtype=INDEX_DTYPE)
+    record['digest'] = np.void(key)
+    if box is not None:
+      row['box'] = box
+      row['points'] = np.rint(points)
+      record['found'] = 1
+
+    with open(self._index_path, 'ab') as index:
+      fcntl.flock(index, fcntl.LOCK_EX)
+      try:
+        self.refresh()
+        if key in self._rows:
+          return
+        count = len(self._found)
+        with open(self._data_path, 'r+b') as f:
+          # Drop a partial row left behind by a writer that died.
+          f.truncate(count * ROW_DTYPE.itemsize)
+          f.seek(0, os.SEEK_END)
+          f.write(row.tobytes())
+        index.write(record.tobytes())
+        index.flush()
+      finally:
+        fcntl.flock(index, fcntl.LOCK_UN)
+    self.refresh()
+
+  def close(self):
+    self._data = None
+    self._mapped = 0
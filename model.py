@@ -5,36 +5,176 @@ from __future__ import print_function
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 
-def model(inputs, batch_size, train):
+NUM_PATCHES = 13
+TOWER_OUTPUTS = 240
+
+# (num_outputs, kernel, padding, activation) of the _submodel convolutions
+_TOWER_CONVS = [(10, 3, 'VALID', tf.nn.elu),
+                (20, 3, 'VALID', tf.nn.elu),
+                (30, 3, 'VALID', tf.nn.elu),
+                (30, 2, 'SAME', None)]
+
+
+def model(inputs, batch_size, train, mode='towers'):
+    """Build the patch network.
+
+    Args:
+      inputs: 5-D float Tensor [batch, 13, 30, 30, 3] of patches.
+      batch_size: unused, the batch dimension is taken from inputs.
+      train: boolean, apply dropout.
+      mode: how the 13 patch towers are computed:
+        'towers': 13 independent _submodel towers, one op chain each.
+        'grouped': the same per-patch weights (and variable names, so the
+          same checkpoints), computed as one batched matmul per layer.
+        'folded': patches folded into the batch dimension and run through
+          one tower with shared weights.
+
+    Returns:
+      2-D float Tensor [batch, 600] of logits.
+    """
     with tf.name_scope('model'):
+        flat = features(inputs, mode)
+        if(train):
+            flat = tf.nn.dropout(flat, keep_prob=0.5)
+        return slim.fully_connected(flat, 600) # classify 500
+
+
+def features(inputs, mode='towers'):
+    """The concatenated outputs of the 13 towers, input of the classifier.
+
+    Args:
+      inputs: 5-D float Tensor [batch, 13, 30, 30, 3] of patches.
+      mode: how the 13 patch towers are computed, see model.
+
+    Returns:
+      2-D float Tensor [batch, 240*13].
+    """
+    if mode == 'towers':
         splits = tf.unstack(inputs, axis=1)
         # results = map(lambda e: _submodel(e, batch_size), splits)
 
         results = []
         for i, e in enumerate(splits):
             with tf.name_scope("submodel_%d" % i):
-                r = _submodel(e, batch_size=batch_size)
+                r = _submodel(e, batch_size=tf.shape(e)[0])
                 results.append(r)
 
         results = tf.stack(results, axis=1)
-        flat = tf.reshape(results, [batch_size, 240*13])
-        if(train):
-            flat = tf.nn.dropout(flat, keep_prob=0.5)
-        return slim.fully_connected(flat, 600) # classify 500
+    elif mode == 'grouped':
+        results = _grouped_submodels(inputs)
+    elif mode == 'folded':
+        shape = inputs.get_shape().as_list()
+        folded = tf.reshape(inputs, [-1] + shape[2:])
+        with tf.name_scope("submodel"):
+            results = _submodel(folded, batch_size=tf.shape(folded)[0])
+    else:
+        raise ValueError('Unknown model mode %r' % mode)
+
+    return tf.reshape(results, [-1, TOWER_OUTPUTS*NUM_PATCHES])
 
 
 def _submodel(images, batch_size): #imgsize = 30x30
     with slim.arg_scope([slim.conv2d, slim.fully_connected],
                         activation_fn=tf.nn.elu):
         l1 = slim.conv2d(images, 10, [3, 3], padding='VALID') #28x28
-        p1 = slim.max_pool2d(l1, [2, 2]) #14x14 #model/submodel_n/MaxPool2D/MaxPool:0
+        # model/submodel_n/MaxPool2D/MaxPool:0
+        p1 = slim.max_pool2d(l1, [2, 2]) #14x14
         l2 = slim.conv2d(p1, 20, [3, 3], padding='VALID') #12x12
         p2 = slim.max_pool2d(l2, [2, 2]) #6x6
         l3 = slim.conv2d(p2, 30, [3, 3], padding='VALID') #4x4
         p3 = slim.max_pool2d(l3, [2, 2]) #2x2
         l3 = slim.conv2d(p3, 30, [2, 2], activation_fn=None) #2x2
         flat = tf.concat([tf.reshape(p3, [batch_size, -1]) , tf.reshape(l3, [batch_size, -1])], 1)
-        print(flat.shape)
         flat2 = slim.fully_connected(flat, 240)
 
     return flat2
+
+
+def _layer_variables(default_name, weights_shape):
+    # Same scopes, names and initializers as slim.conv2d/fully_connected, so
+    # the variables line up with the ones _submodel creates.
+    with tf.variable_scope(None, default_name=default_name):
+        weights = slim.model_variable(
+            'weights', shape=weights_shape,
+            initializer=tf.contrib.layers.xavier_initializer())
+        biases = slim.model_variable(
+            'biases', shape=weights_shape[-1:],
+            initializer=tf.zeros_initializer())
+    return weights, biases
+
+
+def _tower_variables(channels):
+    """Create the variables of the 13 towers in _submodel order.
+
+    Returns:
+      list of (weights, biases) per layer, stacked over the towers, with the
+      conv kernels flattened to [13, kernel*kernel*in, out].
+    """
+    towers = []
+    for _ in range(NUM_PATCHES):
+        layers = []
+        depth = channels
+        for num_outputs, kernel, _, _ in _TOWER_CONVS:
+            w, b = _layer_variables('Conv', [kernel, kernel, depth,
+                                             num_outputs])
+            layers.append((tf.reshape(w, [-1, num_outputs]), b))
+            depth = num_outputs
+        layers.append(_layer_variables('fully_connected',
+                                       [TOWER_OUTPUTS, TOWER_OUTPUTS]))
+        towers.append(layers)
+
+    return [(tf.stack([t[i][0] for t in towers]),
+             tf.stack([t[i][1] for t in towers]))
+            for i in range(len(towers[0]))]
+
+
+def _grouped_conv(x, weights, biases, kernel, padding, activation_fn):
+    """Convolve each of the 13 groups of x with its own kernel.
+
+    Args:
+      x: 5-D Tensor [13, batch, height, width, depth].
+      weights: [13, kernel*kernel*depth, out] flattened kernels.
+      biases: [13, out].
+    Returns:
+      5-D Tensor [13, batch, height', width', out].
+    """
+    shape = x.get_shape().as_list()
+    patches = tf.extract_image_patches(
+        tf.reshape(x, [-1] + shape[2:]), ksizes=[1, kernel, kernel, 1],
+        strides=[1, 1, 1, 1], rates=[1, 1, 1, 1], padding=padding)
+    out_shape = patches.get_shape().as_list()[1:3] + [
+        weights.get_shape().as_list()[-1]]
+    patches = tf.reshape(patches, [NUM_PATCHES, -1, patches.shape[-1].value])
+    y = tf.matmul(patches, weights) + tf.expand_dims(biases, 1)
+    if activation_fn is not None:
+        y = activation_fn(y)
+    return tf.reshape(y, [NUM_PATCHES, -1] + out_shape)
+
+
+def _grouped_max_pool(x):
+    shape = x.get_shape().as_list()
+    y = slim.max_pool2d(tf.reshape(x, [-1] + shape[2:]), [2, 2])
+    return tf.reshape(y, [NUM_PATCHES, -1] + y.get_shape().as_list()[1:])
+
+
+def _grouped_submodels(inputs):
+    """All 13 _submodel towers with per-patch weights as one computation.
+
+    Args:
+      inputs: 5-D float Tensor [batch, 13, 30, 30, 3].
+    Returns:
+      3-D float Tensor [batch, 13, 240], equal to the stacked towers.
+    """
+    variables = _tower_variables(inputs.get_shape().as_list()[-1])
+    x = tf.transpose(inputs, [1, 0, 2, 3, 4])
+    for (w, b), (_, kernel, padding, activation_fn) in zip(variables[:3],
+                                                            _TOWER_CONVS[:3]):
+        x = _grouped_conv(x, w, b, kernel, padding, activation_fn)
+        x = _grouped_max_pool(x)
+    (w, b), (_, kernel, padding, activation_fn) = variables[3], _TOWER_CONVS[3]
+    l4 = _grouped_conv(x, w, b, kernel, padding, activation_fn)
+    flat = tf.concat([tf.reshape(x, [NUM_PATCHES, -1, 120]),
+                      tf.reshape(l4, [NUM_PATCHES, -1, 120])], 2)
+    w, b = variables[-1]
+    flat2 = tf.nn.elu(tf.matmul(flat, w) + tf.expand_dims(b, 1))
+    return tf.transpose(flat2, [1, 0, 2])
@@ -0,0 +1,397 @@
+"""Online alignment augmentation through a shared-memory ring buffer.
+
+ The records hold faces aligned once, offline, so training never sees the
+ small rotation, scale and shift errors of the alignment itself. An
+ AlignmentRing realigns the original photos during training instead: worker
+ processes perturb the `util.procrustes` tform of each photo by a random
+ rotation of up to --alignment_max_rotation degrees, scale of up to
+ +-alignment_max_scale and shift of up to --alignment_max_shift pixels about
+ the face center, warp the photo with the fused `util.transform`, and map the
+ landmarks through the same perturbed transform to re-derive the 13 points.
+
+ Batches never get pickled. The ring is one multiprocessing.shared_memory
+ block of --alignment_slots slots, each holding a whole batch,
+
+   images  uint8 [batch, 230, 230, 3]
+   points  int32 [batch, 13, 2]
+   labels  int64 [batch]
+
+ and workers warp straight into a slot. Only slot numbers travel through
+ two queues: `free` slots go to the workers, `ready` slots to the consumer,
+ which reads numpy views of the slot. When all slots are ready the workers
+ block on `free`, which is the backpressure. close() stops the workers,
+ which check for it at least every 0.1 sec, and unlinks the shared memory.
+
+ Slot lifetime: a slot taken by get() stays out of the ring until release()
+ hands it back, oldest first. tf.data may wrap the yielded views without a
+ copy and keeps reading them while later batches are generated, so
+ batches(hold) only releases a slot once `hold` newer batches have been
+ yielded after it; hold must cover every batch the input pipeline can have
+ in flight before its first copy. The labels, which pass through the
+ pipeline untouched, are yielded as a copy.
+
+ Landmarks come from the landmark_cache of build_image_data; photos missing
+ from it are detected with dlib, through face_runtime, once per worker.
+ Neither the module nor its workers import TensorFlow;
+ image_processing.online_inputs feeds the ring to the training input
+ pipeline.
+
+ Usage:
+   python online_alignment.py --predictor_path=... --landmark_cache=... \
+       --workers=8 --batches=200
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import multiprocessing
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import face_runtime
+import landmark_cache
+import util
+
+NUM_POINTS = len(util.FEATURE_POINTS)
+
+
+def _slot_layout(batch_size):
+  """[(name, shape, dtype, offset)] of the arrays of a slot, and its size."""
+  layout = []
+  offset = 0
+  for name, shape, dtype in [
+      ('images', (batch_size, util.FACE_SIZE, util.FACE_SIZE, 3), np.uint8),
+      ('points', (batch_size, NUM_POINTS, 2), np.int32),
+      ('labels', (batch_size,), np.int64)]:
+    layout.append((name, shape, np.dtype(dtype), offset))
+    offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    offset = (offset + 63) // 64 * 64
+  return layout, offset
+
+
+def _slot_views(buf, layout, slot_size, slot):
+  return tuple(np.ndarray(shape, dtype, buffer=buf,
+                          offset=slot * slot_size + offset)
+               for _, shape, dtype, offset in layout)
+
+
+def jitter_tform(tform, z, rng, max_rotation, max_scale, max_shift):
+  """Perturb a procrustes tform about the face center.
+
+  Args:
+    tform: dict as returned by util.procrustes.
+    z: (K, 2) landmarks transformed by tform.
+    rng: numpy RandomState.
+    max_rotation: largest rotation, in degrees.
+    max_scale: largest relative scale change.
+    max_shift: largest shift along each axis, in pixels.
+  Returns:
+    the perturbed tform and the landmarks it maps to.
+  """
+  angle = np.deg2rad(rng.uniform(-max_rotation, max_rotation))
+  rotation = np.array([[np.cos(angle), np.sin(angle)],
+                       [-np.sin(angle), np.cos(angle)]])
+  scale = np.exp(rng.uniform(np.log1p(-max_scale), np.log1p(max_scale)))
+  shift = rng.uniform(-max_shift, max_shift, 2)
+  center = np.full(2, util.FACE_SIZE / 2.)
+
+  def move(p):
+    return scale * np.dot(p - center, rotation) + center + shift
+
+  jittered = {'rotation': np.dot(tform['rotation'], rotation),
+              'scale': tform['scale'] * scale,
+              'translation': move(tform['translation'])}
+  return jittered, move(z)
+
+
+class _Photos(object):
+  """Endless shuffled stream of (photo, landmarks, label) of one worker."""
+
+  def __init__(self, photos, cache_dir, predictor_path, upsample, rng):
+    self._photos = photos
+    self._cache = (landmark_cache.LandmarkCache(cache_dir, predictor_path)
+                   if cache_dir else None)
+    self._predictor_path = predictor_path
+    self._upsample = upsample
+    self._rng = rng
+    self._dlib = None
+    # filename -> landmarks, None without a face.
+    self._shapes = {}
+    self.skipped = 0
+
+  def _detect(self, img):
+    if self._dlib is None:
+      import dlib
+      self._dlib = (dlib.get_frontal_face_detector(),
+                    dlib.shape_predictor(self._predictor_path))
+    return face_runtime.detect_landmarks(img, self._dlib[0], self._dlib[1],
+                                         self._upsample)
+
+  def _load(self, filename):
+    from skimage import io
+    known = filename in self._shapes
+    if not known and self._cache is not None:
+      with open(filename, 'rb') as f:
+        key = landmark_cache.digest(f.read())
+      entry = self._cache.get_digest(key)
+      if entry is not None:
+        self._shapes[filename] = entry[1]
+        known = True
+    if known and self._shapes[filename] is None:
+      return None, None
+    try:
+      img = io.imread(filename)
+    except (IOError, ValueError):
+      img = None
+    if img is None or img.ndim != 3 or img.shape[2] != 3:
+      self._shapes[filename] = None
+      return None, None
+    if not known:
+      box, shape = self._detect(img)
+      if self._cache is not None:
+        self._cache.put_digest(key, box, shape)
+      self._shapes[filename] = shape
+    return img, self._shapes[filename]
+
+  def __iter__(self):
+    while True:
+      found = 0
+      for i in self._rng.permutation(len(self._photos)):
+        filename, label = self._photos[i]
+        img, shape = self._load(filename)
+        if shape is None:
+          self.skipped += 1
+          continue
+        found += 1
+        yield img, shape, label
+      if not found:
+        raise ValueError('No face in any of the %d photos' % len(self._photos))
+
+
+def _produce(shm_name, batch_size, photos, base_shape, cache_dir,
+             predictor_path, upsample, jitter, seed, free, ready, stop,
+             counters):
+  """Worker: fill free slots with realigned batches until stopped."""
+  shm = shared_memory.SharedMemory(name=shm_name)
+  layout, slot_size = _slot_layout(batch_size)
+  views = None
+  try:
+    rng = np.random.RandomState(seed)
+    samples = _Photos(photos, cache_dir, predictor_path, upsample, rng)
+    stream = iter(samples)
+    skipped = 0
+    while not stop.is_set():
+      start = time.time()
+      try:
+        slot = free.get(timeout=0.1)
+      except queue.Empty:
+        with counters.get_lock():
+          counters[2] += time.time() - start
+        continue
+      waited = time.time() - start
+      views = _slot_views(shm.buf, layout, slot_size, slot)
+      images, points, labels = views
+      for j in range(batch_size):
+        img, shape, label = next(stream)
+        _, z, tform = util.procrustes(base_shape, shape)
+        tform, z = jitter_tform(tform, z, rng, *jitter)
+        util.transform(img, tform, fused=True, out=images[j])
+        points[j] = np.clip(np.rint(z[util.FEATURE_POINTS]), 0,
+                            util.FACE_SIZE - 1)
+        labels[j] = label
+      views = images = points = labels = None
+      ready.put(slot)
+      with counters.get_lock():
+        counters[0] += 1
+        counters[1] += batch_size
+        counters[2] += waited
+        counters[3] += samples.skipped - skipped
+      skipped = samples.skipped
+  except Exception:  # pylint: disable=broad-except
+    if not stop.is_set():
+      ready.put(traceback.format_exc())
+  finally:
+    views = None
+    shm.close()
+
+
+class AlignmentRing(object):
+  """Realigned training batches produced by a pool of worker processes."""
+
+  def __init__(self, photos, base_shape, batch_size, cache_dir='',
+               predictor_path='', upsample=1, num_workers=0, num_slots=8,
+               max_rotation=5., max_scale=0.05, max_shift=4., seed=None):
+    """
+    Args:
+      photos: list of (filename, label) of the original photos.
+      base_shape: (68, 2) landmarks of the reference face.
+      batch_size: faces per slot.
+      cache_dir: landmark_cache directory, '' to detect every photo.
+      predictor_path: dlib shape predictor, also the landmark_cache key.
+      upsample: dlib upsampling of the detections of cache misses.
+      num_workers: worker processes, 0 for one per core.
+      num_slots: batches the ring holds.
+      max_rotation, max_scale, max_shift: see jitter_tform.
+      seed: optional seed of the photo order and jitter.
+    """
+    if num_slots < 2:
+      raise ValueError('Please make num_slots at least 2')
+    num_workers = num_workers or multiprocessing.cpu_count()
+    self.batch_size = batch_size
+    self._layout, self._slot_size = _slot_layout(batch_size)
+    self._shm = shared_memory.SharedMemory(create=True,
+                                           size=num_slots * self._slot_size)
+    ctx = multiprocessing.get_context('spawn')
+    self._free = ctx.Queue()
+    self._ready = ctx.Queue()
+    for slot in range(num_slots):
+      self._free.put(slot)
+    self._stop = ctx.Event()
+    # batches, images, producer wait seconds, skipped photos
+    self._counters = ctx.Array('d', 4)
+    self._num_slots = num_slots
+    # Slots taken by get and not yet released, oldest first.
+    self._held = collections.deque()
+    self._consumer_wait = 0.
+    self._closed = False
+    self._start = time.time()
+    seeds = np.random.RandomState(seed).randint(2**31 - 1, size=num_workers)
+    self._workers = []
+    for i in range(num_workers):
+      worker = ctx.Process(
+          target=_produce,
+          args=(self._shm.name, batch_size, photos[i::num_workers],
+                base_shape, cache_dir, predictor_path, upsample,
+                (max_rotation, max_scale, max_shift), seeds[i], self._free,
+                self._ready, self._stop, self._counters))
+      worker.daemon = True
+      worker.start()
+      self._workers.append(worker)
+
+  def get(self):
+    """Views (images, points, labels) of the next ready batch.
+
+    The views stay valid until release() hands their slot back.
+    """
+    start = time.time()
+    while True:
+      try:
+        slot = self._ready.get(timeout=1.)
+        break
+      except queue.Empty:
+        if not any(w.is_alive() for w in self._workers):
+          raise RuntimeError('All alignment workers exited')
+    self._consumer_wait += time.time() - start
+    if not isinstance(slot, int):
+      raise RuntimeError('Alignment worker failed:\n%s' % slot)
+    self._held.append(slot)
+    return _slot_views(self._shm.buf, self._layout, self._slot_size, slot)
+
+  def release(self):
+    """Hand the slot of the oldest batch still held back to the workers."""
+    if self._held:
+      self._free.put(self._held.popleft())
+
+  def batches(self, hold=0):
+    """Generator of the batches, for tf.data.Dataset.from_generator.
+
+    Args:
+      hold: batches yielded before this one whose slots stay held, at least
+        the number of batches the consumer reads concurrently.
+    """
+    if hold + 2 > self._num_slots:
+      raise ValueError('Holding %d batches needs at least %d slots' %
+                       (hold, hold + 2))
+    while not self._closed:
+      while len(self._held) > hold:
+        self.release()
+      images, points, labels = self.get()
+      yield images, points, labels.copy()
+
+  def stats(self):
+    """Throughput and wait metrics since the ring started."""
+    elapsed = max(time.time() - self._start, 1e-6)
+    with self._counters.get_lock():
+      batches, images, producer_wait, skipped = self._counters[:]
+    return {'batches': int(batches), 'images': int(images),
+            'images_per_sec': images / elapsed,
+            # Share of worker time blocked on a full ring: the consumer
+            # is the bottleneck.
+            'producer_wait_fraction':
+                producer_wait / (elapsed * len(self._workers)),
+            # Share of consumer time waiting on an empty ring: the workers
+            # are the bottleneck.
+            'consumer_wait_fraction': self._consumer_wait / elapsed,
+            'ready_batches': self._ready.qsize(),
+            'skipped_photos': int(skipped)}
+
+  def close(self):
+    """Stop the workers and free the shared memory."""
+    if self._closed:
+      return
+    self._closed = True
+    self._stop.set()
+    for worker in self._workers:
+      worker.join(5.)
+      if worker.is_alive():
+        worker.terminate()
+        worker.join()
+    for q in (self._free, self._ready):
+      q.cancel_join_thread()
+      q.close()
+    try:
+      self._shm.close()
+    except BufferError:
+      # A consumer still holds views of a slot; the mapping goes with them.
+      pass
+    self._shm.unlink()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--data_dir', default='./faces')
+  parser.add_argument('--labels_file', default='./labels')
+  parser.add_argument('--predictor_path',
+                      default='./data/shape_predictor_68_face_landmarks.dat')
+  parser.add_argument('--base_face', default='./data/base_face.jpg')
+  parser.add_argument('--landmark_cache', default='')
+  parser.add_argument('--batch_size', type=int, default=32)
+  parser.add_argument('--workers', type=int, default=0)
+  parser.add_argument('--slots', type=int, default=8)
+  parser.add_argument('--batches', type=int, default=200)
+  args = parser.parse_args()
+
+  import dlib
+  base_shape = face_runtime.load_base_shape(
+      dlib.get_frontal_face_detector(),
+      dlib.shape_predictor(args.predictor_path), args.base_face)
+  photos = [(filename, label) for filename, label, _ in
+            face_runtime.find_image_files(args.data_dir, args.labels_file)]
+  with AlignmentRing(photos, base_shape, args.batch_size,
+                     args.landmark_cache, args.predictor_path,
+                     num_workers=args.workers, num_slots=args.slots) as ring:
+    for _ in range(args.batches):
+      ring.get()
+      ring.release()
+    stats = ring.stats()
+  print('%d batches, %.1f images/sec, producers blocked %.0f%%, consumer '
+        'waited %.0f%%, %d photos skipped' % (
+            stats['batches'], stats['images_per_sec'],
+            100 * stats['producer_wait_fraction'],
+            100 * stats['consumer_wait_fraction'], stats['skipped_photos']))
+
+
+if __name__ == '__main__':
+  main()
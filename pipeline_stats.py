@@ -0,0 +1,232 @@
+"""Opt-in instrumentation of the input pipeline.
+
+ The pipeline builders (`image_processing.batch_inputs` and
+ `image_processing.dataset_inputs`) thread their tensors through a
+ `PipelineStats` object, which, when enabled, adds to the graph
+
+   counters of the elements enqueued to and dequeued from each queue,
+   accumulated wall time of each pipeline stage,
+   the time at which each training batch became ready.
+
+ When disabled every method hands its arguments back untouched, so the graph
+ is exactly the uninstrumented one.
+
+ `PipelineMonitorHook` reads those tensors, plus the fill level of every queue
+ in the QUEUE_RUNNERS collection, and exports
+
+   pipeline/<queue>/fill_fraction
+   pipeline/<queue>/enqueue_per_sec, pipeline/<queue>/dequeue_per_sec
+   pipeline/stage/<stage>_ms
+   pipeline/step/input_wait_ms, pipeline/step/compute_ms
+
+ as scalar summaries, and optionally as a Chrome trace (chrome://tracing).
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+
+import tensorflow as tf
+
+COLLECTION = 'pipeline_stats'
+
+
+def _local_variable(name, shape, dtype):
+  return tf.Variable(tf.zeros(shape, dtype=dtype), name=name,
+                     trainable=False,
+                     collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+
+def _flatten(tensors):
+  if isinstance(tensors, (list, tuple)):
+    return [t for e in tensors for t in _flatten(e)]
+  return [tensors]
+
+
+def _after(update, tensors):
+  # Identities of tensors that only become available after update ran.
+  with tf.control_dependencies([update]):
+    if isinstance(tensors, (list, tuple)):
+      return type(tensors)(_after(update, t) for t in tensors)
+    return tf.identity(tensors)
+
+
+class PipelineStats(object):
+  """Builds the instrumentation tensors of one input pipeline."""
+
+  def __init__(self, enabled):
+    self.enabled = enabled
+    self.counters = {}
+    self.stages = {}
+    self.queues = {}
+    self.batch_ready = None
+    if enabled:
+      tf.add_to_collection(COLLECTION, self)
+
+  def _counter(self, name):
+    if name not in self.counters:
+      with tf.name_scope('pipeline_stats'):
+        self.counters[name] = _local_variable(name.replace('/', '_'), [],
+                                              tf.int64)
+    return self.counters[name]
+
+  def count(self, name, tensors, n=1):
+    """Count n events each time tensors are produced.
+
+    Returns:
+      tensors, available only once the counter has been updated.
+    """
+    if not self.enabled:
+      return tensors
+    with tf.control_dependencies(_flatten(tensors)):
+      update = tf.assign_add(self._counter(name), n, use_locking=True)
+    return _after(update, tensors)
+
+  def count_op(self, name, op, n=1):
+    """Count n events each time op runs; returns the op to run instead."""
+    if not self.enabled:
+      return op
+    with tf.control_dependencies([op]):
+      return tf.assign_add(self._counter(name), n, use_locking=True).op
+
+  def stage(self, name, inputs, outputs):
+    """Accumulate the wall time from inputs to outputs being available.
+
+    Returns:
+      outputs, available only once the time has been recorded.
+    """
+    if not self.enabled:
+      return outputs
+    if name not in self.stages:
+      with tf.name_scope('pipeline_stats'):
+        # total seconds, number of runs
+        self.stages[name] = _local_variable('stage_' + name, [2], tf.float64)
+    with tf.control_dependencies(_flatten(inputs)):
+      start = tf.timestamp()
+    with tf.control_dependencies(_flatten(outputs)):
+      end = tf.timestamp()
+    update = tf.assign_add(self.stages[name], tf.stack([end - start, 1.]),
+                           use_locking=True)
+    return _after(update, outputs)
+
+  def queue(self, name, queue, capacity):
+    """Register a queue whose fill level should be exported."""
+    if self.enabled:
+      self.queues[name] = (queue.size(), capacity, queue.name)
+
+  def mark_batch_ready(self, tensors):
+    """Record when a training batch is ready, to split the step time."""
+    if not self.enabled:
+      return
+    with tf.control_dependencies(_flatten(tensors)):
+      self.batch_ready = tf.timestamp()
+
+
+def _queue_capacity(queue):
+  try:
+    return queue.queue_ref.op.get_attr('capacity')
+  except ValueError:
+    return -1
+
+
+class PipelineMonitorHook(tf.train.SessionRunHook):
+  """Exports the PipelineStats of the graph as summaries and a trace."""
+
+  def __init__(self, output_dir, every_n_steps=100, trace_path=None):
+    self._output_dir = output_dir
+    self._every_n_steps = every_n_steps
+    self._trace_path = trace_path
+    self._events = []
+
+  def begin(self):
+    stats = tf.get_collection(COLLECTION)
+    self._counters = {}
+    self._stages = {}
+    self._queues = {}
+    self._batch_ready = []
+    for s in stats:
+      self._counters.update(s.counters)
+      self._stages.update(s.stages)
+      self._queues.update(s.queues)
+      if s.batch_ready is not None:
+        self._batch_ready.append(s.batch_ready)
+    registered = set(q[2] for q in self._queues.values())
+    for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS):
+      if qr.queue.name not in registered:
+        self._queues[qr.queue.name] = (qr.queue.size(),
+                                       _queue_capacity(qr.queue),
+                                       qr.queue.name)
+    self._writer = tf.summary.FileWriterCache.get(self._output_dir)
+    self._step = 0
+    self._last = None
+    self._input_wait = []
+    self._compute = []
+
+  def before_run(self, run_context):
+    self._start = time.time()
+    fetches = {'batch_ready': self._batch_ready}
+    if self._step % self._every_n_steps == 0:
+      fetches['counters'] = self._counters
+      fetches['stages'] = self._stages
+      fetches['queues'] = {k: v[0] for k, v in self._queues.items()}
+    return tf.train.SessionRunArgs(fetches)
+
+  def after_run(self, run_context, run_values):
+    end = time.time()
+    results = run_values.results
+    if results['batch_ready']:
+      ready = max(min(results['batch_ready']), self._start)
+      self._input_wait.append(ready - self._start)
+      self._compute.append(end - ready)
+      if self._trace_path:
+        self._trace('input_wait', self._start, ready)
+        self._trace('compute', ready, end)
+    if 'counters' in results:
+      self._export(results, end)
+    self._step += 1
+
+  def _trace(self, name, start, end):
+    self._events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                         'ts': start * 1e6, 'dur': (end - start) * 1e6})
+
+  def _export(self, results, now):
+    values = {}
+    for name, size in results['queues'].items():
+      capacity = self._queues[name][1]
+      if capacity > 0:
+        values['pipeline/%s/fill_fraction' % name] = size / capacity
+    if self._last is not None:
+      last_time, last_counters, last_stages = self._last
+      elapsed = max(now - last_time, 1e-6)
+      for name, count in results['counters'].items():
+        values['pipeline/%s_per_sec' % name] = (
+            (count - last_counters[name]) / elapsed)
+      for name, (total, runs) in results['stages'].items():
+        last_total, last_runs = last_stages[name]
+        if runs > last_runs:
+          values['pipeline/stage/%s_ms' % name] = (
+              1000. * (total - last_total) / (runs - last_runs))
+    if self._input_wait:
+      values['pipeline/step/input_wait_ms'] = (
+          1000. * sum(self._input_wait) / len(self._input_wait))
+      values['pipeline/step/compute_ms'] = (
+          1000. * sum(self._compute) / len(self._compute))
+      self._input_wait, self._compute = [], []
+    self._last = (now, results['counters'], results['stages'])
+
+    summary = tf.Summary(value=[tf.Summary.Value(tag=k, simple_value=v)
+                                for k, v in sorted(values.items())])
+    self._writer.add_summary(summary, self._step)
+    if self._trace_path:
+      self._events.append({'name': 'pipeline', 'ph': 'C', 'pid': 0,
+                           'ts': now * 1e6,
+                           'args': {k: v for k, v in values.items()
+                                    if k.endswith('fill_fraction')}})
+
+  def end(self, session):
+    self._writer.flush()
+    if self._trace_path:
+      with open(self._trace_path, 'w') as f:
+        json.dump({'traceEvents': self._events}, f)
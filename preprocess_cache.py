@@ -0,0 +1,163 @@
+"""Memory-mapped cache of the deterministic stages of the input pipeline.
+
+ Parsing, decode_raw of the 230x230x3 images, the points readout and, for
+ evaluation, the fixed patch crop give the same result every epoch. A
+ PreprocessCache stores those results once, as one .npy array per field
+ with the records in shard order,
+
+   <cache_dir>/<key>/<field>.npy   (N, ...) arrays, opened memory-mapped
+   <cache_dir>/<key>/index.json    shards, their size, mtime and sha1, the
+                                   first row and record count of each, the
+                                   stage and its parameters
+
+ where key hashes the shard paths, the stage name and its parameters, so
+ changing any of them selects another cache. A cache is valid while every
+ shard has the recorded size and mtime, or, when those changed, the same
+ content sha1. Caches are built in a temporary directory and renamed into
+ place. The module does not depend on TensorFlow; `image_processing`
+ materializes the stages and streams batches from the arrays.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+CACHE_VERSION = 1
+INDEX = 'index.json'
+
+
+def content_digest(path, block_size=1 << 20):
+  """Hex sha1 of the content of a file."""
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      h.update(block)
+  return h.hexdigest()
+
+
+def _stat(path):
+  st = os.stat(path)
+  return st.st_size, st.st_mtime_ns
+
+
+class PreprocessCache(object):
+  """The cached output of one stage over a list of shards."""
+
+  def __init__(self, cache_dir, shards, stage, params):
+    """
+    Args:
+      cache_dir: directory holding the caches.
+      shards: list of shard paths, in the order their records are cached.
+      stage: name of the cached stage.
+      params: dict of every parameter the stage output depends on.
+    """
+    self.shards = [os.path.abspath(s) for s in shards]
+    self.stage = stage
+    self.params = params
+    key = json.dumps({'shards': self.shards, 'stage': stage,
+                      'params': params, 'version': CACHE_VERSION},
+                     sort_keys=True)
+    self.path = os.path.join(cache_dir,
+                             hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+  def _load_index(self):
+    try:
+      with open(os.path.join(self.path, INDEX)) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def valid(self):
+    """Whether the cache exists and its shards did not change."""
+    index = self._load_index()
+    if index is None or [s['path'] for s in index['shards']] != self.shards:
+      return False
+    touched = False
+    for shard in index['shards']:
+      try:
+        size, mtime = _stat(shard['path'])
+      except OSError:
+        return False
+      if (size, mtime) == (shard['size'], shard['mtime_ns']):
+        continue
+      if (size != shard['size'] or
+          content_digest(shard['path']) != shard['sha1']):
+        return False
+      # Same content, only touched.
+      shard['mtime_ns'] = mtime
+      touched = True
+    if touched:
+      self._write_index(self.path, index)
+    return True
+
+  @staticmethod
+  def _write_index(directory, index):
+    tmp = os.path.join(directory, INDEX + '.tmp%d' % os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(index, f, indent=2)
+    os.rename(tmp, os.path.join(directory, INDEX))
+
+  def build(self, fields, counts, batches):
+    """Materialize the stage into the cache.
+
+    Args:
+      fields: dict of field name to (per-record shape, numpy dtype).
+      counts: number of records of each shard.
+      batches: iterable of dicts of field name to arrays of consecutive
+        records, in shard order.
+    """
+    total = int(sum(counts))
+    tmp = '%s.tmp%d' % (self.path, os.getpid())
+    if os.path.exists(tmp):
+      shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    arrays = {name: np.lib.format.open_memmap(
+                  os.path.join(tmp, name + '.npy'), mode='w+', dtype=dtype,
+                  shape=(total,) + tuple(shape))
+              for name, (shape, dtype) in fields.items()}
+    row = 0
+    for batch in batches:
+      n = len(next(iter(batch.values())))
+      for name, values in batch.items():
+        arrays[name][row:row + n] = values
+      row += n
+    if row != total:
+      raise ValueError('Materialized %d records, the shards hold %d' %
+                       (row, total))
+    for a in arrays.values():
+      a.flush()
+    del arrays
+
+    first = np.cumsum([0] + list(counts))
+    shards = []
+    for i, path in enumerate(self.shards):
+      size, mtime = _stat(path)
+      shards.append({'path': path, 'size': size, 'mtime_ns': mtime,
+                     'sha1': content_digest(path), 'first': int(first[i]),
+                     'count': int(counts[i])})
+    self._write_index(tmp, {'stage': self.stage, 'params': self.params,
+                            'fields': sorted(fields), 'records': total,
+                            'shards': shards})
+    if os.path.exists(self.path):
+      shutil.rmtree(self.path)
+    os.rename(tmp, self.path)
+
+  def open(self, ram_bytes=0):
+    """dict of field name to its array.
+
+    Arrays are memory-mapped, or read into memory when all of them together
+    fit in ram_bytes.
+    """
+    index = self._load_index()
+    arrays = {name: np.load(os.path.join(self.path, name + '.npy'),
+                            mmap_mode='r')
+              for name in index['fields']}
+    if sum(a.nbytes for a in arrays.values()) <= ram_bytes:
+      arrays = {name: np.array(a) for name, a in arrays.items()}
+    return arrays
@@ -0,0 +1,248 @@
+"""Post-training quantization of the patch network for CPU inference.
+
+ Restores a checkpoint of `model.model`, calibrates activation ranges on
+ --calibration_batches batches of `image_processing.inputs()` and converts
+ the network with the TensorFlow Lite converter, either to
+
+   int8     int8 weights and activations, float input and output
+   float16  float16 weights, float32 compute
+
+ The next --eval_batches batches are then run through the float graph and
+ the quantized model, one face at a time on one core, and the report gives
+ top-1 accuracy of both, their top-1 agreement, the mean absolute logit
+ difference and the per-core latency and throughput of both. The report is
+ printed and written next to the quantized model as JSON.
+
+ The towers mode of model.model is converted, since its conv, pool and
+ fully-connected ops all have int8 TFLite kernels, which the batched matmul
+ of the grouped mode does not. int8 mode first asks for int8 builtins only.
+ Converters without an int8 kernel for one of the ops, such as ELU in older
+ releases, reject that; the conversion is then retried with float builtins
+ allowed, those ops stay float between quantize and dequantize ops, and the
+ report lists the tensors that stayed float under 'float_tensors'.
+
+ The converter needs TensorFlow 1.15 or later, for representative_dataset
+ calibration and target_spec. Older releases fail with an error that says
+ so.
+
+ Usage:
+   python quantize.py --checkpoint=./model.ckpt --quantize_mode=int8 \
+       --quantized_model=./model_int8.tflite
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import image_processing
+import model
+
+tf.app.flags.DEFINE_string('checkpoint', '',
+                           """Checkpoint of model.model to quantize.""")
+tf.app.flags.DEFINE_string('quantize_mode', 'int8',
+                           """'int8' or 'float16'.""")
+tf.app.flags.DEFINE_string('quantized_model', './model_quantized.tflite',
+                           """Path of the quantized model.""")
+tf.app.flags.DEFINE_integer('calibration_batches', 10,
+                            """Batches of inputs() used for calibration.""")
+tf.app.flags.DEFINE_integer('eval_batches', 20,
+                            """Batches of inputs() used for the report.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+# TF1 releases do not export the converter's error class.
+try:
+  from tensorflow.lite.python.convert import ConverterError
+except ImportError:
+  ConverterError = RuntimeError
+
+_CONVERSION_ERRORS = (ConverterError, RuntimeError, ValueError)
+
+
+def sample_batches(num_batches, batch_size):
+  """Evaluation batches of (patches, labels) from image_processing.inputs."""
+  with tf.Graph().as_default():
+    images, labels = image_processing.inputs(None, batch_size=batch_size)
+    with tf.Session() as sess:
+      sess.run(tf.local_variables_initializer())
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+      try:
+        batches = [sess.run([images, labels]) for _ in range(num_batches)]
+      finally:
+        coord.request_stop()
+        coord.join(threads, stop_grace_period_secs=5)
+  return batches
+
+
+def _single_core_config():
+  return tf.ConfigProto(intra_op_parallelism_threads=1,
+                        inter_op_parallelism_threads=1)
+
+
+class FloatModel(object):
+  """The restored float network with a batch of one face as input."""
+
+  def __init__(self, checkpoint):
+    size = FLAGS.image_size
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.patches = tf.placeholder(tf.float32, [1, 13, size, size, 3],
+                                    name='patches')
+      self.logits = tf.identity(
+          model.model(self.patches, 1, train=False, mode='towers'),
+          name='logits')
+      saver = tf.train.Saver()
+    self.sess = tf.Session(graph=self.graph, config=_single_core_config())
+    saver.restore(self.sess, checkpoint)
+
+  def __call__(self, patches):
+    return self.sess.run(self.logits, {self.patches: patches})
+
+
+def _converter(float_model, mode, calibration, supported_ops=None):
+  if not hasattr(tf.lite, 'TFLiteConverter'):
+    raise RuntimeError('quantize.py needs TensorFlow 1.15 or later, this is '
+                       '%s.' % tf.__version__)
+  converter = tf.lite.TFLiteConverter.from_session(
+      float_model.sess, [float_model.patches], [float_model.logits])
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if mode == 'int8':
+    def representative_dataset():
+      for batch in calibration:
+        for patches in batch:
+          yield [patches[None].astype(np.float32)]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = supported_ops
+  elif mode == 'float16':
+    converter.target_spec.supported_types = [tf.float16]
+  else:
+    raise ValueError('Unknown quantize_mode %r' % mode)
+  return converter
+
+
+def convert(float_model, mode, calibration):
+  """Quantized TFLite flatbuffer of float_model.
+
+  Args:
+    float_model: FloatModel.
+    mode: 'int8' or 'float16'.
+    calibration: list of [batch, 13, size, size, 3] float arrays.
+  Returns:
+    the flatbuffer, and whether it holds int8 builtins only. Always False
+    for float16.
+  Raises:
+    RuntimeError: if the converter cannot quantize the network.
+  """
+  if mode != 'int8':
+    return _converter(float_model, mode, calibration).convert(), False
+  int8 = tf.lite.OpsSet.TFLITE_BUILTINS_INT8
+  try:
+    return _converter(float_model, mode, calibration, [int8]).convert(), True
+  except _CONVERSION_ERRORS as e:
+    print('int8 builtins only failed, keeping unsupported ops float: %s' %
+          str(e).strip().split('\n')[-1])
+  try:
+    flatbuffer = _converter(float_model, mode, calibration,
+                            [int8, tf.lite.OpsSet.TFLITE_BUILTINS]).convert()
+  except _CONVERSION_ERRORS as e:
+    raise RuntimeError(
+        'int8 conversion failed under TensorFlow %s: %s\nFull-integer '
+        'quantization needs TensorFlow 1.15 or later; '
+        '--quantize_mode=float16 avoids calibration.' % (tf.__version__, e))
+  return flatbuffer, False
+
+
+class QuantizedModel(object):
+  """A TFLite interpreter on one core."""
+
+  def __init__(self, flatbuffer):
+    try:
+      self.interpreter = tf.lite.Interpreter(model_content=flatbuffer,
+                                             num_threads=1)
+    except TypeError:
+      self.interpreter = tf.lite.Interpreter(model_content=flatbuffer)
+    self.interpreter.allocate_tensors()
+    self._input = self.interpreter.get_input_details()[0]['index']
+    self._output = self.interpreter.get_output_details()[0]['index']
+
+  def float_tensors(self):
+    """Names of the float32 tensors between the input and the output."""
+    return sorted(d['name'] for d in self.interpreter.get_tensor_details()
+                  if d['dtype'] == np.float32 and
+                  d['index'] not in (self._input, self._output))
+
+  def __call__(self, patches):
+    self.interpreter.set_tensor(self._input, patches.astype(np.float32))
+    self.interpreter.invoke()
+    return self.interpreter.get_tensor(self._output)
+
+
+def _evaluate(run, batches):
+  """Logits of every face and the seconds each one took."""
+  logits, durations = [], []
+  for patches, _ in batches:
+    for face in patches:
+      start = time.time()
+      logits.append(run(face[None])[0])
+      durations.append(time.time() - start)
+  return np.array(logits), np.array(durations)
+
+
+def report(float_model, quantized_model, batches, mode):
+  """Accuracy and speed of the quantized model against the float one."""
+  labels = np.concatenate([l for _, l in batches])
+  float_logits, float_times = _evaluate(float_model, batches)
+  quant_logits, quant_times = _evaluate(quantized_model, batches)
+  float_top1 = float_logits.argmax(1)
+  quant_top1 = quant_logits.argmax(1)
+  result = {
+      'mode': mode,
+      'examples': len(labels),
+      'float_top1_accuracy': float(np.mean(float_top1 == labels)),
+      'quantized_top1_accuracy': float(np.mean(quant_top1 == labels)),
+      'top1_agreement': float(np.mean(float_top1 == quant_top1)),
+      'mean_abs_logit_diff': float(np.abs(float_logits - quant_logits).mean()),
+  }
+  for name, times in (('float', float_times), ('quantized', quant_times)):
+    result[name + '_latency_ms_p50'] = 1000. * float(np.percentile(times, 50))
+    result[name + '_latency_ms_p99'] = 1000. * float(np.percentile(times, 99))
+    result[name + '_examples_per_sec_per_core'] = len(times) / times.sum()
+  result['speedup'] = (result['quantized_examples_per_sec_per_core'] /
+                       result['float_examples_per_sec_per_core'])
+  return result
+
+
+def main(unused_argv):
+  if not FLAGS.checkpoint:
+    raise ValueError('Please supply a --checkpoint')
+  batches = sample_batches(FLAGS.calibration_batches + FLAGS.eval_batches,
+                           FLAGS.batch_size)
+  calibration = [p for p, _ in batches[:FLAGS.calibration_batches]]
+  evaluation = batches[FLAGS.calibration_batches:]
+
+  float_model = FloatModel(FLAGS.checkpoint)
+  flatbuffer, int8_only = convert(float_model, FLAGS.quantize_mode,
+                                 calibration)
+  with open(FLAGS.quantized_model, 'wb') as f:
+    f.write(flatbuffer)
+
+  quantized_model = QuantizedModel(flatbuffer)
+  result = report(float_model, quantized_model, evaluation,
+                  FLAGS.quantize_mode)
+  result['model_bytes'] = len(flatbuffer)
+  if FLAGS.quantize_mode == 'int8':
+    result['int8_builtins_only'] = int8_only
+    result['float_tensors'] = quantized_model.float_tensors()
+  with open(FLAGS.quantized_model + '.report.json', 'w') as f:
+    json.dump(result, f, indent=2, sort_keys=True)
+  print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  tf.app.run()
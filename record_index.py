@@ -0,0 +1,217 @@
+"""Offset indexes of TFRecord shards and a random-access record sampler.
+
+ Every shard gets a sidecar index, `<shard>.index`, built once by scanning the
+ TFRecord framing
+
+   uint64 length, uint32 masked crc32c of length, data, uint32 crc32c of data
+
+ and storing the (offset, length) of every record's data as a flat uint64
+ array. `IndexedRecordSampler` uses the indexes to shuffle the whole data set
+ with one permutation per epoch and fetches the records by positioned reads,
+ through mmap or pread. Shuffle quality does not depend on a buffer size,
+ memory stays bounded by the indexes, and the first record is available as
+ soon as the indexes are loaded.
+
+ Usage:
+   python record_index.py './train/*'      # build the indexes up front
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import glob
+import mmap
+import os
+import struct
+import sys
+
+import numpy as np
+
+INDEX_SUFFIX = '.index'
+
+# Name of the file pointing at the current manifest of dataset_manager.py.
+MANIFEST = 'MANIFEST'
+
+_HEADER = struct.Struct('<QI')
+
+
+def index_path(shard):
+  return shard + INDEX_SUFFIX
+
+
+def scan_shard(shard):
+  """Scan the TFRecord framing of a shard.
+
+  Returns:
+    (N, 2) uint64 array of the (offset, length) of each record's data.
+
+  Raises:
+    ValueError: if the shard ends in the middle of a record.
+  """
+  entries = []
+  size = os.path.getsize(shard)
+  with open(shard, 'rb') as f:
+    pos = 0
+    while pos < size:
+      header = f.read(_HEADER.size)
+      if len(header) < _HEADER.size:
+        raise ValueError('Truncated record header in %s at %d' % (shard, pos))
+      length, _ = _HEADER.unpack(header)
+      data_offset = pos + _HEADER.size
+      pos = data_offset + length + 4
+      if pos > size:
+        raise ValueError('Truncated record in %s at %d' % (shard, data_offset))
+      entries.append((data_offset, length))
+      f.seek(pos)
+  return np.array(entries, dtype=np.uint64).reshape(-1, 2)
+
+
+def build_index(shard):
+  """Write the sidecar index of a shard, atomically; returns the index."""
+  index = scan_shard(shard)
+  path = index_path(shard)
+  tmp = '%s.tmp%d' % (path, os.getpid())
+  with open(tmp, 'wb') as f:
+    f.write(index.tobytes())
+  os.rename(tmp, path)
+  return index
+
+
+def load_index(shard):
+  """The index of a shard, (re)built when missing or older than the shard."""
+  path = index_path(shard)
+  try:
+    if os.path.getmtime(path) >= os.path.getmtime(shard):
+      return np.fromfile(path, dtype=np.uint64).reshape(-1, 2)
+  except OSError:
+    pass
+  return build_index(shard)
+
+
+def manifest_shards(directory):
+  """Names of the shards of the current dataset_manager generation.
+
+  Returns:
+    set of shard names, or None if directory has no manifest.
+  """
+  try:
+    with open(os.path.join(directory, MANIFEST)) as f:
+      name = f.read().strip()
+  except IOError:
+    return None
+  with np.load(os.path.join(directory, name)) as data:
+    return set(data['shards'].tolist())
+
+
+def shard_files(pattern):
+  """Shards matching pattern, without their sidecar files.
+
+  In a directory managed by dataset_manager.py only the shards of the current
+  generation are returned.
+  """
+  files = [f for f in glob.glob(pattern)
+           if not f.endswith(INDEX_SUFFIX) and '.index.tmp' not in f]
+  current = manifest_shards(os.path.dirname(pattern) or '.')
+  if current is not None:
+    files = [f for f in files if os.path.basename(f) in current]
+  return sorted(files)
+
+
+class IndexedRecordSampler(object):
+  """Yields the serialized records of a set of shards in random order.
+
+  Every epoch is a fresh permutation of all records. Records are fetched in
+  chunks; inside a chunk the reads are sorted by shard and offset, which keeps
+  them close together on disk, and handed out in permutation order.
+  """
+
+  def __init__(self, shards, seed=None, use_mmap=True, chunk_size=256,
+               num_workers=1, worker_index=0):
+    """
+    Args:
+      shards: list of TFRecord shard paths.
+      seed: optional integer seed of the permutations.
+      use_mmap: read through mmap, otherwise with os.pread.
+      chunk_size: number of records fetched together.
+      num_workers, worker_index: yield only every num_workers-th record of
+        each permutation, starting at worker_index, so that workers sharing
+        a seed see disjoint parts of the data set.
+    """
+    if not shards:
+      raise ValueError('No shards to sample from')
+    self.shards = list(shards)
+    indexes = [load_index(s) for s in self.shards]
+    self._shard_ids = np.concatenate(
+        [np.full(len(ix), i, dtype=np.int32) for i, ix in enumerate(indexes)])
+    self._offsets = np.concatenate([ix[:, 0] for ix in indexes])
+    self._lengths = np.concatenate([ix[:, 1] for ix in indexes])
+    self._seed = seed
+    self._use_mmap = use_mmap
+    self._chunk_size = chunk_size
+    self._num_workers = num_workers
+    self._worker_index = worker_index
+    self._files = [None] * len(self.shards)
+    self._maps = [None] * len(self.shards)
+
+  def __len__(self):
+    return len(self._offsets)
+
+  def _read(self, shard_id, offset, length):
+    if self._use_mmap:
+      if self._maps[shard_id] is None:
+        with open(self.shards[shard_id], 'rb') as f:
+          self._maps[shard_id] = mmap.mmap(f.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+      return self._maps[shard_id][offset:offset + length]
+    if self._files[shard_id] is None:
+      self._files[shard_id] = os.open(self.shards[shard_id], os.O_RDONLY)
+    return os.pread(self._files[shard_id], length, offset)
+
+  def permutation(self, epoch):
+    """Record numbers of one epoch, for this worker."""
+    seed = None if self._seed is None else self._seed + epoch
+    order = np.random.RandomState(seed).permutation(len(self))
+    return order[self._worker_index::self._num_workers]
+
+  def epoch(self, epoch=0):
+    """Yield the serialized records of one epoch."""
+    order = self.permutation(epoch)
+    for start in range(0, len(order), self._chunk_size):
+      chunk = order[start:start + self._chunk_size]
+      by_position = sorted(range(len(chunk)), key=lambda i: (
+          self._shard_ids[chunk[i]], self._offsets[chunk[i]]))
+      records = [None] * len(chunk)
+      for i in by_position:
+        r = chunk[i]
+        records[i] = self._read(self._shard_ids[r], int(self._offsets[r]),
+                                int(self._lengths[r]))
+      for record in records:
+        yield record
+
+  def __call__(self):
+    """Yield records forever, one permutation after the other."""
+    epoch = 0
+    while True:
+      for record in self.epoch(epoch):
+        yield record
+      epoch += 1
+
+  def close(self):
+    for m in self._maps:
+      if m is not None:
+        m.close()
+    for fd in self._files:
+      if fd is not None:
+        os.close(fd)
+    self._maps = [None] * len(self.shards)
+    self._files = [None] * len(self.shards)
+
+
+def main(argv):
+  for pattern in argv[1:]:
+    for shard in shard_files(pattern):
+      print('%s: %d records' % (shard, len(build_index(shard))))
+
+
+if __name__ == '__main__':
+  main(sys.argv)
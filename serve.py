@@ -0,0 +1,434 @@
+"""Local inference service for face classification.
+
+ Loads a checkpoint of `model.model` and serves top-k predictions over the 600
+ outputs on a localhost HTTP endpoint:
+
+   POST /classify  Content-Type: image/*             raw face photo
+   POST /classify  Content-Type: application/x-npz   'image' 230x230x3 uint8
+                                                      aligned crop, 'points'
+                                                      13x2 feature points
+   GET  /stats                                        latency and throughput
+
+ Photos are detected and aligned (`util.procrustes_batch`/`util.transform`)
+ on a worker thread pool. Concurrent requests are gathered into micro-batches
+ of at most --max_batch_size examples, waiting at most --max_batch_wait_ms for
+ a batch to fill, and each micro-batch is one session run.
+
+ Usage:
+   python serve.py --checkpoint=./model.ckpt --port=8500
+   python serve.py --checkpoint=./model.ckpt --load_test_seconds=30
+   python serve.py --frozen_graph=./face_model.pb
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import http.client
+import io
+import json
+import threading
+import time
+from concurrent import futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import tensorflow as tf
+
+import build_image_data
+import frozen_runtime
+import image_processing
+import model
+import util
+
+tf.app.flags.DEFINE_string('checkpoint', '',
+                           """Checkpoint of model.model to serve.""")
+tf.app.flags.DEFINE_string('frozen_graph', '',
+                           """Frozen graph written by export_model.py, """
+                           """served instead of --checkpoint.""")
+tf.app.flags.DEFINE_string('model_mode', 'grouped',
+                           """Tower construction, see model.model.""")
+tf.app.flags.DEFINE_integer('port', 8500,
+                            """Port to listen on, on localhost.""")
+tf.app.flags.DEFINE_integer('top_k', 5,
+                            """Number of classes returned per face.""")
+tf.app.flags.DEFINE_integer('max_batch_size', 32,
+                            """Largest micro-batch.""")
+tf.app.flags.DEFINE_float('max_batch_wait_ms', 5.0,
+                          """Longest a request waits for its batch to fill.""")
+tf.app.flags.DEFINE_integer('align_threads', 4,
+                            """Threads detecting and aligning photos.""")
+tf.app.flags.DEFINE_integer('load_test_seconds', 0,
+                            """Run the built-in load generator for this """
+                            """long instead of serving forever.""")
+tf.app.flags.DEFINE_integer('load_test_concurrency', 16,
+                            """Concurrent clients of the load generator.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class Stats(object):
+  """Thread-safe latency and throughput counters."""
+
+  def __init__(self, window=10000):
+    self._lock = threading.Lock()
+    self._latencies = collections.deque(maxlen=window)
+    self._batch_sizes = collections.deque(maxlen=window)
+    self._count = 0
+    self._start = time.time()
+
+  def add_latency(self, seconds):
+    with self._lock:
+      self._latencies.append(seconds)
+      self._count += 1
+
+  def add_batch(self, size):
+    with self._lock:
+      self._batch_sizes.append(size)
+
+  def reset(self):
+    with self._lock:
+      self._latencies.clear()
+      self._batch_sizes.clear()
+      self._count = 0
+      self._start = time.time()
+
+  def summary(self):
+    with self._lock:
+      latencies = np.array(self._latencies) * 1000.
+      batch_sizes = np.array(self._batch_sizes)
+      count = self._count
+      elapsed = time.time() - self._start
+    result = {'requests': count,
+              'throughput': count / max(elapsed, 1e-6),
+              'mean_batch_size': (float(batch_sizes.mean())
+                                  if len(batch_sizes) else 0.)}
+    for p in (50, 90, 99):
+      result['p%d_ms' % p] = (float(np.percentile(latencies, p))
+                              if len(latencies) else 0.)
+    return result
+
+
+class FaceClassifier(object):
+  """Restored patch network taking aligned faces and their points."""
+
+  def __init__(self, checkpoint, top_k, mode):
+    self.graph = tf.Graph()
+    with self.graph.as_default():
+      self.images = tf.placeholder(tf.uint8, [None, util.FACE_SIZE,
+                                              util.FACE_SIZE, 3])
+      self.points = tf.placeholder(tf.int32, [None, 13, 2])
+      patches = image_processing.augment_batch(self.images, self.points,
+                                               train=False,
+                                               add_summaries=False)
+      logits = model.model(patches, None, train=False, mode=mode)
+      self.scores, self.classes = tf.nn.top_k(tf.nn.softmax(logits), top_k)
+      saver = tf.train.Saver()
+    self.sess = tf.Session(graph=self.graph)
+    saver.restore(self.sess, checkpoint)
+
+  def run(self, images, points):
+    """Top-k (scores, classes) of a batch of aligned faces."""
+    return self.sess.run([self.scores, self.classes],
+                         {self.images: images, self.points: points})
+
+
+class MicroBatcher(object):
+  """Gathers concurrent requests into batches for one run function."""
+
+  def __init__(self, run_batch, max_batch_size, max_wait, stats):
+    self._run_batch = run_batch
+    self._max_batch_size = max_batch_size
+    self._max_wait = max_wait
+    self._stats = stats
+    self._pending = collections.deque()
+    self._cond = threading.Condition()
+    self._closed = False
+    self._thread = threading.Thread(target=self._loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, image, points):
+    """Queue one aligned face; returns a Future of (scores, classes).
+
+    Raises:
+      ValueError: if image is not uint8 [230, 230, 3] or points not integer
+        [13, 2].
+    """
+    image = np.asarray(image)
+    points = np.asarray(points)
+    if (image.shape != (util.FACE_SIZE, util.FACE_SIZE, 3) or
+        image.dtype != np.uint8):
+      raise ValueError('image must be uint8 %dx%dx3, got %s %s' % (
+          util.FACE_SIZE, util.FACE_SIZE, image.dtype, image.shape))
+    if (points.shape != (len(util.FEATURE_POINTS), 2) or
+        points.dtype.kind not in 'iu'):
+      raise ValueError('points must be integer %dx2, got %s %s' % (
+          len(util.FEATURE_POINTS), points.dtype, points.shape))
+    future = futures.Future()
+    with self._cond:
+      if self._closed:
+        raise RuntimeError('MicroBatcher is closed')
+      self._pending.append((image, points, future))
+      self._cond.notify()
+    return future
+
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._thread.join()
+
+  def _next_batch(self):
+    with self._cond:
+      while not self._pending and not self._closed:
+        self._cond.wait()
+      if not self._pending:
+        return None
+      deadline = time.time() + self._max_wait
+      while len(self._pending) < self._max_batch_size and not self._closed:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self._cond.wait(remaining)
+      n = min(len(self._pending), self._max_batch_size)
+      return [self._pending.popleft() for _ in range(n)]
+
+  def _loop(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      try:
+        images = np.stack([b[0] for b in batch])
+        points = np.stack([b[1] for b in batch]).astype(np.int32)
+        scores, classes = self._run_batch(images, points)
+      except Exception as e:  # pylint: disable=broad-except
+        for _, _, future in batch:
+          future.set_exception(e)
+        continue
+      self._stats.add_batch(len(batch))
+      for i, (_, _, future) in enumerate(batch):
+        future.set_result((scores[i], classes[i]))
+
+
+class Aligner(object):
+  """Detects and aligns photos with one dlib predictor per thread."""
+
+  def __init__(self, predictor_path, base_face, upsample):
+    import dlib
+    self._dlib = dlib
+    self._predictor_path = predictor_path
+    self._upsample = upsample
+    self._local = threading.local()
+    detector, predictor = self._models()
+    self._base_shape = build_image_data.load_base_shape(
+        detector, predictor, base_face, upsample)
+
+  def _models(self):
+    if not hasattr(self._local, 'predictor'):
+      self._local.detector = self._dlib.get_frontal_face_detector()
+      self._local.predictor = self._dlib.shape_predictor(self._predictor_path)
+    return self._local.detector, self._local.predictor
+
+  def align(self, data):
+    """Aligned face and feature points of the photo in data.
+
+    Raises:
+      ValueError: if no face is found.
+    """
+    from PIL import Image
+    img = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+    detector, predictor = self._models()
+    _, shape = build_image_data._detect_landmarks(img, detector, predictor,
+                                                  self._upsample)
+    if shape is None:
+      raise ValueError('No face found')
+    faces, points = build_image_data.align_faces([img], shape[None],
+                                                 self._base_shape)
+    return faces[0], points[0]
+
+
+class InferenceService(object):
+  """Alignment pool in front of a micro-batched classifier."""
+
+  def __init__(self, classifier, aligner, max_batch_size, max_wait,
+               align_threads):
+    self.stats = Stats()
+    self._aligner = aligner
+    self._batcher = MicroBatcher(classifier.run, max_batch_size, max_wait,
+                                 self.stats)
+    self._pool = futures.ThreadPoolExecutor(align_threads)
+
+  def classify_aligned(self, image, points):
+    """Top-k (scores, classes) of an aligned face, blocking."""
+    start = time.time()
+    result = self._batcher.submit(image, points).result()
+    self.stats.add_latency(time.time() - start)
+    return result
+
+  def classify_photo(self, data):
+    """Top-k (scores, classes) of the face in an encoded photo, blocking."""
+    if self._aligner is None:
+      raise ValueError('Photo alignment is not available')
+    start = time.time()
+    image, points = self._pool.submit(self._aligner.align, data).result()
+    result = self._batcher.submit(image, points).result()
+    self.stats.add_latency(time.time() - start)
+    return result
+
+  def close(self):
+    self._pool.shutdown()
+    self._batcher.close()
+
+
+def _make_handler(service):
+
+  class Handler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+      data = json.dumps(body).encode('utf-8')
+      self.send_response(code)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):
+      if self.path == '/stats':
+        self._reply(200, service.stats.summary())
+      else:
+        self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+      if self.path != '/classify':
+        self._reply(404, {'error': 'not found'})
+        return
+      data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      try:
+        if self.headers.get('Content-Type') == 'application/x-npz':
+          arrays = np.load(io.BytesIO(data))
+          scores, classes = service.classify_aligned(arrays['image'],
+                                                     arrays['points'])
+        else:
+          scores, classes = service.classify_photo(data)
+      except (ValueError, KeyError, IOError) as e:
+        self._reply(400, {'error': str(e)})
+        return
+      self._reply(200, {'classes': classes.tolist(),
+                        'scores': scores.tolist()})
+
+    def log_message(self, *args):
+      pass
+
+  return Handler
+
+
+def serve(service, port):
+  """HTTP server for service on localhost, not yet started."""
+  return ThreadingHTTPServer(('127.0.0.1', port), _make_handler(service))
+
+
+def _encode_aligned(image, points):
+  buf = io.BytesIO()
+  np.savez(buf, image=image, points=points)
+  return buf.getvalue()
+
+
+def load_test(port, concurrency, seconds):
+  """Post synthetic aligned faces from concurrent clients.
+
+  Returns:
+    dict of client-side latency percentiles and throughput.
+  """
+  rng = np.random.RandomState(0)
+  bodies = [_encode_aligned(
+                rng.randint(0, 256, (util.FACE_SIZE, util.FACE_SIZE, 3))
+                .astype(np.uint8),
+                rng.randint(40, util.FACE_SIZE - 40, (13, 2)))
+            for _ in range(8)]
+  latencies = [[] for _ in range(concurrency)]
+  errors = [0] * concurrency
+  deadline = time.time() + seconds
+
+  def client(i):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    n = 0
+    while time.time() < deadline:
+      start = time.time()
+      conn.request('POST', '/classify', bodies[n % len(bodies)],
+                   {'Content-Type': 'application/x-npz'})
+      response = conn.getresponse()
+      response.read()
+      if response.status == 200:
+        latencies[i].append(time.time() - start)
+      else:
+        errors[i] += 1
+      n += 1
+    conn.close()
+
+  threads = [threading.Thread(target=client, args=(i,))
+             for i in range(concurrency)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = time.time() - start
+
+  all_latencies = np.concatenate([np.array(l) for l in latencies]) * 1000.
+  result = {'requests': len(all_latencies), 'errors': sum(errors),
+            'concurrency': concurrency,
+            'throughput': len(all_latencies) / elapsed}
+  for p in (50, 90, 99):
+    result['p%d_ms' % p] = (float(np.percentile(all_latencies, p))
+                            if len(all_latencies) else 0.)
+  return result
+
+
+def main(unused_argv):
+  if FLAGS.frozen_graph:
+    classifier = frozen_runtime.FrozenClassifier(FLAGS.frozen_graph,
+                                                 top_k=FLAGS.top_k)
+  elif FLAGS.checkpoint:
+    classifier = FaceClassifier(FLAGS.checkpoint, FLAGS.top_k,
+                                FLAGS.model_mode)
+  else:
+    raise ValueError('Please supply a --checkpoint or --frozen_graph')
+  try:
+    aligner = Aligner(FLAGS.predictor_path, FLAGS.base_face, FLAGS.upsample)
+  except (ImportError, IOError, RuntimeError) as e:
+    print('Photo alignment disabled: %s' % e)
+    aligner = None
+  service = InferenceService(classifier, aligner, FLAGS.max_batch_size,
+                             FLAGS.max_batch_wait_ms / 1000.,
+                             FLAGS.align_threads)
+  # The load generator picks any free port.
+  server = serve(service, 0 if FLAGS.load_test_seconds else FLAGS.port)
+  port = server.server_address[1]
+
+  if not FLAGS.load_test_seconds:
+    print('Serving on 127.0.0.1:%d' % port)
+    try:
+      server.serve_forever()
+    finally:
+      server.server_close()
+      service.close()
+    return
+
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  try:
+    result = load_test(port, FLAGS.load_test_concurrency,
+                       FLAGS.load_test_seconds)
+    result['server'] = service.stats.summary()
+    print(json.dumps(result, indent=2, sort_keys=True))
+  finally:
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -0,0 +1,240 @@
+"""Data-parallel training of model.model over many processes.
+
+ Launches one worker process per rank. Every worker builds its own graph of
+ `image_processing.distorted_inputs` and `model.model`, reads a disjoint
+ subset of the training shards (--task_index/--num_tasks), computes the
+ gradients of its batch, and the workers average their gradients with a
+ ring allreduce (`allreduce.Ring`) over TCP sockets before each applies the
+ same update. The variables of rank 0 are broadcast at start, so all
+ replicas stay identical. Small sessions in many processes keep all cores of
+ a host busy where the intra-op parallelism of one session does not.
+
+ The ring is given by --ring_addresses, one host:port per rank. By default
+ --num_procs ranks run on localhost. To span hosts, run the driver on every
+ host with the same --ring_addresses and the ranks of that host in
+ --local_ranks.
+
+ With --scaling_sweep the driver instead trains --train_steps steps with
+ each of the given process counts on this host and reports throughput and
+ scaling efficiency, throughput / (procs * throughput of one process),
+ printed and written to --scaling_report.
+
+ Usage:
+   python train_parallel.py --num_procs=16 --train_steps=10000
+   python train_parallel.py --scaling_sweep=1,2,4,8,16 --train_steps=50
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import allreduce
+import image_processing
+import model
+
+tf.app.flags.DEFINE_string('train_dir', './train_logs',
+                           """Directory of the checkpoints of rank 0.""")
+tf.app.flags.DEFINE_integer('train_steps', 1000,
+                            """Number of synchronous steps.""")
+tf.app.flags.DEFINE_float('learning_rate', 0.01,
+                          """Learning rate of the momentum optimizer.""")
+tf.app.flags.DEFINE_string('model_mode', 'grouped',
+                           """Tower construction, see model.model.""")
+tf.app.flags.DEFINE_integer('num_procs', max(1, (os.cpu_count() or 1) // 4),
+                            """Processes on localhost without """
+                            """--ring_addresses.""")
+tf.app.flags.DEFINE_integer('base_port', 29500,
+                            """First port of the localhost ring.""")
+tf.app.flags.DEFINE_string('ring_addresses', '',
+                           """Comma separated host:port of every rank.""")
+tf.app.flags.DEFINE_string('local_ranks', '',
+                           """Comma separated ranks to run on this host, """
+                           """all by default.""")
+tf.app.flags.DEFINE_integer('log_every_n_steps', 10,
+                            """Steps between the progress lines of rank 0.""")
+tf.app.flags.DEFINE_string('scaling_sweep', '',
+                           """Comma separated process counts to benchmark.""")
+tf.app.flags.DEFINE_string('scaling_report', './scaling.json',
+                           """File the scaling results are written to.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class _Flattener(object):
+  """Packs a list of arrays into one float32 buffer and back."""
+
+  def __init__(self, shapes):
+    self.shapes = shapes
+    sizes = [int(np.prod(s)) for s in shapes]
+    self.offsets = np.cumsum([0] + sizes)
+    self.buffer = np.empty(self.offsets[-1], dtype=np.float32)
+
+  def pack(self, arrays):
+    for i, a in enumerate(arrays):
+      self.buffer[self.offsets[i]:self.offsets[i + 1]] = a.ravel()
+    return self.buffer
+
+  def unpack(self):
+    return [self.buffer[self.offsets[i]:self.offsets[i + 1]].reshape(s)
+            for i, s in enumerate(self.shapes)]
+
+
+def _session_config(local_procs):
+  threads = max(1, (os.cpu_count() or 1) // local_procs)
+  return tf.ConfigProto(intra_op_parallelism_threads=threads,
+                        inter_op_parallelism_threads=2)
+
+
+def train_worker(argv, rank, addresses, local_procs, results):
+  """Body of one rank; puts its timing summary on the results queue."""
+  FLAGS(argv)
+  FLAGS.task_index = rank
+  FLAGS.num_tasks = len(addresses)
+  ring = allreduce.Ring(rank, addresses)
+
+  with tf.Graph().as_default():
+    global_step = tf.train.get_or_create_global_step()
+    images, labels = image_processing.distorted_inputs(None)
+    logits = model.model(images, FLAGS.batch_size, train=True,
+                         mode=FLAGS.model_mode)
+    loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=labels, logits=logits))
+    variables = tf.trainable_variables()
+    gradients = [tf.convert_to_tensor(g)
+                 for g in tf.gradients(loss, variables)]
+    averaged = [tf.placeholder(tf.float32, v.get_shape()) for v in variables]
+    optimizer = tf.train.MomentumOptimizer(FLAGS.learning_rate, 0.9)
+    train_op = optimizer.apply_gradients(zip(averaged, variables),
+                                         global_step=global_step)
+    saver = tf.train.Saver() if rank == 0 else None
+
+    shapes = [v.get_shape().as_list() for v in variables]
+    packed = _Flattener(shapes)
+    with tf.Session(config=_session_config(local_procs)) as sess:
+      sess.run([tf.global_variables_initializer(),
+                tf.local_variables_initializer()])
+      ring.broadcast(packed.pack(sess.run(variables)))
+      for v, value in zip(variables, packed.unpack()):
+        v.load(value, sess)
+
+      coord = tf.train.Coordinator()
+      threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+      compute = communicate = 0.
+      start = time.time()
+      try:
+        for step in range(FLAGS.train_steps):
+          t0 = time.time()
+          loss_value, grads = sess.run([loss, gradients])
+          t1 = time.time()
+          ring.allreduce(packed.pack(grads))
+          packed.buffer /= ring.size
+          t2 = time.time()
+          sess.run(train_op, dict(zip(averaged, packed.unpack())))
+          compute += (t1 - t0) + (time.time() - t2)
+          communicate += t2 - t1
+          if rank == 0 and step % FLAGS.log_every_n_steps == 0:
+            print('step %d, loss = %.3f, %.1f examples/sec' % (
+                step, loss_value, (step + 1) * FLAGS.batch_size * ring.size /
+                (time.time() - start)))
+      finally:
+        coord.request_stop()
+        coord.join(threads, stop_grace_period_secs=5)
+      duration = time.time() - start
+      if saver is not None:
+        saver.save(sess, os.path.join(FLAGS.train_dir, 'model.ckpt'),
+                   global_step=global_step)
+  ring.close()
+  results.put({'rank': rank, 'seconds': duration, 'compute': compute,
+               'allreduce': communicate,
+               'examples': FLAGS.train_steps * FLAGS.batch_size})
+
+
+def run(addresses, ranks, argv):
+  """Run the given ranks of a job on this host; returns their summaries."""
+  context = multiprocessing.get_context('spawn')
+  results = context.Queue()
+  procs = [context.Process(target=train_worker,
+                           args=(argv, rank, addresses, len(ranks), results))
+           for rank in ranks]
+  for p in procs:
+    p.start()
+  summaries = []
+  try:
+    while len(summaries) < len(procs):
+      try:
+        summaries.append(results.get(timeout=1.))
+      except queue.Empty:
+        # A dead rank leaves the others blocked in allreduce for good.
+        for p in procs:
+          if p.exitcode:
+            raise RuntimeError('Worker exited with code %d' % p.exitcode)
+  finally:
+    if len(summaries) < len(procs):
+      for p in procs:
+        if p.is_alive():
+          p.terminate()
+  for p in procs:
+    p.join()
+    if p.exitcode:
+      raise RuntimeError('Worker exited with code %d' % p.exitcode)
+  return sorted(summaries, key=lambda s: s['rank'])
+
+
+def _localhost(num_procs):
+  return ['localhost:%d' % (FLAGS.base_port + i) for i in range(num_procs)]
+
+
+def scaling_sweep(counts, argv):
+  """Train with each process count; returns one result per count."""
+  report = []
+  for n in counts:
+    summaries = run(_localhost(n), list(range(n)), argv)
+    seconds = max(s['seconds'] for s in summaries)
+    result = {'procs': n,
+              'examples_per_sec': sum(s['examples'] for s in summaries) /
+                                  seconds,
+              'allreduce_fraction': np.mean([s['allreduce'] / s['seconds']
+                                             for s in summaries])}
+    base = report[0] if report else result
+    result['efficiency'] = (result['examples_per_sec'] * base['procs'] /
+                            (base['examples_per_sec'] * n))
+    report.append(result)
+    print('%3d procs %10.1f examples/sec  efficiency %.2f  allreduce %.0f%%'
+          % (n, result['examples_per_sec'], result['efficiency'],
+             100. * result['allreduce_fraction']))
+  return report
+
+
+def main(unused_argv):
+  if not os.path.isdir(FLAGS.train_dir):
+    os.makedirs(FLAGS.train_dir)
+  if FLAGS.scaling_sweep:
+    counts = [int(n) for n in FLAGS.scaling_sweep.split(',')]
+    report = scaling_sweep(counts, sys.argv)
+    with open(FLAGS.scaling_report, 'w') as f:
+      json.dump({'cpus': os.cpu_count(), 'batch_size': FLAGS.batch_size,
+                 'results': report}, f, indent=2)
+    return
+
+  addresses = (FLAGS.ring_addresses.split(',') if FLAGS.ring_addresses
+               else _localhost(FLAGS.num_procs))
+  ranks = ([int(r) for r in FLAGS.local_ranks.split(',')]
+           if FLAGS.local_ranks else list(range(len(addresses))))
+  summaries = run(addresses, ranks, sys.argv)
+  for s in summaries:
+    print('rank %d: %.1f examples/sec, %.0f%% in allreduce' % (
+        s['rank'], s['examples'] / s['seconds'],
+        100. * s['allreduce'] / s['seconds']))
+
+
+if __name__ == '__main__':
+  tf.app.run()
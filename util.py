@@ -1,5 +1,13 @@
 import numpy as np
-from scipy import ndimage, misc
+
+# scipy.ndimage is imported by the warps that need it, so that procrustes
+# alone starts without scipy.
+
+# side of the square aligned face images stored in the records
+FACE_SIZE = 230
+
+# indices of the 13 dlib landmarks the model extracts patches around
+FEATURE_POINTS = [20, 23, 26, 29, 33, 37, 41, 44, 47, 17, 54, 60, 66]
 
 def procrustes(X, Y, scaling=True, reflection='best'):
     """
@@ -107,14 +115,191 @@ def procrustes(X, Y, scaling=True, reflection='best'):
 
     return d, Z, tform
 
-def transform(img, tform):
-    imgt = np.squeeze(np.dsplit(img, 3))
-    imgt = map(lambda e:
-               ndimage.shift(
-                   ndimage.zoom(
-                       ndimage.affine_transform(e, tform['rotation'].T),
-                       tform['scale']),
-                   reversed(tform['translation'])), imgt)
+def procrustes_batch(X, Y, scaling=True, reflection='best'):
+    """
+    Batched version of `procrustes`: aligns a whole stack of landmark sets
+    to one reference shape with stacked SVDs.
+
+        d, Z, tform = procrustes_batch(X, Y)
+
+    Inputs:
+    ------------
+    X
+        (K, M) matrix of target (reference) coordinates.
+
+    Y
+        (N, K, M) stack of input coordinates, one landmark set per face.
+
+    scaling, reflection
+        same meaning as in `procrustes`, applied to every face.
+
+    Outputs
+    ------------
+    d
+        (N,) residual sums of squared errors
+
+    Z
+        (N, K, M) transformed Y-values
+
+    tform
+        a dict of stacked transformation values: 'rotation' (N, M, M),
+        'scale' (N,) and 'translation' (N, M). tform[...][i] gives the same
+        numbers as `procrustes(X, Y[i])`.
+
+    """
+
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim != 3 or Y.shape[1:] != X.shape:
+        raise ValueError('Y must be a (N, %d, %d) stack, got %s'
+                         % (X.shape + (Y.shape,)))
 
-    return np.moveaxis(imgt, 0, -1) #revert axis
+    muX = X.mean(0)
+    muY = Y.mean(1)
+
+    X0 = X - muX
+    Y0 = Y - muY[:, None, :]
+
+    ssX = (X0**2.).sum()
+    ssY = (Y0**2.).sum(axis=(1, 2))
+
+    # centred Frobenius norm
+    normX = np.sqrt(ssX)
+    normY = np.sqrt(ssY)
+
+    # scale to equal (unit) norm
+    X0 /= normX
+    Y0 /= normY[:, None, None]
+
+    # optimum rotation matrices of Y, one SVD per face
+    A = np.einsum('km,nkl->nml', X0, Y0)
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
+    V = np.swapaxes(Vt, 1, 2)
+    T = np.matmul(V, np.swapaxes(U, 1, 2))
+
+    if reflection != 'best':
+        # does the current solution use a reflection?
+        have_reflection = np.linalg.det(T) < 0
+        # force another reflection where that's not what was specified
+        flip = have_reflection != reflection
+        if flip.any():
+            V[flip, :, -1] *= -1
+            s[flip, -1] *= -1
+            T[flip] = np.matmul(V[flip], np.swapaxes(U[flip], 1, 2))
+
+    traceTA = s.sum(1)
+
+    if scaling:
+        # optimum scaling of Y
+        b = traceTA * normX / normY
+        # standarised distance between X and b*Y*T + c
+        d = 1 - traceTA**2
+        # transformed coords
+        Z = (normX*traceTA)[:, None, None]*np.matmul(Y0, T) + muX
+
+    else:
+        b = np.ones_like(traceTA)
+        d = 1 + ssY/ssX - 2 * traceTA * normY / normX
+        Z = normY[:, None, None]*np.matmul(Y0, T) + muX
+
+    c = muX - b[:, None]*np.einsum('nm,nml->nl', muY, T)
+
+    #transformation values
+    tform = {'rotation':T, 'scale':b, 'translation':c}
+
+    return d, Z, tform
+
+def transform(img, tform, fused=False, out=None, order=1):
+    """
+    Warp a face image with a `procrustes` tform.
+
+    The legacy mode resamples every channel three times (affine_transform,
+    zoom, shift). With fused=True the rotation, scale and translation are
+    combined into one matrix and all channels are sampled in a single pass
+    straight into a FACE_SIZE x FACE_SIZE x 3 uint8 buffer.
+
+    Inputs:
+    ------------
+    img
+        (H, W, 3) image
+
+    tform
+        a dict as returned by `procrustes`
+
+    fused
+        use the single-pass warp
+
+    out
+        optional preallocated (FACE_SIZE, FACE_SIZE, 3) uint8 output buffer,
+        fused mode only
+
+    order
+        spline interpolation order of the fused warp (0-5)
+
+    Outputs
+    ------------
+    the warped image (`out` if given)
+    """
+    from scipy import ndimage
+    if not fused:
+        imgt = np.squeeze(np.dsplit(img, 3))
+        imgt = [ndimage.shift(
+                    ndimage.zoom(
+                        ndimage.affine_transform(e, tform['rotation'].T),
+                        tform['scale']),
+                    list(reversed(tform['translation']))) for e in imgt]
+
+        return np.moveaxis(imgt, 0, -1) #revert axis
+
+    if out is None:
+        out = np.empty((FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8)
+    matrix, offset = _fused_matrix(tform['rotation'], tform['scale'],
+                                   tform['translation'])
+    ndimage.affine_transform(img, matrix, offset=offset,
+                             output_shape=out.shape, output=out, order=order)
+    return out
+
+def transform_batch(imgs, tforms, out=None, order=1):
+    """
+    Fused warp of a chunk of faces.
+
+    Inputs:
+    ------------
+    imgs
+        sequence of N (H, W, 3) images, or an (N, H, W, 3) array
+
+    tforms
+        a dict of stacked values as returned by `procrustes_batch`
+
+    out
+        optional preallocated (N, FACE_SIZE, FACE_SIZE, 3) uint8 buffer
+
+    order
+        spline interpolation order
+
+    Outputs
+    ------------
+    the (N, FACE_SIZE, FACE_SIZE, 3) uint8 batch (`out` if given)
+    """
+    from scipy import ndimage
+    n = len(imgs)
+    if out is None:
+        out = np.empty((n, FACE_SIZE, FACE_SIZE, 3), dtype=np.uint8)
+    for i in range(n):
+        matrix, offset = _fused_matrix(tforms['rotation'][i],
+                                       tforms['scale'][i],
+                                       tforms['translation'][i])
+        ndimage.affine_transform(imgs[i], matrix, offset=offset,
+                                 output_shape=out.shape[1:], output=out[i],
+                                 order=order)
+    return out
 
+def _fused_matrix(rotation, scale, translation):
+    # The legacy chain affine_transform(R.T) -> zoom(b) -> shift(c) samples
+    # the input at R.T (o - c) / b in (row, col) coordinates. The channel
+    # axis is mapped onto itself.
+    matrix = np.eye(3)
+    matrix[:2, :2] = rotation.T / scale
+    offset = np.zeros(3)
+    offset[:2] = -np.dot(matrix[:2, :2], translation[::-1])
+    return matrix, offset
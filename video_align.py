@@ -0,0 +1,347 @@
+"""Aligns the faces of video streams, tracking landmarks between frames.
+
+ Running dlib detection with upsampling on every frame cannot keep up with a
+ camera. Here the detector only runs
+
+   on keyframes, every --keyframe_interval frames,
+   when the face was lost, and
+   when tracking confidence drops: the `util.procrustes` disparity of the
+   tracked landmarks to the base face exceeds --max_track_disparity,
+
+ and then on the frame downscaled by --detect_downscale. On all other frames
+ the face box is predicted from the previous frame's landmarks. The 68-point
+ predictor always runs on the full resolution frame, and the face is aligned
+ with the fused `util.transform` warp.
+
+ Each stream is a video file (read with imageio) or a directory of frames.
+ Streams are spread over a bounded pool of --video_workers processes. Inside
+ a worker, frame decoding, tracking plus alignment, and writing run as a
+ pipeline of three threads joined by bounded queues. Aligned faces go to
+ one TFRecord file per stream in --video_output, in the face record format,
+ with label -1 and text '<stream>:<frame number>'. A stream is named after
+ its basename, followed by a hash of its full path when several streams
+ share that basename. If the decoder or the writer fails, the stream stops
+ and its error is raised in the worker.
+
+ Per stream the fps, the latency from frame decode to written record
+ (p50, p99, null when no face was written), and the number of detections
+ are printed and appended to --video_report as JSON lines.
+
+ Usage:
+   python video_align.py --video_workers=4 cam0.mp4 cam1.mp4 ./frames_dir
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import build_image_data
+import face_runtime
+import util
+
+tf.app.flags.DEFINE_integer('keyframe_interval', 30,
+                            """Frames between forced detections.""")
+tf.app.flags.DEFINE_integer('detect_downscale', 2,
+                            """Integer factor frames are downscaled by """
+                            """for detection.""")
+tf.app.flags.DEFINE_integer('detect_upsample', 0,
+                            """Times dlib upsamples the downscaled frame.""")
+tf.app.flags.DEFINE_float('max_track_disparity', 0.05,
+                          """Largest procrustes disparity of tracked """
+                          """landmarks before redetecting.""")
+tf.app.flags.DEFINE_float('track_margin', 0.1,
+                          """Margin added around the previous landmarks """
+                          """to predict the face box.""")
+tf.app.flags.DEFINE_integer('video_workers', 0,
+                            """Streams processed at once, 0 for one per """
+                            """core.""")
+tf.app.flags.DEFINE_integer('frame_queue', 8,
+                            """Frames buffered between pipeline stages.""")
+tf.app.flags.DEFINE_string('video_output', './video_faces',
+                           """Directory of the aligned face records.""")
+tf.app.flags.DEFINE_string('video_report', './video_report.jsonl',
+                           """File the per-stream statistics go to.""")
+
+FLAGS = tf.app.flags.FLAGS
+
+# Per-worker dlib models, set up once by _init_worker.
+_detector = None
+_predictor = None
+_base_shape = None
+
+_END = object()
+
+
+class FaceTracker(object):
+  """Landmarks of the face of one stream, frame after frame."""
+
+  def __init__(self, detector, predictor, base_shape, keyframe_interval=30,
+               detect_downscale=2, detect_upsample=0,
+               max_track_disparity=0.05, track_margin=0.1):
+    self._detector = detector
+    self._predictor = predictor
+    self._base_shape = base_shape
+    self._keyframe_interval = keyframe_interval
+    self._downscale = detect_downscale
+    self._upsample = detect_upsample
+    self._max_disparity = max_track_disparity
+    self._margin = track_margin
+    self._shape = None
+    self._since_detection = 0
+    self.detections = 0
+    self.redetections = 0
+
+  def _detect(self, frame):
+    import dlib
+    self.detections += 1
+    self._since_detection = 0
+    s = self._downscale
+    dets = self._detector(np.ascontiguousarray(frame[::s, ::s]),
+                          self._upsample)
+    if len(dets) == 0:
+      return None
+    d = dets[0]
+    return dlib.rectangle(d.left() * s, d.top() * s, d.right() * s,
+                          d.bottom() * s)
+
+  def _tracked_box(self, frame):
+    import dlib
+    (left, top), (right, bottom) = self._shape.min(0), self._shape.max(0)
+    mx = self._margin * (right - left)
+    my = self._margin * (bottom - top)
+    height, width = frame.shape[:2]
+    return dlib.rectangle(int(max(left - mx, 0)), int(max(top - my, 0)),
+                          int(min(right + mx, width - 1)),
+                          int(min(bottom + my, height - 1)))
+
+  def _landmarks(self, frame, box):
+    shape = build_image_data.shape_to_array(self._predictor(frame, box))
+    d, z, tform = util.procrustes(self._base_shape, shape)
+    return shape, d, z, tform
+
+  def track(self, frame):
+    """Landmarks of the face in the next frame.
+
+    Returns:
+      (68, 2) landmarks, their procrustes (z, tform), and whether the
+      detector ran; landmarks are None when there is no face.
+    """
+    detected = (self._shape is None or
+                self._since_detection >= self._keyframe_interval)
+    box = self._detect(frame) if detected else self._tracked_box(frame)
+    self._since_detection += 1
+    if box is None:
+      self._shape = None
+      return None, None, detected
+    shape, d, z, tform = self._landmarks(frame, box)
+    if d > self._max_disparity and not detected:
+      # The tracked box drifted off the face.
+      self.redetections += 1
+      detected = True
+      box = self._detect(frame)
+      if box is None:
+        self._shape = None
+        return None, None, detected
+      shape, d, z, tform = self._landmarks(frame, box)
+    self._shape = shape
+    return shape, (z, tform), detected
+
+
+def _init_worker(predictor_path, base_shape):
+  global _detector, _predictor, _base_shape
+  import dlib
+  _detector = dlib.get_frontal_face_detector()
+  _predictor = dlib.shape_predictor(predictor_path)
+  _base_shape = base_shape
+
+
+def read_frames(path):
+  """Yield the (H, W, 3) uint8 frames of a video file or frame directory."""
+  if os.path.isdir(path):
+    from skimage import io
+    for filename in sorted(glob.glob(os.path.join(path, '*'))):
+      yield io.imread(filename)[..., :3]
+  else:
+    import imageio
+    reader = imageio.get_reader(path)
+    try:
+      for frame in reader:
+        yield np.asarray(frame)[..., :3]
+    finally:
+      reader.close()
+
+
+def _stage(target, *args):
+  thread = threading.Thread(target=target, args=args)
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+def _put(q, item, alive):
+  """Put item on q while alive() holds; returns whether it was put."""
+  while True:
+    try:
+      q.put(item, timeout=1.)
+      return True
+    except queue.Full:
+      if not alive():
+        return False
+
+
+def stream_names(streams):
+  """Output names of the streams, unique across them."""
+  bases = [os.path.basename(os.path.normpath(path)) for path in streams]
+  counts = collections.Counter(bases)
+  names = []
+  for path, base in zip(streams, bases):
+    if counts[base] > 1:
+      digest = hashlib.sha1(os.path.abspath(path).encode('utf-8'))
+      base = '%s-%s' % (base, digest.hexdigest()[:8])
+    names.append(base)
+  return names
+
+
+def align_stream(args):
+  """Align the faces of one (path, name) stream in a worker.
+
+  Returns:
+    dict of the statistics of the stream.
+  """
+  path, name = args
+  tracker = FaceTracker(_detector, _predictor, _base_shape,
+                        FLAGS.keyframe_interval, FLAGS.detect_downscale,
+                        FLAGS.detect_upsample, FLAGS.max_track_disparity,
+                        FLAGS.track_margin)
+  frames = queue.Queue(FLAGS.frame_queue)
+  faces = queue.Queue(FLAGS.frame_queue)
+  latencies = []
+  errors = []
+  # Set once the main loop is done, so a blocked decoder gives up.
+  stop = threading.Event()
+  running = lambda: not stop.is_set()
+
+  def decode():
+    try:
+      for number, frame in enumerate(read_frames(path)):
+        if not _put(frames, (number, time.time(), frame), running):
+          break
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+    finally:
+      _put(frames, _END, running)
+
+  def write():
+    try:
+      writer = tf.python_io.TFRecordWriter(
+          os.path.join(FLAGS.video_output, name + '.tfrecord'))
+      try:
+        while True:
+          item = faces.get()
+          if item is _END:
+            break
+          number, decoded, face, points = item
+          writer.write(face_runtime.face_example(
+              face.tobytes(), points.tobytes(), -1,
+              '%s:%d' % (name, number)))
+          latencies.append(time.time() - decoded)
+      finally:
+        writer.close()
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+
+  start = time.time()
+  decoder = _stage(decode)
+  writer = _stage(write)
+  num_frames = 0
+  try:
+    while True:
+      item = frames.get()
+      if item is _END:
+        break
+      number, decoded, frame = item
+      num_frames += 1
+      shape, alignment, _ = tracker.track(frame)
+      if shape is None:
+        continue
+      z, tform = alignment
+      face = util.transform(frame, tform, fused=True)
+      points = np.rint(z[util.FEATURE_POINTS]).astype(np.int64)
+      np.clip(points, 0, util.FACE_SIZE - 1, out=points)
+      if not _put(faces, (number, decoded, face, points), writer.is_alive):
+        break
+  finally:
+    stop.set()
+    _put(faces, _END, writer.is_alive)
+    writer.join()
+  decoder.join()
+  if errors:
+    raise errors[0]
+
+  duration = time.time() - start
+  num_faces = len(latencies)
+  # No latency without a written record.
+  p50 = p99 = None
+  if num_faces:
+    p50 = 1000. * float(np.percentile(latencies, 50))
+    p99 = 1000. * float(np.percentile(latencies, 99))
+  return {'stream': path, 'output': name, 'frames': num_frames,
+          'faces': num_faces,
+          'fps': num_frames / max(duration, 1e-6),
+          'latency_ms_p50': p50,
+          'latency_ms_p99': p99,
+          'detections': tracker.detections,
+          'redetections': tracker.redetections}
+
+
+def main(argv):
+  streams = argv[1:]
+  if not streams:
+    raise ValueError('Please supply video files or frame directories')
+  paths = [os.path.abspath(path) for path in streams]
+  if len(set(paths)) < len(paths):
+    raise ValueError('A stream is given more than once')
+  if not os.path.isdir(FLAGS.video_output):
+    os.makedirs(FLAGS.video_output)
+  import dlib
+  base_shape = build_image_data.load_base_shape(
+      dlib.get_frontal_face_detector(),
+      dlib.shape_predictor(FLAGS.predictor_path), FLAGS.base_face)
+
+  num_workers = FLAGS.video_workers or multiprocessing.cpu_count()
+  pool = multiprocessing.Pool(min(num_workers, len(streams)), _init_worker,
+                              (FLAGS.predictor_path, base_shape))
+  try:
+    with open(FLAGS.video_report, 'a') as report:
+      for stats in pool.imap_unordered(
+          align_stream, zip(streams, stream_names(streams))):
+        report.write(json.dumps(stats, sort_keys=True) + '\n')
+        report.flush()
+        latency = 'no faces'
+        if stats['faces']:
+          latency = 'latency p50 %.1f ms p99 %.1f ms' % (
+              stats['latency_ms_p50'], stats['latency_ms_p99'])
+        print('%s: %d frames, %d faces, %.1f fps, %s, %d detections '
+              '(%d redetections)' % (
+                  stats['stream'], stats['frames'], stats['faces'],
+                  stats['fps'], latency, stats['detections'],
+                  stats['redetections']))
+  finally:
+    pool.close()
+    pool.join()
+
+
+if __name__ == '__main__':
+  tf.app.run()